@@ -6,487 +6,3619 @@ import os
 import subprocess
 import json
 import errno
+import sqlite3
+import multiprocessing
+import shutil
+import threading
+import zlib
+import lzma
+import io
+import tarfile
+import time
+import hashlib
+import fnmatch
+import stat
+import select
+import struct
+import ctypes
+import ctypes.util
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
+from functools import partial
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None  # pylint: disable=C0103
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None  # pylint: disable=C0103
+
+# metadata files of the available backends
+JSON_METADATA = 'metadata.json'
+SQLITE_METADATA = 'metadata.sqlite'
+
+# ioctl request to clone a file on copy-on-write filesystems (Linux)
+FICLONE = 0x40049409
+
+# archive compression formats
+COMPRESSION_SUFFIXES = {'gz': '.tar.gz', 'xz': '.tar.xz', 'zst': '.tar.zst',
+                        'none': '.tar'}
+DEFAULT_COMPRESSION_LEVELS = {'gz': 6, 'xz': 6, 'zst': 3, 'none': 0}
+# lowest and highest compression level of each format
+COMPRESSION_LEVEL_RANGES = {'gz': (0, 9), 'xz': (0, 9), 'zst': (1, 22)}
+# size of the independently compressed blocks
+COMPRESSION_BLOCK_SIZE = 1024 * 1024
+
+# left out when packing directories not under git control, see is_excluded
+DEFAULT_EXCLUDES = ['obj/', 'bin/', '.DS_Store']
+
+# refuse absolute paths and the like when unpacking, where supported
+TAR_EXTRACT_OPTIONS = {'filter': 'tar'} if hasattr(tarfile,
+                                                   'tar_filter') else {}
+
+# record --journal compacts the journal automatically beyond this size
+JOURNAL_MAX_SIZE = 1024 * 1024
+
+# inotify events (see inotify(7)) watched by InotifyWatcher
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+INOTIFY_MASK = (IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO |
+                IN_CREATE | IN_DELETE)
+
+# Applications importing this module configure handlers on it, main() does
+# for the command line
+LOGGER = logging.getLogger('OFStateMgr')
+LOGGER.addHandler(logging.NullHandler())
 
 
 ###############################################################################
-def validate_git_repo(strict=True):
-    """Validate if current directory is in a git repo.
+class StateManagerError(Exception):
+    """Raised by the library functions (record_snapshot, archive_snapshot,
+    checkout_snapshot, list_snapshots) if an operation fails."""
+
+
+###############################################################################
+class Profiler(object):
+    """Timing of spans of work and of external commands, collected while
+    enabled, e.g. by --profile. Safe to use from several threads."""
+
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+
+    def enable(self):
+        """Start collecting, dropping anything collected before."""
+        with self._lock:
+            self.enabled = True
+            self.events = []
+            self._origin = time.perf_counter()
+
+    def _add(self, event):
+        """Store event, adding the current thread."""
+        thread = threading.current_thread()
+        event['thread'] = (thread.ident, thread.name)
+        with self._lock:
+            self.events.append(event)
+
+    @contextmanager
+    def span(self, name):
+        """Context manager timing the work done inside as span name."""
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._add({'kind': 'span', 'name': name, 'start': start,
+                       'end': time.perf_counter()})
+
+    def command(self, argv, cwd, start, end, returncode):
+        """Record an external command, see TracedPopen."""
+        if self.enabled:
+            self._add({'kind': 'command',
+                       'name': ' '.join(str(arg) for arg in argv),
+                       'cwd': cwd or os.getcwd(), 'start': start, 'end': end,
+                       'returncode': returncode})
+
+    def summary(self, limit=15):
+        """Return the lines of a summary of the collected events: spans and
+        commands by total time, and the slowest single commands."""
+        with self._lock:
+            events = list(self.events)
+        commands = [event for event in events if event['kind'] == 'command']
+        lines = ['Profile: ' + str(len(commands)) + ' external commands, ' +
+                 '{0:.1f} ms in total'.format(
+                    sum(event['end'] - event['start']
+                        for event in commands) * 1000)]
+        for kind, title, key in [
+                ('span', 'Spans', lambda event: event['name']),
+                ('command', 'Commands',
+                 lambda event: ' '.join(event['name'].split(' ')[0:2]))]:
+            totals = {}
+            for event in events:
+                if event['kind'] == kind:
+                    item = totals.setdefault(key(event), [0, 0.0])
+                    item[0] += 1
+                    item[1] += event['end'] - event['start']
+            lines.append(title + ' by total time:')
+            for name, (count, total) in sorted(
+                    totals.items(), key=lambda item: -item[1][1])[0:limit]:
+                lines.append('  {0:10.1f} ms {1:5d}x  {2}'.format(
+                                total * 1000, count, name))
+        lines.append('Slowest commands:')
+        for event in sorted(commands, key=lambda event:
+                            event['start'] - event['end'])[0:limit]:
+            lines.append('  {0:10.1f} ms  exit {1:3d}  {2}  (in {3})'.format(
+                            (event['end'] - event['start']) * 1000,
+                            event['returncode'], event['name'],
+                            event['cwd']))
+        return lines
+
+    def write_trace(self, path):
+        """Write the collected events as a Chrome trace_event file, for
+        chrome://tracing or Perfetto."""
+        with self._lock:
+            events = list(self.events)
+        threads = {}
+        trace = []
+        for event in events:
+            ident, name = event['thread']
+            if ident not in threads:
+                threads[ident] = len(threads) + 1
+                trace.append({'name': 'thread_name', 'ph': 'M',
+                              'pid': os.getpid(), 'tid': threads[ident],
+                              'args': {'name': name}})
+            item = {'name': event['name'], 'cat': event['kind'], 'ph': 'X',
+                    'ts': (event['start'] - self._origin) * 1e6,
+                    'dur': (event['end'] - event['start']) * 1e6,
+                    'pid': os.getpid(), 'tid': threads[ident]}
+            if event['kind'] == 'command':
+                item['args'] = {'cwd': event['cwd'],
+                                'returncode': event['returncode']}
+            trace.append(item)
+        with open(path, 'w') as trace_file:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'},
+                      trace_file)
+
+
+PROFILER = Profiler()
+
+
+###############################################################################
+class TracedPopen(subprocess.Popen):
+    """subprocess.Popen, recording argv, cwd, duration and exit code of the
+    command in PROFILER once it has been waited for. All external commands
+    are run through this class, see traced_call and traced_check_output."""
+
+    def __init__(self, args, **kwargs):
+        self._traced = False
+        self._trace_start = time.perf_counter()
+        self._trace_cwd = kwargs.get('cwd')
+        subprocess.Popen.__init__(self, args, **kwargs)
+
+    def wait(self, timeout=None):
+        returncode = subprocess.Popen.wait(self, timeout)
+        if not self._traced:
+            self._traced = True
+            PROFILER.command(self.args, self._trace_cwd, self._trace_start,
+                             time.perf_counter(), returncode)
+        return returncode
+
+
+###############################################################################
+def traced_call(args, **kwargs):
+    """Like subprocess.call, running args through TracedPopen."""
+    with TracedPopen(args, **kwargs) as process:
+        try:
+            return process.wait()
+        except BaseException:
+            process.kill()
+            raise
+
+
+###############################################################################
+def traced_check_output(args, **kwargs):
+    """Like subprocess.check_output, running args through TracedPopen."""
+    with TracedPopen(args, stdout=subprocess.PIPE, **kwargs) as process:
+        try:
+            output = process.communicate()[0]
+        except BaseException:
+            process.kill()
+            raise
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, args,
+                                                output=output)
+    return output
+
+
+###############################################################################
+def find_git_toplevel(path):
+    """Return the top level directory of the work tree containing path.
+
+    Walks up from path looking for a .git directory or gitdir file, without
+    spawning git. Return None if none is found."""
+
+    current = os.path.realpath(path)
+    while True:
+        if os.path.exists(os.path.join(current, '.git')):
+            return current
+        parent = os.path.dirname(current)
+        if parent == current:
+            return None
+        current = parent
+
+
+###############################################################################
+def probe_git_repo(path):
+    """Probe the git state of the directory at path, without logging.
+
+    Return one of 'clean', 'uncommitted', 'untracked' or 'no-repo'.
+    Safe to call from worker threads, as the working directory is not
+    changed."""
+
+    # Find out where path sits inside its work tree. Paths in git status'
+    # porcelain output are always relative to the top level directory.
+    toplevel = find_git_toplevel(path)
+    if toplevel is not None:
+        prefix = os.path.relpath(os.path.realpath(path), toplevel)
+        prefix = '' if prefix == os.curdir else prefix.replace(os.sep, '/')
+    else:
+        # exotic layout (e.g. GIT_DIR set), let git find the repo, if any
+        try:
+            with open(os.devnull, 'w') as devnull:
+                prefix = traced_check_output(
+                            ['git', 'rev-parse', '--show-prefix'], cwd=path,
+                            stderr=devnull, universal_newlines=True).strip()
+        except subprocess.CalledProcessError:
+            return 'no-repo'
+        prefix = prefix.rstrip('/')
+
+    # An ignored directory inside a git repo (i.e. in OF/addons/someAddon) is
+    # not a repo of its own. check-ignore only looks at the ignore rules,
+    # without walking the ignored files like git clean -xnd does.
+    if prefix:
+        if 0 == traced_call(['git', 'check-ignore', '-q', '.'], cwd=path):
+            return 'no-repo'
+
+    # One status call yields modified, staged, unmerged and untracked entries.
+    # Ignored files are not visited at all. --no-optional-locks keeps status
+    # from rewriting the index, so probing is side-effect free.
+    process = TracedPopen(['git', '--no-optional-locks', 'status',
+                           '--porcelain=v2', '-z',
+                           '--untracked-files=normal'],
+                          stdout=subprocess.PIPE, cwd=path)
+    out = process.communicate()[0].decode('utf-8', 'replace')
+    if process.returncode != 0:
+        return 'no-repo'
+
+    uncommitted = False
+    untracked = False
+    fields = iter(out.split('\0'))
+    for item in fields:
+        if item.startswith('? '):
+            item = item[2:]
+            if item.endswith('/') and (prefix + '/').startswith(item):
+                # the directory, or one of its parents, is wholly untracked,
+                # not a repo of its own
+                return 'no-repo'
+            # like ls-files --others ., only look below path
+            if not prefix or item.startswith(prefix + '/'):
+                untracked = True
+        elif item[:2] in ('1 ', 'u '):
+            uncommitted = True
+        elif item.startswith('2 '):
+            uncommitted = True
+            next(fields, None)  # skip the original path of the rename
+
+    if uncommitted:
+        return 'uncommitted'
+    elif untracked:
+        return 'untracked'
+    return 'clean'
+
+
+###############################################################################
+def report_repo_state(state, path, strict=True):
+    """Log the result of probe_git_repo for the repo at path.
 
     Return 0 on success, 1 on error if not in a git repo,
     2 for warning about not being in a git repo"""
 
     LOGGER.debug('Checking if in a git repository?')
-    # python3.3 offers subpocess.DEVNULL for output redirection
-    if ((0 == subprocess.call(['git', 'rev-parse'])) and
-        (1 == subprocess.call(
-                'git clean -xnd `pwd` | grep "Would remove \./" > /dev/null',
-                shell=True))):
-    # we are in a git repository, but not in an ignored directory inside a git
-    # repo (i.e. in OF/addons/someAddon)
-        LOGGER.debug('Yes, this is in a git repository.')
-        # check for uncommitted modifications
-        # apparently --quiet is not 100% reliable. Use --exit-code instead
-        if 0 != subprocess.call('git diff --exit-code HEAD > /dev/null',
-                                 shell=True):
-            LOGGER.error('Repository has uncommitted changes, ' +
-                         'commit those before continuing!')
+    if state == 'no-repo':
+        if strict is True:
+            LOGGER.error('Not in a git repository: ' + path)
             return 1
         else:
-            # Check for untracked files
-            if not subprocess.call(
-                        'git ls-files --others --exclude-standard ' +
-                        '--error-unmatch . > /dev/null 2>&1',
-                        shell=True):
-                LOGGER.error('Repository has untracked files, ' +
-                             'either commit, ignore or delete them.')
-                return 1
-            else:
-                LOGGER.debug('Repository clean')
-                return 0
-    else:
-        if strict is True:
-            LOGGER.error('Not in a git repository: ' + os.getcwd())
-            return 1
+            LOGGER.warning('Not in a git repository: ' + path)
+            return 2
+    LOGGER.debug('Yes, this is in a git repository.')
+    if state == 'uncommitted':
+        LOGGER.error('Repository has uncommitted changes, ' +
+                     'commit those before continuing!')
+        return 1
+    elif state == 'untracked':
+        LOGGER.error('Repository has untracked files, ' +
+                     'either commit, ignore or delete them.')
+        return 1
+    else:
+        LOGGER.debug('Repository clean')
+        return 0
+
+
+###############################################################################
+def validate_git_repo(strict=True, path=None):
+    """Validate if current directory (or path, if given) is in a git repo.
+
+    Return 0 on success, 1 on error if not in a git repo,
+    2 for warning about not being in a git repo"""
+
+    if path is None:
+        path = os.getcwd()
+    return report_repo_state(probe_git_repo(path), path, strict)
+
+
+###############################################################################
+def find_git_dirs(path):
+    """Return (gitdir, commondir) of the work tree containing path.
+
+    Understands .git directories as well as the gitdir files used by
+    worktrees and submodules. Return None if no repository was found, or if
+    its layout is not understood (e.g. reftable), so that callers fall back
+    to the git CLI."""
+
+    toplevel = find_git_toplevel(path)
+    if toplevel is None:
+        return None
+    gitdir = os.path.join(toplevel, '.git')
+    if os.path.isfile(gitdir):
+        with open(gitdir, 'r') as gitdir_file:
+            content = gitdir_file.read().strip()
+        if not content.startswith('gitdir:'):
+            return None
+        gitdir = os.path.join(toplevel, content[len('gitdir:'):].strip())
+    commondir = gitdir
+    try:
+        with open(os.path.join(gitdir, 'commondir'), 'r') as commondir_file:
+            commondir = os.path.join(gitdir, commondir_file.read().strip())
+    except IOError as exc:
+        if exc.errno != errno.ENOENT:  # pragma: no cover
+            raise
+    if (not os.path.isfile(os.path.join(gitdir, 'HEAD')) or
+            os.path.exists(os.path.join(commondir, 'reftable'))):
+        return None
+    return (os.path.normpath(gitdir), os.path.normpath(commondir))
+
+
+###############################################################################
+def is_sha(name):
+    """Return True if name looks like a full (SHA-1 or SHA-256) object name."""
+    return (len(name) in (40, 64) and
+            all(char in '0123456789abcdef' for char in name))
+
+
+###############################################################################
+def read_packed_refs(commondir):
+    """Return a dictionary refname -> SHA from the packed-refs file."""
+    refs = {}
+    try:
+        with open(os.path.join(commondir, 'packed-refs'), 'r') as packed:
+            for line in packed:
+                # skip comments and peeled tag objects ('^sha')
+                if line.startswith('#') or line.startswith('^'):
+                    continue
+                parts = line.split()
+                if len(parts) == 2:
+                    refs[parts[1]] = parts[0]
+    except IOError as exc:
+        if exc.errno != errno.ENOENT:  # pragma: no cover
+            raise
+    return refs
+
+
+###############################################################################
+def read_ref(git_dirs, refname, depth=0):
+    """Resolve refname (e.g. HEAD or refs/heads/master) to a SHA.
+
+    Loose refs take precedence over packed refs, as in git itself.
+    Return None if the ref cannot be resolved."""
+
+    gitdir, commondir = git_dirs
+    # HEAD is per worktree, everything under refs/ is shared
+    refpath = os.path.join(gitdir if refname == 'HEAD' else commondir,
+                           *refname.split('/'))
+    try:
+        with open(refpath, 'r') as ref_file:
+            content = ref_file.read().strip()
+    except IOError as exc:
+        if exc.errno not in (errno.ENOENT, errno.EISDIR, errno.ENOTDIR):
+            raise  # pragma: no cover
+        content = read_packed_refs(commondir).get(refname, '')
+    if content.startswith('ref:'):
+        if depth > 5:
+            return None
+        return read_ref(git_dirs, content[len('ref:'):].strip(), depth + 1)
+    return content if is_sha(content) else None
+
+
+###############################################################################
+def read_branches(git_dirs):
+    """Return a dictionary refname -> SHA of all local branches."""
+    commondir = git_dirs[1]
+    branches = dict((name, sha)
+                    for name, sha in read_packed_refs(commondir).items()
+                    if name.startswith('refs/heads/'))
+    heads_dir = os.path.join(commondir, 'refs', 'heads')
+    for dirpath, _dirnames, filenames in os.walk(heads_dir):
+        for filename in filenames:
+            refname = '/'.join(['refs', 'heads'] + os.path.relpath(
+                            os.path.join(dirpath, filename),
+                            heads_dir).split(os.sep))
+            with open(os.path.join(dirpath, filename), 'r') as ref_file:
+                sha = ref_file.read().strip()
+            if is_sha(sha):
+                branches[refname] = sha
+    return branches
+
+
+###############################################################################
+def get_head_sha(path):
+    """Return the SHA HEAD points to in the git repo at path."""
+    git_dirs = find_git_dirs(path)
+    if git_dirs is not None:
+        sha = read_ref(git_dirs, 'HEAD')
+        if sha is not None:
+            return sha
+    out = traced_check_output(['git', 'rev-parse', 'HEAD'],
+                              universal_newlines=True, cwd=path)
+    return out.strip()
+
+
+###############################################################################
+def probe_addon(path):
+    """Probe the addon directory at path for use in record.
+
+    Return a tuple (state, sha), with state as returned by probe_git_repo.
+    state is None if the addon directory does not exist, sha is None unless
+    the repo is clean. Runs in worker threads of record."""
+
+    if not os.path.isdir(path):
+        return (None, None)
+    state = probe_git_repo(path)
+    if state == 'clean':
+        return (state, get_head_sha(path))
+    return (state, None)
+
+
+###############################################################################
+def default_cache_dir():
+    """Return the default location of the shared archive cache."""
+    cache_home = (os.environ.get('XDG_CACHE_HOME') or
+                  os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(cache_home, 'ofStateManager', 'archives')
+
+
+###############################################################################
+def link_or_copy(source, target):
+    """Make the file source available at target without duplicating data.
+
+    Try a hard link first, then a reflink (copy-on-write clone) on
+    filesystems supporting it, then fall back to a plain copy."""
+
+    try:
+        os.link(source, target)
+        return
+    except OSError:
+        LOGGER.debug('Could not hard link ' + source + ', copying')
+    partpath = target + '.part'
+    with open(source, 'rb') as source_file:
+        with open(partpath, 'wb') as target_file:
+            cloned = False
+            if fcntl is not None:
+                try:
+                    fcntl.ioctl(target_file.fileno(), FICLONE,
+                                source_file.fileno())
+                    cloned = True
+                except (IOError, OSError):
+                    pass
+            if not cloned:
+                shutil.copyfileobj(source_file, target_file)
+    os.replace(partpath, target)
+
+
+###############################################################################
+class BlockCompressor(object):
+    """Compress tar streams in independent blocks on a thread pool.
+
+    Every block becomes a complete gzip member, xz stream or zstd frame.
+    Concatenations of those are valid files which standard tools (and thus
+    tar) decompress as a whole, just like the output of pigz. zlib, lzma and
+    zstandard release the GIL, so the blocks really are compressed in
+    parallel. Use as a context manager to shut down the thread pool."""
+
+    def __init__(self, compression='gz', level=None, jobs=1):
+        self.compression = compression
+        self.level = self.check_level(compression, level)
+        self.suffix = COMPRESSION_SUFFIXES[compression]
+        # archives in the shared cache also depend on the level
+        self.cache_suffix = '-level' + str(self.level) + self.suffix
+        # number of blocks which may be in flight per writer
+        self.queue_depth = 2 * max(1, jobs)
+        self._executor = ThreadPoolExecutor(max_workers=max(1, jobs))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_exc_info):
+        self._executor.shutdown()
+
+    @staticmethod
+    def check_level(compression, level):
+        """Return level, or the default level of compression if None.
+        Levels are ignored without compression. Raise StateManagerError if
+        compression does not support level."""
+        if level is None or compression not in COMPRESSION_LEVEL_RANGES:
+            return DEFAULT_COMPRESSION_LEVELS[compression]
+        lowest, highest = COMPRESSION_LEVEL_RANGES[compression]
+        if not lowest <= level <= highest:
+            raise StateManagerError('Compression level of ' + compression +
+                                    ' must be between ' + str(lowest) +
+                                    ' and ' + str(highest) + ', not ' +
+                                    str(level) + '.')
+        return level
+
+    def submit(self, data):
+        """Start compressing data, return a future of the compressed block."""
+        return self._executor.submit(self.compress_block, data)
+
+    def compress_block(self, data):
+        """Return data compressed as a self-contained block."""
+        if self.compression == 'gz':
+            # wbits=31 writes a gzip header, without timestamp
+            compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+            return compressor.compress(data) + compressor.flush()
+        elif self.compression == 'xz':
+            return lzma.compress(data, preset=self.level)
+        elif self.compression == 'zst':
+            return zstandard.ZstdCompressor(level=self.level).compress(data)
+        return data
+
+    def compress(self, source, target):
+        """Compress the file object source into the file object target.
+
+        Return the number of bytes written."""
+        writer = self.writer(target)
+        while True:
+            data = source.read(COMPRESSION_BLOCK_SIZE)
+            if not data:
+                break
+            writer.write(data)
+        writer.close()
+        return writer.written
+
+    def writer(self, target):
+        """Return a file-like object compressing everything written to it
+        into the file object target."""
+        return BlockWriter(self, target)
+
+
+###############################################################################
+class BlockWriter(object):
+    """Write-only file object compressing its input with a BlockCompressor.
+
+    At most two blocks per job are held in memory at any time. close() must
+    be called to write out the last block."""
+
+    def __init__(self, compressor, target):
+        self._compressor = compressor
+        self._target = target
+        self._buffer = []
+        self._buffered = 0
+        self._pending = deque()
+        self.written = 0
+
+    def write(self, data):
+        """Buffer data, hand full blocks to the compressor. Return the
+        number of bytes of data."""
+        size = len(data)
+        self._buffer.append(data)
+        self._buffered += size
+        if self._buffered >= COMPRESSION_BLOCK_SIZE:
+            buffered = b''.join(self._buffer)
+            end = len(buffered) - len(buffered) % COMPRESSION_BLOCK_SIZE
+            for start in range(0, end, COMPRESSION_BLOCK_SIZE):
+                self._submit(buffered[start:start + COMPRESSION_BLOCK_SIZE])
+            self._buffer = [buffered[end:]]
+            self._buffered = len(buffered) - end
+        return size
+
+    def _submit(self, block):
+        """Compress block in the background, write out finished blocks."""
+        self._pending.append(self._compressor.submit(block))
+        self._drain(self._compressor.queue_depth)
+
+    def _drain(self, limit):
+        """Write out compressed blocks until at most limit are pending."""
+        while len(self._pending) > limit:
+            block = self._pending.popleft().result()
+            self._target.write(block)
+            self.written += len(block)
+
+    def close(self):
+        """Compress the remaining data and write out all blocks."""
+        if self._buffered:
+            self._submit(b''.join(self._buffer))
+            self._buffer = []
+            self._buffered = 0
+        self._drain(0)
+
+
+###############################################################################
+def write_archive(command, cwd, target, compressor):
+    """Compress the tar stream written by command to the file target.
+
+    The archive is written to a temporary file next to target and only
+    renamed into place once complete, so an interrupted run never leaves a
+    truncated archive under the final name.
+    Return True on success. On failure, no file is left behind."""
+
+    partpath = target + '.part'
+    compressed = False
+    process = TracedPopen(command, stdout=subprocess.PIPE, cwd=cwd)
+    try:
+        with open(partpath, 'wb') as target_file:
+            compressor.compress(process.stdout, target_file)
+        compressed = True
+    finally:
+        process.stdout.close()
+        ret = process.wait()
+        if (ret != 0 or not compressed) and os.path.exists(partpath):
+            os.remove(partpath)
+    if ret != 0:
+        return False
+    os.replace(partpath, target)
+    return True
+
+
+###############################################################################
+def file_sha256(path):
+    """Return the hex SHA-256 checksum of the file at path."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as infile:
+        for chunk in iter(partial(infile.read, COMPRESSION_BLOCK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+###############################################################################
+class ArchiveManifest(object):
+    """Size and checksum of every archive written for a snapshot.
+
+    The manifest lives next to the archives and is rewritten atomically
+    after each finished archive, so it survives an interrupted run and lets
+    archive --resume tell complete archives from damaged ones."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        try:
+            with open(path, 'r') as manifest_file:
+                self.entries = json.load(manifest_file)
+        except IOError as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+        except ValueError:
+            LOGGER.warning('Ignoring unreadable archive manifest ' + path)
+
+    def record(self, archivefile):
+        """Add the finished archive archivefile to the manifest."""
+        item = {'size': os.path.getsize(archivefile),
+                'sha256': file_sha256(archivefile)}
+        with self.lock:
+            self.entries[os.path.basename(archivefile)] = item
+            with open(self.path + '.part', 'w') as manifest_file:
+                json.dump(self.entries, manifest_file, indent=1,
+                          sort_keys=True)
+            os.replace(self.path + '.part', self.path)
+
+    def __contains__(self, archivefile):
+        with self.lock:
+            return os.path.basename(archivefile) in self.entries
+
+    def verify(self, archivefile):
+        """Return True if archivefile matches its recorded size and
+        checksum."""
+        with self.lock:
+            item = self.entries.get(os.path.basename(archivefile))
+        if item is None or not os.path.isfile(archivefile):
+            return False
+        if os.path.getsize(archivefile) != item['size']:
+            return False
+        return file_sha256(archivefile) == item['sha256']
+
+
+###############################################################################
+def check_resumable(archivefile, manifest):
+    """Return True if archivefile was completed by an earlier run.
+
+    An existing archive which does not match the manifest is removed, so it
+    gets archived again."""
+
+    if manifest.verify(archivefile):
+        LOGGER.info(os.path.basename(archivefile) +
+                    ' verified. Skipping ...')
+        return True
+    if os.path.exists(archivefile):
+        LOGGER.warning(os.path.basename(archivefile) +
+                       ' is incomplete or corrupt. Archiving again.')
+        os.remove(archivefile)
+    return False
+
+
+###############################################################################
+def git_archive_repo(archivename, archivepath, repopath, repo_sha,
+                     compressor, cache_dir=None):
+    """Archive a git repo snapshot in the given archive file.
+
+    If cache_dir is given, the archive is taken from (or first added to) the
+    shared archive cache and linked into archivepath.
+    Return the number of bytes written, 0 if the archive already existed,
+    or None if archiving failed."""
+
+    outpath = os.path.abspath(os.path.join(archivepath, archivename))
+    if os.path.exists(outpath):
+        LOGGER.info(archivename + ' already exists. Skipping ...')
+        return 0
+    # Besides the SHA, only the prefix, format and level influence the
+    # archive content, so the cache is keyed by all of them
+    prefixname = os.path.basename(repopath)
+    if cache_dir is not None:
+        cachepath = os.path.join(cache_dir, prefixname,
+                                 repo_sha + compressor.cache_suffix)
+        if os.path.exists(cachepath):
+            LOGGER.info('Using cached archive for ' + archivename)
+            link_or_copy(cachepath, outpath)
+            return os.path.getsize(outpath)
+        target = (cachepath + '.' + str(os.getpid()) + '.' +
+                  str(threading.current_thread().ident) + '.tmp')
+        try:
+            os.makedirs(os.path.dirname(cachepath))
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:  # pragma: no cover
+                raise
+    else:
+        target = outpath
+    LOGGER.info('Archiving ' + archivename)
+    # git archive --format=tar --remote=./openFrameworks/ sha
+    # The uncompressed tar stream is deterministic (file times are taken
+    # from the commit), and so is the compressed output.
+    if not write_archive(['git', 'archive', '--format=tar',
+                          '--prefix=' + prefixname + os.sep, repo_sha],
+                         repopath, target, compressor):
+        # This doesn't work with the remote option, since git repos don't
+        # allow clients access to arbitrary sha's, only named ones.
+        # Solution: run git in the repo directory.
+        # cf. http://git.661346.n2.nabble.com/Passing-
+        # commit-IDs-to-git-archive-td7359753.html
+        LOGGER.error('An error occured archiving ' + repopath)
+        return None
+    if target != outpath:
+        # concurrent runs may race to fill the cache, they produce the
+        # same content, so the last rename simply wins
+        os.replace(target, cachepath)
+        link_or_copy(cachepath, outpath)
+    return os.path.getsize(outpath)
+
+
+###############################################################################
+def is_excluded(relpath, is_dir, excludes):
+    """Return True if relpath, relative to the packed directory and using /
+    as separator, matches one of the patterns in excludes.
+
+    Patterns ending in / only match directories. Patterns containing another
+    / are matched against the whole relative path, all others against the
+    file name."""
+
+    name = relpath.rsplit('/', 1)[-1]
+    for pattern in excludes:
+        if pattern.endswith('/'):
+            if not is_dir:
+                continue
+            pattern = pattern[:-1]
+        if fnmatch.fnmatchcase(relpath if '/' in pattern else name, pattern):
+            return True
+    return False
+
+
+###############################################################################
+def scan_dir(dirpath, excludes):
+    """Return everything below dirpath not matching excludes, as a sorted
+    list of tuples (relative path, stat result). Symlinks are not followed.
+    """
+
+    entries = []
+    pending = ['']
+    while pending:
+        reldir = pending.pop()
+        for dirent in os.scandir(os.path.join(dirpath, reldir)):
+            relpath = reldir + '/' + dirent.name if reldir else dirent.name
+            is_dir = dirent.is_dir(follow_symlinks=False)
+            if is_excluded(relpath, is_dir, excludes):
+                continue
+            entries.append((relpath, dirent.stat(follow_symlinks=False)))
+            if is_dir:
+                pending.append(relpath)
+    entries.sort()
+    return entries
+
+
+###############################################################################
+class HashingReader(object):
+    """Wrap a file object, computing the git blob hash of what is read."""
+
+    def __init__(self, fileobj, size):
+        self.fileobj = fileobj
+        self.digest = hashlib.sha1(b'blob ' + str(size).encode('ascii') +
+                                   b'\0')
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.digest.update(data)
+        return data
+
+    def hexdigest(self):
+        return self.digest.hexdigest()
+
+
+###############################################################################
+def add_dir_to_tar(tar, dirpath, arcname, entries):
+    """Add dirpath and the given entries of it (see scan_dir) to tar under
+    arcname, reading every file once.
+
+    Return a dict mapping the relative paths of files and symlinks to their
+    git blob hashes."""
+
+    tar.add(dirpath, arcname=arcname, recursive=False)
+    hashes = {}
+    for relpath, _filestat in entries:
+        fullpath = os.path.join(dirpath, relpath)
+        info = tar.gettarinfo(fullpath, arcname=arcname + '/' + relpath)
+        if info.isreg():
+            with open(fullpath, 'rb') as infile:
+                reader = HashingReader(infile, info.size)
+                tar.addfile(info, reader)
+            hashes[relpath] = reader.hexdigest()
+        elif info.issym():
+            target = info.linkname.encode('utf-8', 'surrogateescape')
+            hashes[relpath] = hashlib.sha1(
+                        b'blob ' + str(len(target)).encode('ascii') + b'\0' +
+                        target).hexdigest()
+            tar.addfile(info)
+        else:
+            tar.addfile(info)
+    return hashes
+
+
+###############################################################################
+class StatIndex(object):
+    """Content hashes of the files in a directory, stored with their size,
+    modification time and inode. As long as these match, a file is taken to
+    be unchanged and is not read again."""
+
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+        try:
+            with open(path, 'r') as index_file:
+                self.files = json.load(index_file)
+        except IOError as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+        except ValueError:
+            LOGGER.warning('Ignoring unreadable stat index ' + path)
+
+    @staticmethod
+    def signature(filestat):
+        """Return the part of a stat result identifying a file version."""
+        return [filestat.st_size, filestat.st_mtime_ns, filestat.st_ino,
+                filestat.st_mode]
+
+    def lookup(self, relpath, filestat):
+        """Return the known hash of relpath, or None if it may have
+        changed."""
+        item = self.files.get(relpath)
+        if item is None or item[:4] != self.signature(filestat):
+            return None
+        return item[4]
+
+    def save(self, entries, hashes):
+        """Replace the index with the given entries and their hashes."""
+        self.files = dict((relpath,
+                           self.signature(filestat) + [hashes[relpath]])
+                          for relpath, filestat in entries
+                          if relpath in hashes)
+        # unique per thread, as several records may share the cache
+        partpath = (self.path + '.' + str(os.getpid()) + '.' +
+                    str(threading.current_thread().ident) + '.tmp')
+        with open(partpath, 'w') as index_file:
+            json.dump(self.files, index_file, sort_keys=True)
+        os.replace(partpath, self.path)
+
+
+###############################################################################
+def stat_index_path(cache_dir, dirpath):
+    """Return the location of the stat index of dirpath in cache_dir, making
+    sure its directory exists."""
+
+    indexdir = os.path.join(cache_dir, os.path.basename(dirpath))
+    try:
+        os.makedirs(indexdir)
+    except OSError as exc:
+        if exc.errno != errno.EEXIST:  # pragma: no cover
+            raise
+    pathhash = hashlib.sha1(os.path.realpath(dirpath).encode(
+                                'utf-8', 'surrogateescape')).hexdigest()
+    return os.path.join(indexdir, 'non-git-' + pathhash[0:16] + '.index.json')
+
+
+###############################################################################
+def blob_hash(path, filestat):
+    """Return the git blob hash of the file or symlink at path."""
+    if stat.S_ISLNK(filestat.st_mode):
+        data = os.readlink(path).encode('utf-8', 'surrogateescape')
+        return hashlib.sha1(b'blob ' + str(len(data)).encode('ascii') +
+                            b'\0' + data).hexdigest()
+    with open(path, 'rb') as infile:
+        reader = HashingReader(infile, filestat.st_size)
+        while reader.read(COMPRESSION_BLOCK_SIZE):
+            pass
+    return reader.hexdigest()
+
+
+###############################################################################
+def git_tree_hash(entries, hashes):
+    """Return the hash git would give the tree object of a directory, from
+    its entries as returned by scan_dir and the blob hashes of its files.
+
+    Like in git, empty directories do not count, only the executable bit of
+    the file mode does."""
+
+    root = {}
+    for relpath, filestat in entries:
+        if stat.S_ISDIR(filestat.st_mode):
+            continue
+        if stat.S_ISLNK(filestat.st_mode):
+            mode = b'120000'
+        elif filestat.st_mode & stat.S_IXUSR:
+            mode = b'100755'
+        else:
+            mode = b'100644'
+        parts = relpath.encode('utf-8', 'surrogateescape').split(b'/')
+        node = root
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+        node[parts[-1]] = (mode, hashes[relpath])
+
+    def tree_hash(node):
+        """Return the hash of the tree object for node."""
+        items = []
+        for name, child in node.items():
+            if isinstance(child, dict):
+                # git sorts trees as if their name ended in /
+                items.append((name + b'/', b'40000', name, tree_hash(child)))
+            else:
+                items.append((name, child[0], name, child[1]))
+        body = b''.join(mode + b' ' + name + b'\0' + bytes.fromhex(sha)
+                        for _key, mode, name, sha in sorted(items))
+        return hashlib.sha1(b'tree ' + str(len(body)).encode('ascii') +
+                            b'\0' + body).hexdigest()
+
+    return tree_hash(root)
+
+
+###############################################################################
+def fingerprint_dir(dirpath, excludes, cache_dir=None, jobs=1):
+    """Return the git tree hash of the directory dirpath, leaving out files
+    matching excludes.
+
+    Files are hashed on a pool of jobs threads. If cache_dir is given, the
+    hashes are kept in a stat index there, so unchanged files are not read
+    again."""
+
+    entries = scan_dir(dirpath, excludes)
+    index = None
+    if cache_dir is not None:
+        index = StatIndex(stat_index_path(cache_dir, dirpath))
+    hashes = {}
+    missing = []
+    for relpath, filestat in entries:
+        if stat.S_ISDIR(filestat.st_mode):
+            continue
+        if index is not None:
+            hashes[relpath] = index.lookup(relpath, filestat)
+        if hashes.get(relpath) is None:
+            missing.append((relpath, filestat))
+    LOGGER.debug('Hashing ' + str(len(missing)) + ' of ' + str(len(entries)) +
+                 ' entries of ' + dirpath)
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        for (relpath, _filestat), sha in zip(missing, executor.map(
+                    lambda item: blob_hash(os.path.join(dirpath, item[0]),
+                                           item[1]),
+                    missing)):
+            hashes[relpath] = sha
+    if index is not None and missing:
+        index.save(entries, hashes)
+    return git_tree_hash(entries, hashes)
+
+
+###############################################################################
+def tar_archive_dir(archivename, archivepath, dirpath, compressor,
+                    excludes, cache_dir=None, fingerprint=None):
+    """Pack a directory not under git control into the given archive file.
+
+    Files matching excludes are left out. If cache_dir is given, a stat index
+    of the directory is kept there: if no file changed since the directory
+    was last packed, the previous archive is taken from the cache without
+    reading or compressing anything. A warning is logged if the content
+    does not match the recorded fingerprint.
+    Return the number of bytes written, 0 if the archive already existed,
+    or None if archiving failed."""
+
+    outpath = os.path.abspath(os.path.join(archivepath, archivename))
+    prefixname = os.path.basename(dirpath)
+
+    def check_fingerprint(current):
+        """Warn if the packed content differs from the recorded one."""
+        if fingerprint is not None and current != fingerprint:
+            LOGGER.warning(prefixname + ' changed since the snapshot was ' +
+                           'recorded. Archiving its current content.')
+
+    entries = scan_dir(dirpath, excludes)
+    if cache_dir is not None:
+        indexpath = stat_index_path(cache_dir, dirpath)
+        indexdir = os.path.dirname(indexpath)
+        index = StatIndex(indexpath)
+        hashes = {}
+        for relpath, filestat in entries:
+            if not stat.S_ISDIR(filestat.st_mode):
+                hashes[relpath] = index.lookup(relpath, filestat)
+        if None not in hashes.values():
+            treehash = git_tree_hash(entries, hashes)
+            cachepath = os.path.join(indexdir, 'non-git-' + treehash +
+                                     compressor.cache_suffix)
+            if os.path.exists(cachepath):
+                check_fingerprint(treehash)
+                if (os.path.exists(outpath) and
+                        os.path.samefile(cachepath, outpath)):
+                    LOGGER.info(archivename + ' already exists. Skipping ...')
+                    return 0
+                LOGGER.info(prefixname + ' is unchanged since it was last ' +
+                            'archived. Using cached archive for ' +
+                            archivename)
+                link_or_copy(cachepath, outpath)
+                return os.path.getsize(outpath)
+        partpath = (os.path.join(indexdir, str(os.getpid())) + '.' +
+                    str(threading.current_thread().ident) + '.tmp')
+    else:
+        partpath = outpath + '.part'
+
+    LOGGER.info('Archiving ' + archivename)
+    try:
+        with open(partpath, 'wb') as outfile:
+            writer = compressor.writer(outfile)
+            tar = tarfile.open(fileobj=writer, mode='w|',
+                               format=tarfile.PAX_FORMAT)
+            hashes = add_dir_to_tar(tar, dirpath, prefixname, entries)
+            tar.close()
+            writer.close()
+    except (IOError, OSError, tarfile.TarError) as exc:
+        LOGGER.error('An error occured archiving ' + dirpath + ': ' +
+                     str(exc))
+        os.remove(partpath)
+        return None
+    treehash = git_tree_hash(entries, hashes)
+    check_fingerprint(treehash)
+    if cache_dir is None:
+        os.replace(partpath, outpath)
+    else:
+        cachepath = os.path.join(indexdir, 'non-git-' + treehash +
+                                 compressor.cache_suffix)
+        os.replace(partpath, cachepath)
+        index.save(entries, hashes)
+        if os.path.exists(outpath):
+            os.remove(outpath)
+        link_or_copy(cachepath, outpath)
+    return os.path.getsize(outpath)
+
+
+###############################################################################
+def archive_component(component, compressor, cache_dir=None, manifest=None,
+                      resume=False, excludes=()):
+    """Archive one component of a snapshot. Runs in worker threads of archive.
+
+    component is a tuple as returned by snapshot_components.
+    Finished archives are added to manifest, if given. With resume, archives
+    verified against the manifest are skipped. excludes applies to
+    components not under git control.
+    Return the number of bytes written, or None if archiving failed."""
+
+    label, archivename, archivepath, repopath, sha, fingerprint = component
+    archivefile = os.path.join(archivepath, archivename)
+    if resume and check_resumable(archivefile, manifest):
+        return 0
+    if sha != 'non-git':
+        written = git_archive_repo(archivename, archivepath, repopath, sha,
+                                   compressor, cache_dir)
+    else:
+        LOGGER.info(label + ' is not a git repo. Packing as tar file.')
+        written = tar_archive_dir(archivename, archivepath, repopath,
+                                  compressor, excludes, cache_dir,
+                                  fingerprint)
+    if written:
+        LOGGER.info('Finished archiving ' + label + ' (' + str(written) +
+                    ' bytes)')
+    # archives already present were not touched, only hash them once
+    if (manifest is not None and
+            (written or (written == 0 and archivefile not in manifest))):
+        manifest.record(archivefile)
+    return written
+
+
+###############################################################################
+def changed_files(repopath, base_sha, sha):
+    """Return the files changed in the git repo at repopath between two
+    commits, as a tuple (set of added or modified files, list of deleted
+    files), or None if the commits could not be compared."""
+
+    try:
+        out = traced_check_output(['git', 'diff', '--name-status', '-z',
+                                   '--no-renames', base_sha, sha],
+                                  cwd=repopath)
+    except subprocess.CalledProcessError:
+        return None
+    fields = out.decode('utf-8', 'surrogateescape').split('\0')
+    changed = set()
+    deleted = []
+    for status, path in zip(fields[0::2], fields[1::2]):
+        if status == 'D':
+            deleted.append(path)
+        else:
+            changed.add(path)
+    return (changed, sorted(deleted))
+
+
+###############################################################################
+def delta_archive_repo(archivename, archivepath, repopath, repo_sha,
+                       base_sha, compressor):
+    """Archive the files of a git repo which changed since base_sha.
+
+    Return a tuple (bytes written, list of deleted files), or None if
+    archiving failed. Zero bytes are written if the archive already
+    existed."""
+
+    delta = changed_files(repopath, base_sha, repo_sha)
+    if delta is None:
+        LOGGER.error('Could not compare ' + base_sha + ' to ' + repo_sha +
+                     ' in ' + repopath)
+        return None
+    changed, deleted = delta
+    outpath = os.path.abspath(os.path.join(archivepath, archivename))
+    if os.path.exists(outpath):
+        LOGGER.info(archivename + ' already exists. Skipping ...')
+        return (0, deleted)
+    LOGGER.info('Archiving ' + str(len(changed)) + ' changed files in ' +
+                archivename)
+    prefix = os.path.basename(repopath) + '/'
+    process = TracedPopen(['git', 'archive', '--format=tar',
+                           '--prefix=' + prefix, repo_sha],
+                          stdout=subprocess.PIPE, cwd=repopath)
+    failed = False
+    partpath = outpath + '.part'
+    try:
+        with open(partpath, 'wb') as outfile:
+            writer = compressor.writer(outfile)
+            outer = tarfile.open(fileobj=writer, mode='w|',
+                                 format=tarfile.PAX_FORMAT)
+            inner = tarfile.open(fileobj=process.stdout, mode='r|')
+            for member in inner:
+                if member.name[len(prefix):] in changed:
+                    member.pax_headers = {}
+                    outer.addfile(member, inner.extractfile(member))
+            outer.close()
+            writer.close()
+    except tarfile.TarError:
+        failed = True
+    finally:
+        process.stdout.close()
+        ret = process.wait()
+    if failed or ret != 0:
+        LOGGER.error('An error occured archiving ' + repopath)
+        os.remove(partpath)
+        return None
+    os.replace(partpath, outpath)
+    return (os.path.getsize(outpath), deleted)
+
+
+###############################################################################
+def delta_archive_component(component, base_sha, base_fingerprint, compressor,
+                            cache_dir=None, manifest=None, resume=False,
+                            excludes=()):
+    """Archive one component of a snapshot relative to a base snapshot.
+    Runs in worker threads of archive.
+
+    Components unchanged since the base (by commit, or by fingerprint for
+    non-git components) are skipped. Other non-git components and components
+    missing from the base are archived in full.
+    Return a tuple (bytes written, manifest entry), or None if archiving
+    failed."""
+
+    label, archivename, archivepath, repopath, sha, fingerprint = component
+    item = {'label': label, 'prefix': os.path.basename(repopath),
+            'sha': sha, 'base_sha': base_sha, 'archive': None, 'deleted': []}
+    if ((sha != 'non-git' and sha == base_sha) or
+            (sha == 'non-git' and fingerprint is not None and
+             fingerprint == base_fingerprint)):
+        LOGGER.info(label + ' is unchanged since the base snapshot')
+        item['mode'] = 'unchanged'
+        return (0, item)
+    if sha == 'non-git' or base_sha in (None, 'non-git'):
+        written = archive_component(component, compressor, cache_dir,
+                                    manifest, resume, excludes)
+        item['mode'] = 'full'
+        item['archive'] = archivename
+        return None if written is None else (written, item)
+
+    suffix = compressor.suffix
+    archivename = (archivename[:-len(suffix)] + '_from_' + base_sha[0:7] +
+                   suffix)
+    archivefile = os.path.join(archivepath, archivename)
+    if resume and check_resumable(archivefile, manifest):
+        delta = changed_files(repopath, base_sha, sha)
+        if delta is None:
+            return None
+        item['mode'] = 'delta'
+        item['archive'] = archivename
+        item['deleted'] = delta[1]
+        return (0, item)
+    result = delta_archive_repo(archivename, archivepath, repopath, sha,
+                                base_sha, compressor)
+    if result is None:
+        return None
+    if manifest is not None and (result[0] or archivefile not in manifest):
+        manifest.record(archivefile)
+    item['mode'] = 'delta'
+    item['archive'] = archivename
+    item['deleted'] = result[1]
+    if result[0]:
+        LOGGER.info('Finished archiving ' + label + ' (' + str(result[0]) +
+                    ' bytes)')
+    return (result[0], item)
+
+
+###############################################################################
+def snapshot_components(entry, projectpath, archivepath, suffix):
+    """Return the components of a snapshot, as archived by archive.
+
+    Each component is a tuple (label, archivename, archivepath, repopath,
+    sha, fingerprint), fingerprint being the content hash recorded for
+    addons not under git control, or None."""
+
+    basename = str(os.path.basename(projectpath))
+    components = [('OF',
+                   basename + '_' + entry['name'] +
+                   '_OF_' + entry['core']['sha'][0:7] + suffix,
+                   archivepath,
+                   os.path.abspath(os.path.join(projectpath,
+                                                entry['core']['path'])),
+                   entry['core']['sha'],
+                   None)]
+    for addon in entry['addons']:
+        components.append((addon['name'],
+                           basename + '_' + entry['name'] + '_' +
+                           os.path.basename(addon['name']) + '_' +
+                           addon['sha'][0:7] + suffix,
+                           archivepath,
+                           os.path.abspath(os.path.join(
+                                                projectpath,
+                                                entry['core']['path'],
+                                                'addons',
+                                                addon['name'])),
+                           addon['sha'],
+                           addon.get('fingerprint')))
+    return components
+
+
+###############################################################################
+def delta_manifest_name(projectpath, snapshot_name):
+    """Return the name of the manifest file of a delta archive."""
+    return (os.path.basename(projectpath) + '_' + snapshot_name +
+            '_delta.json')
+
+
+###############################################################################
+def extract_archive(archivefile, targetpath):
+    """Unpack a (possibly compressed) tar archive into targetpath."""
+    if archivefile.endswith(COMPRESSION_SUFFIXES['zst']):
+        if zstandard is None:
+            raise IOError('Unpacking ' + archivefile + ' needs the ' +
+                          'zstandard module.')
+        with open(archivefile, 'rb') as compressed:
+            reader = zstandard.ZstdDecompressor().stream_reader(
+                        compressed, read_across_frames=True)
+            with tarfile.open(fileobj=reader, mode='r|') as tar:
+                tar.extractall(targetpath, **TAR_EXTRACT_OPTIONS)
+    else:
+        with tarfile.open(archivefile, mode='r:*') as tar:
+            tar.extractall(targetpath, **TAR_EXTRACT_OPTIONS)
+
+
+###############################################################################
+def add_bytes_to_tar(tar, name, data):
+    """Add a regular file called name with content data to tar."""
+    tarinfo = tarfile.TarInfo(name)
+    tarinfo.size = len(data)
+    tarinfo.mtime = time.time()
+    tarinfo.mode = 0o644
+    tar.addfile(tarinfo, io.BytesIO(data))
+
+
+###############################################################################
+def stream_snapshot(entry, snapshots, projectpath, outfile, compressor,
+                    excludes=()):
+    """Write a snapshot as one tar stream to the binary file object outfile.
+
+    The stream holds the metadata and description files in the project
+    directory, and every component at its location relative to the project,
+    so that unpacking it recreates the folder structure. The output of git
+    archive is copied over member by member, nothing is staged on disk.
+    excludes applies to components not under git control.
+    Return True on success."""
+
+    projectpath = os.path.realpath(projectpath)
+    corepath = os.path.realpath(os.path.join(projectpath,
+                                             entry['core']['path']))
+    components = [('OF', corepath, entry['core']['sha'])]
+    for addon in entry['addons']:
+        components.append((addon['name'],
+                           os.path.realpath(os.path.join(corepath, 'addons',
+                                                         addon['name'])),
+                           addon['sha']))
+    # Store everything relative to the closest directory containing the
+    # project and all components
+    paths = [projectpath] + [path for _label, path, _sha in components]
+    root = os.path.commonpath(paths)
+    if root in paths:
+        root = os.path.dirname(root)
+
+    def tar_name(path):
+        """Return the name of path inside the stream."""
+        return os.path.relpath(path, root).replace(os.sep, '/')
+
+    writer = compressor.writer(outfile)
+    outer = tarfile.open(fileobj=writer, mode='w|', format=tarfile.PAX_FORMAT)
+    try:
+        projectname = tar_name(projectpath)
+        add_bytes_to_tar(outer, projectname + '/' + JSON_METADATA,
+                         json.dumps(snapshots.to_json_object(), indent=1,
+                                    sort_keys=True).encode('utf-8'))
+        if entry['description'] != '':
+            add_bytes_to_tar(outer, projectname + '/' +
+                             os.path.basename(projectpath) + '_' +
+                             entry['name'] + '_description.txt',
+                             entry['description'].encode('utf-8'))
+        for label, path, sha in components:
+            LOGGER.info('Streaming ' + label + ' to ' + tar_name(path))
+            if sha == 'non-git':
+                add_dir_to_tar(outer, path, tar_name(path),
+                               scan_dir(path, excludes))
+                continue
+            process = TracedPopen(['git', 'archive', '--format=tar',
+                                   '--prefix=' + tar_name(path) + '/',
+                                   sha],
+                                  stdout=subprocess.PIPE, cwd=path)
+            failed = False
+            try:
+                inner = tarfile.open(fileobj=process.stdout, mode='r|')
+                for member in inner:
+                    # drop git's global header (the commit ID) which would
+                    # otherwise be repeated for every member. Headers needed
+                    # for long names are regenerated when writing.
+                    member.pax_headers = {}
+                    outer.addfile(member, inner.extractfile(member))
+            except tarfile.TarError:
+                failed = True
+            finally:
+                process.stdout.close()
+                ret = process.wait()
+            if failed or ret != 0:
+                LOGGER.error('An error occured archiving ' + path)
+                return False
+    finally:
+        outer.close()
+        writer.close()
+    return True
+
+
+###############################################################################
+class SnapshotCollection(object):
+    """The snapshots stored in a metadata file, indexed by name.
+
+    Lookup, replacement and deletion by name are O(1). Iterating yields the
+    snapshots in file order, with replaced snapshots moved to the end, as
+    they always have been. by_date() gives a date-ordered view."""
+
+    supports_journal = True
+
+    def __init__(self, json_object=None):
+        if json_object is None:
+            json_object = {'snapshots': []}
+        # keep any other top-level keys untouched
+        self._extra = dict((key, value) for key, value in json_object.items()
+                           if key != 'snapshots')
+        self._entries = OrderedDict()
+        self._by_date = None
+        for entry in json_object['snapshots']:
+            if entry['name'] in self._entries:
+                LOGGER.warning('Ignoring duplicate snapshot entry ' +
+                               entry['name'])
+                continue
+            self._entries[entry['name']] = entry
+
+    @classmethod
+    def create(cls, filename):
+        """Create an empty metadata file, return an empty collection."""
+        open(filename, 'w').close()
+        return cls()
+
+    @classmethod
+    def load(cls, filename):
+        """Load the snapshots from a metadata file, replaying its journal.
+
+        Raise IOError if the file cannot be opened."""
+        with open(filename, 'r') as metafile:
+            json_object = json.load(metafile)
+        LOGGER.debug(json_object)
+        snapshots = cls(json_object)
+        snapshots.replay_journal(journal_name(filename))
+        return snapshots
+
+    def replay_journal(self, journalname):
+        """Apply the changes recorded in journalname, if it exists."""
+        try:
+            with open(journalname, 'r') as journal:
+                lines = journal.readlines()
+        except IOError as exc:
+            if exc.errno == errno.ENOENT:
+                return
+            raise  # pragma: no cover
+        LOGGER.debug('Replaying ' + str(len(lines)) + ' journal entries')
+        for number, line in enumerate(lines):
+            try:
+                change = json.loads(line)
+            except ValueError:
+                # an interrupted append can only leave a partial last line
+                LOGGER.warning('Ignoring corrupt entry in line ' +
+                               str(number + 1) + ' of ' + journalname)
+                continue
+            if change['op'] == 'put':
+                self.put(change['entry'])
+            elif change['op'] == 'remove':
+                self._entries.pop(change['name'], None)
+                self._by_date = None
+
+    @staticmethod
+    @contextmanager
+    def lock(filename):
+        """Context manager holding an exclusive lock on the metadata file
+        filename and its journal, against other processes and threads.
+
+        Hold it around append, and around load and dump when changing the
+        file, so that no entry appended in between is lost when dump
+        removes the journal."""
+        if fcntl is None:  # pragma: no cover
+            yield
+            return
+        with open(filename + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_exc_info):
+        self.close()
+
+    def close(self):
+        """Do nothing, the metadata file is not kept open."""
+
+    def dump(self, filename):
+        """Write the snapshots to a metadata file, folding in its journal."""
+        tempname = (filename + '.' + str(os.getpid()) + '.' +
+                    str(threading.current_thread().ident) + '.tmp')
+        with open(tempname, 'w') as metafile:
+            json.dump(self.to_json_object(), metafile, indent=1,
+                      sort_keys=True)
+        os.replace(tempname, filename)
+        try:
+            os.remove(journal_name(filename))
+        except OSError as exc:
+            if exc.errno != errno.ENOENT:  # pragma: no cover
+                raise
+
+    @staticmethod
+    def append(filename, entry):
+        """Record entry in the journal of a metadata file.
+
+        The metadata file itself is not read, so this is independent of the
+        number of stored snapshots.
+        Return the new size of the journal in bytes."""
+        journalname = journal_name(filename)
+        line = json.dumps({'op': 'put', 'entry': entry}, sort_keys=True)
+        with open(journalname, 'ab+') as journal:
+            if journal.seek(0, os.SEEK_END) > 0:
+                journal.seek(-1, os.SEEK_END)
+                if journal.read(1) != b'\n':
+                    # an interrupted append left a partial last line, end
+                    # it so it is skipped on replay instead of this entry
+                    LOGGER.warning('Found incomplete last line in ' +
+                                   journalname)
+                    line = '\n' + line
+            journal.write((line + '\n').encode('utf-8'))
+        return os.path.getsize(journalname)
+
+    def to_json_object(self):
+        """Return the snapshots in the metadata.json schema."""
+        json_object = dict(self._extra)
+        json_object['snapshots'] = list(self._entries.values())
+        return json_object
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(list(self._entries.values()))
+
+    def __contains__(self, name):
+        return name in self._entries
+
+    def get(self, name):
+        """Return the snapshot entry called name, or None."""
+        return self._entries.get(name)
+
+    def put(self, entry):
+        """Add entry, replacing any snapshot with the same name."""
+        self._entries.pop(entry['name'], None)
+        self._entries[entry['name']] = entry
+        self._by_date = None
+
+    def remove(self, name):
+        """Remove the snapshot entry called name, return it."""
+        self._by_date = None
+        return self._entries.pop(name)
+
+    def by_date(self):
+        """Return a list of all snapshot entries, oldest first."""
+        if self._by_date is None:
+            self._by_date = sorted(self._entries.values(),
+                                   key=lambda entry: entry['date'])
+        return list(self._by_date)
+
+    def names_with_sha(self, sha):
+        """Return the names of all snapshots pinning a component to sha."""
+        return [entry['name'] for entry in self._entries.values()
+                if entry['core']['sha'] == sha or
+                any(addon['sha'] == sha or addon.get('fingerprint') == sha
+                    for addon in entry['addons'])]
+
+
+###############################################################################
+class SqliteSnapshotCollection(object):
+    """The snapshots stored in an SQLite metadata database.
+
+    Offers the same interface as SnapshotCollection, but queries the
+    database instead of loading all snapshots, using indexes on snapshot
+    name, date and component SHAs. Use as a context manager, or call close(),
+    to close the database."""
+
+    supports_journal = False
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS snapshots (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE,
+            date TEXT NOT NULL,
+            description TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS snapshots_date ON snapshots (date);
+        CREATE TABLE IF NOT EXISTS core_pins (
+            snapshot_id INTEGER PRIMARY KEY
+                REFERENCES snapshots (id) ON DELETE CASCADE,
+            path TEXT NOT NULL,
+            sha TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS core_pins_sha ON core_pins (sha);
+        CREATE TABLE IF NOT EXISTS addon_pins (
+            snapshot_id INTEGER NOT NULL
+                REFERENCES snapshots (id) ON DELETE CASCADE,
+            position INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            sha TEXT NOT NULL,
+            fingerprint TEXT,
+            PRIMARY KEY (snapshot_id, position));
+        CREATE INDEX IF NOT EXISTS addon_pins_sha ON addon_pins (sha);
+        """
+
+    def __init__(self, filename):
+        self._connection = sqlite3.connect(filename)
+        self._connection.execute('PRAGMA foreign_keys = ON')
+        self._connection.executescript(self.SCHEMA)
+        # databases written before content fingerprints were recorded
+        columns = [row[1] for row in self._connection.execute(
+                        'PRAGMA table_info(addon_pins)')]
+        if 'fingerprint' not in columns:
+            self._connection.execute('ALTER TABLE addon_pins ' +
+                                     'ADD COLUMN fingerprint TEXT')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS ' +
+                                 'addon_pins_fingerprint ON addon_pins ' +
+                                 '(fingerprint)')
+
+    @classmethod
+    def create(cls, filename):
+        """Create an empty metadata database, return it."""
+        return cls(filename)
+
+    @staticmethod
+    @contextmanager
+    def lock(_filename):
+        """Do nothing, SQLite does its own locking."""
+        yield
+
+    @classmethod
+    def load(cls, filename):
+        """Open a metadata database.
+
+        Raise IOError if the file does not exist."""
+        if not os.path.isfile(filename):
+            raise IOError(errno.ENOENT, 'No such file or directory',
+                          filename)
+        return cls(filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_exc_info):
+        self.close()
+
+    def close(self):
+        """Close the database, discarding changes not committed by dump."""
+        self._connection.close()
+
+    def dump(self, _filename):
+        """Commit all changes to the database."""
+        self._connection.commit()
+
+    def to_json_object(self):
+        """Return the snapshots in the metadata.json schema."""
+        return {'snapshots': list(self)}
+
+    def _entries(self, where='', parameters=(), order='snapshots.id'):
+        """Return a list of snapshot entries matching a WHERE clause."""
+        rows = self._connection.execute(
+                    'SELECT snapshots.id, name, date, description, path, sha '
+                    'FROM snapshots JOIN core_pins '
+                    'ON snapshots.id = core_pins.snapshot_id ' + where +
+                    ' ORDER BY ' + order, parameters).fetchall()
+        entries = []
+        for row in rows:
+            addons = self._connection.execute(
+                        'SELECT name, sha, fingerprint FROM addon_pins '
+                        'WHERE snapshot_id = ? ORDER BY position',
+                        (row[0],)).fetchall()
+            entries.append({'name': row[1],
+                            'date': row[2],
+                            'description': row[3],
+                            'core': {'path': row[4], 'sha': row[5]},
+                            'addons': [self._addon(*addon)
+                                       for addon in addons]})
+        return entries
+
+    @staticmethod
+    def _addon(name, sha, fingerprint):
+        """Return the entry of an addon pin."""
+        addon = {'name': name, 'sha': sha}
+        if fingerprint is not None:
+            addon['fingerprint'] = fingerprint
+        return addon
+
+    def __len__(self):
+        return self._connection.execute(
+                    'SELECT COUNT(*) FROM snapshots').fetchone()[0]
+
+    def __iter__(self):
+        return iter(self._entries())
+
+    def __contains__(self, name):
+        return self._connection.execute(
+                    'SELECT 1 FROM snapshots WHERE name = ?',
+                    (name,)).fetchone() is not None
+
+    def get(self, name):
+        """Return the snapshot entry called name, or None."""
+        entries = self._entries('WHERE name = ?', (name,))
+        return entries[0] if entries else None
+
+    def put(self, entry):
+        """Add entry, replacing any snapshot with the same name."""
+        self._connection.execute('DELETE FROM snapshots WHERE name = ?',
+                                 (entry['name'],))
+        snapshot_id = self._connection.execute(
+                        'INSERT INTO snapshots (name, date, description) '
+                        'VALUES (?, ?, ?)',
+                        (entry['name'], entry['date'],
+                         entry['description'])).lastrowid
+        self._connection.execute(
+                'INSERT INTO core_pins (snapshot_id, path, sha) '
+                'VALUES (?, ?, ?)',
+                (snapshot_id, entry['core']['path'], entry['core']['sha']))
+        self._connection.executemany(
+                'INSERT INTO addon_pins '
+                '(snapshot_id, position, name, sha, fingerprint) '
+                'VALUES (?, ?, ?, ?, ?)',
+                [(snapshot_id, position, addon['name'], addon['sha'],
+                  addon.get('fingerprint'))
+                 for position, addon in enumerate(entry['addons'])])
+
+    def remove(self, name):
+        """Remove the snapshot entry called name, return it."""
+        entry = self.get(name)
+        if entry is None:
+            raise KeyError(name)
+        self._connection.execute('DELETE FROM snapshots WHERE name = ?',
+                                 (name,))
+        return entry
+
+    def by_date(self):
+        """Return a list of all snapshot entries, oldest first."""
+        return self._entries(order='date')
+
+    def names_with_sha(self, sha):
+        """Return the names of all snapshots pinning a component to sha."""
+        return [row[0] for row in self._connection.execute(
+                    'SELECT name FROM snapshots WHERE id IN ('
+                    'SELECT snapshot_id FROM core_pins WHERE sha = ? UNION '
+                    'SELECT snapshot_id FROM addon_pins WHERE sha = ? UNION '
+                    'SELECT snapshot_id FROM addon_pins '
+                    'WHERE fingerprint = ?) '
+                    'ORDER BY id', (sha, sha, sha))]
+
+
+###############################################################################
+def journal_name(filename):
+    """Return the name of the journal belonging to a metadata file."""
+    return filename + '.journal'
+
+
+###############################################################################
+def check_for_snapshot_entry(name, snapshots):
+    """Return snapshot entry if it already exists."""
+    entry = snapshots.get(name)
+    if entry is None:
+        return {}
+    LOGGER.info('Selecting snapshot ' + name)
+    return entry
+
+
+###############################################################################
+def open_snapshots(projectpath, store=None, filename=JSON_METADATA):
+    """Load the snapshots of the project at projectpath from the metadata
+    file filename, using the collection class store. Close the collection
+    when done, e.g. by using it as a context manager.
+
+    Raise StateManagerError if the file cannot be opened."""
+
+    if store is None:
+        store = SnapshotCollection
+    try:
+        with PROFILER.span('load metadata'):
+            snapshots = store.load(os.path.join(projectpath, filename))
+    except IOError as exc:
+        raise StateManagerError('Could not open file: ' + str(exc))
+    LOGGER.info('Loaded json data from ' + filename)
+    return snapshots
+
+
+###############################################################################
+def cache_dir_from_args(args):
+    """Return the cache directory selected in args, or None."""
+    return None if args.no_cache else args.cache_dir
+
+
+###############################################################################
+def excludes_from_args(args):
+    """Return the exclude patterns selected in args."""
+    return (([] if args.no_default_excludes else DEFAULT_EXCLUDES) +
+            args.exclude)
+
+
+###############################################################################
+class RepoMemo(object):
+    """Results of validating and resolving repositories, shared by all
+    projects of one workspace run.
+
+    Paths are canonicalized with realpath, so each repository is probed
+    only once, however the projects refer to it. Safe to use from several
+    threads: concurrent requests for the same path wait for the first one.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._results = {}
+        self.hits = 0
+
+    def __len__(self):
+        return len(self._results)
+
+    def _get(self, kind, path, func):
+        """Return func(path), computing it once per kind and real path."""
+        key = (kind, os.path.realpath(path))
+        with self._lock:
+            future = self._results.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._results[key] = future
+            else:
+                self.hits += 1
+        if owner:
+            try:
+                future.set_result(func(path))
+            except BaseException as exc:  # pylint: disable=W0703
+                future.set_exception(exc)
+        else:
+            LOGGER.debug('Reusing ' + kind + ' result for ' + key[1])
+        return future.result()
+
+    def core(self, corepath):
+        """Validate the OF repo at corepath. Return its HEAD SHA, or None if
+        it could not be validated."""
+        def resolve(path):
+            if validate_git_repo(path=path) != 0:
+                return None
+            return get_head_sha(path)
+        return self._get('core', corepath, resolve)
+
+    def official_addons(self, addons_path):
+        """Return the official addons listed in addons/.gitignore."""
+        def read(path):
+            official_addons = []
+            with open(os.path.join(path, '.gitignore'),
+                      'r') as gitignore_file:
+                for line in gitignore_file:
+                    if line.startswith('!ofx'):
+                        official_addons.append(line[1:].strip())
+            return official_addons
+        return self._get('gitignore', addons_path, read)
+
+    def addon(self, path):
+        """Return probe_addon(path)."""
+        return self._get('addon', path, probe_addon)
+
+    def fingerprint(self, path, excludes, cache_dir=None, jobs=1):
+        """Return fingerprint_dir(path, excludes, cache_dir, jobs)."""
+        return self._get('fingerprint ' + ' '.join(excludes), path,
+                         lambda dirpath: fingerprint_dir(dirpath, excludes,
+                                                         cache_dir, jobs))
+
+
+###############################################################################
+def read_project_files(projectpath):
+    """Return the OF location given in config.make of the project at
+    projectpath, and the list of addons in its addons.make.
+
+    Raise StateManagerError if config.make does not give the OF location."""
+
+    # parse addons.make into a list of addons
+    addons_list = []
+    try:
+        with open(os.path.join(projectpath, 'addons.make'),
+                  'r') as addons_make:
+            for line in addons_make.readlines():
+                addons_list.append(line.rstrip())
+    except IOError as exc:
+        if exc.errno == errno.ENOENT:
+            LOGGER.debug('No addons.make file found.')
+        else:  # pragma: no cover
+            raise
+    if len(addons_list) == 0:
+        LOGGER.info('No addons found.')
+
+    # search config.make for OF location
+    with open(os.path.join(projectpath, 'config.make'), 'r') as config_make:
+        of_path = ''
+        for line in config_make.readlines():
+            if 'OF_ROOT =' in line:
+                of_path = line.split('=', 1)[-1].strip()
+                break
+        if len(of_path) == 0:
+            raise StateManagerError('Did not find OF location in ' +
+                                    'config.make in ' + projectpath)
+    return (of_path, addons_list)
+
+
+###############################################################################
+def record_snapshot(projectpath, name='latest', description='', update=False,
+                    store=None, filename=JSON_METADATA, journal=False, jobs=1,
+                    excludes=None, cache_dir=None, memo=None):
+    """Record a snapshot of the project at projectpath in its metadata file.
+
+    OF and addon paths are read from config.make and addons.make of the
+    project, nothing depends on the current directory. Addons not under git
+    control are fingerprinted, leaving out excludes (DEFAULT_EXCLUDES if
+    None), with file hashes kept in cache_dir if given. Pass the same
+    RepoMemo as memo to share repository results between projects.
+    Return the recorded snapshot entry. Raise StateManagerError on failure.
+    """
+
+    projectpath = os.path.abspath(projectpath)
+    if excludes is None:
+        excludes = DEFAULT_EXCLUDES
+    if memo is None:
+        memo = RepoMemo()
+
+    of_path, addons_list = read_project_files(projectpath)
+
+    LOGGER.info('Processing OF at ' + of_path)
+    corepath = os.path.normpath(os.path.join(projectpath, of_path))
+    core_dict = {'path': of_path}
+    LOGGER.debug('Recording commit SHA')
+    with PROFILER.span('validate OF'):
+        core_dict['sha'] = memo.core(corepath)
+    if core_dict['sha'] is None:
+        raise StateManagerError('OF git repo could not be validated ' +
+                                'successfully.')
+    LOGGER.debug('OF commit SHA: ' + core_dict['sha'])
+
+    LOGGER.info('Processing addons')
+    addons_path = os.path.join(corepath, 'addons')
+    # get list of official addons
+    official_addons = memo.official_addons(addons_path)
+    # prune official addons (which are in the OF repo already)
+    # not very efficient (better with sets),
+    # but irrelevant for the small lists we expect
+    addons_list = [{'name': x}
+                   for x
+                   in addons_list
+                   if x
+                   not in official_addons]
+
+    # Validate and resolve all addons concurrently, then evaluate the results
+    # in addons.make order, so that the first failing addon aborts as before
+    LOGGER.debug('Probing ' + str(len(addons_list)) + ' addons using ' +
+                 str(jobs) + ' jobs')
+    def probe(addon):
+        """Validate and resolve addon, in a worker thread."""
+        with PROFILER.span('addon ' + addon['name']):
+            return memo.addon(os.path.join(addons_path, addon['name']))
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        results = list(executor.map(probe, addons_list))
+
+    for addon, (state, sha) in zip(addons_list, results):
+        LOGGER.info('Processing addon ' + addon['name'])
+        if state is None:
+            raise StateManagerError(addon['name'] + ' does not exist at ' +
+                                    addons_path + '.')
+
+        ret = report_repo_state(state, os.path.join(addons_path,
+                                                    addon['name']),
+                                strict=False)
+        if ret == 0:
+            addon['sha'] = sha
+        elif ret == 2:
+            addon['sha'] = 'non-git'
+            LOGGER.info('Fingerprinting content of ' + addon['name'])
+            with PROFILER.span('fingerprint ' + addon['name']):
+                addon['fingerprint'] = memo.fingerprint(
+                                    os.path.join(addons_path, addon['name']),
+                                    excludes, cache_dir, jobs)
+            LOGGER.debug(addon['name'] + ' fingerprint: ' +
+                         addon['fingerprint'])
+        else:
+            raise StateManagerError(addon['name'] + ' git repo could not ' +
+                                    'be validated successfully.')
+
+    temp = {'name': name,
+            'date': datetime.now().isoformat(),
+            'description': description,
+            'core': core_dict,
+            'addons': addons_list}
+    store_snapshot(projectpath, temp, update, store, filename, journal)
+    return temp
+
+
+###############################################################################
+def store_snapshot(projectpath, temp, update=False, store=None,
+                   filename=JSON_METADATA, journal=False):
+    """Store the snapshot entry temp in the metadata file of the project at
+    projectpath. Raise StateManagerError if an entry of the same name exists
+    and update is not set, unless the name is 'latest'."""
+
+    if store is None:
+        store = SnapshotCollection
+    name = temp['name']
+    metadatapath = os.path.join(projectpath, filename)
+    LOGGER.info('Storing metadata')
+
+    with store.lock(metadatapath):
+        # In journal mode, overwriting does not need to look at the existing
+        # snapshots at all, so just append to the journal
+        journal = journal and store.supports_journal
+        if (journal and (update or name == 'latest') and
+                os.path.exists(metadatapath)):
+            LOGGER.info('Appending entry ' + name + ' to journal of ' +
+                        filename)
+            with PROFILER.span('write metadata'):
+                if (SnapshotCollection.append(metadatapath, temp) >
+                        JOURNAL_MAX_SIZE):
+                    LOGGER.info('Journal is getting large, compacting ' +
+                                filename)
+                    SnapshotCollection.load(metadatapath).dump(metadatapath)
+            return
+
+        # Open/initialise metadata file
+        try:
+            with PROFILER.span('load metadata'):
+                snapshots = store.load(metadatapath)
+            LOGGER.info('loaded data from ' + filename)
+        except IOError as exc:
+            if exc.errno == errno.ENOENT:
+                LOGGER.info(filename + ' does not exist yet. Creating..')
+                # create new skeleton collection
+                snapshots = store.create(metadatapath)
+            else:  # pragma: no cover
+                raise
+
+        with snapshots:
+            # Store/update metadata
+            # check if snapshot entry already exists
+            if name in snapshots:
+                if (update is False) and (name != 'latest'):
+                    raise StateManagerError(name + ': entry with the same ' +
+                                            'name already exists. Use -u ' +
+                                            'option to overwrite.')
+
+            # write updated entry
+            with PROFILER.span('write metadata'):
+                if journal and len(snapshots):
+                    LOGGER.info('Appending entry ' + name + ' to journal ' +
+                                'of ' + filename)
+                    SnapshotCollection.append(metadatapath, temp)
+                else:
+                    snapshots.put(temp)
+                    LOGGER.info('Writing updated data to ' + filename)
+                    snapshots.dump(metadatapath)
+
+
+###############################################################################
+def repin_snapshot(entry, repos, name, description=''):
+    """Return a copy of the snapshot entry, renamed to name, with the git
+    repositories in repos, a list of tuples (label, path) as returned by
+    watched_repos, validated and pinned to their current HEAD again. All
+    other repositories and fingerprints are copied unchanged.
+
+    Raise StateManagerError if a repository can not be validated."""
+
+    pins = dict((addon['name'], dict(addon)) for addon in entry['addons'])
+    pins['OF'] = dict(entry['core'])
+    for label, path in repos:
+        with PROFILER.span('validate OF' if label == 'OF' else
+                           'addon ' + label):
+            state = probe_git_repo(path)
+            sha = get_head_sha(path) if state == 'clean' else None
+        if label not in pins or report_repo_state(state, path) != 0:
+            raise StateManagerError(label + ' git repo could not be ' +
+                                    'validated successfully.')
+        pins[label]['sha'] = sha
+    return {'name': name,
+            'date': datetime.now().isoformat(),
+            'description': description,
+            'core': pins['OF'],
+            'addons': [pins[addon['name']] for addon in entry['addons']]}
+
+
+###############################################################################
+def find_projects(workspace):
+    """Return the real paths of all projects below the directory workspace,
+    sorted. A project is a directory containing config.make, its
+    subdirectories are not searched. Hidden directories are skipped."""
+
+    projects = []
+    visited = set()
+    pending = [os.path.realpath(workspace)]
+    while pending:
+        dirpath = pending.pop()
+        if dirpath in visited:
+            continue
+        visited.add(dirpath)
+        if os.path.isfile(os.path.join(dirpath, 'config.make')):
+            projects.append(dirpath)
+            continue
+        try:
+            with os.scandir(dirpath) as entries:
+                for dir_entry in entries:
+                    if (dir_entry.is_dir() and
+                            not dir_entry.name.startswith('.')):
+                        pending.append(os.path.realpath(dir_entry.path))
+        except OSError as exc:
+            LOGGER.warning('Could not search ' + dirpath + ': ' + str(exc))
+    return sorted(projects)
+
+
+###############################################################################
+def metadata_store(projectpath, backend=None):
+    """Return the collection class and metadata file name of the project at
+    projectpath. backend is 'json' or 'sqlite', or None to use sqlite if
+    its metadata file exists, json otherwise."""
+
+    if backend is None:
+        if os.path.isfile(os.path.join(projectpath, SQLITE_METADATA)):
+            backend = 'sqlite'
+        else:
+            backend = 'json'
+    if backend == 'sqlite':
+        return (SqliteSnapshotCollection, SQLITE_METADATA)
+    return (SnapshotCollection, JSON_METADATA)
+
+
+###############################################################################
+def run_workspace(args, action):
+    """Call action(projectpath, store, filename, memo) for every project in
+    the workspace given in args, sharing one RepoMemo, so that repositories
+    used by several projects are validated and resolved only once.
+
+    Return 0 if action succeeded for all projects, 1 otherwise."""
+
+    projects = find_projects(args.workspace)
+    if not projects:
+        LOGGER.error('No projects found in ' + args.workspace)
+        return 1
+    LOGGER.info('Found ' + str(len(projects)) + ' projects in ' +
+                args.workspace)
+    memo = RepoMemo()
+    failed = []
+    for projectpath in projects:
+        LOGGER.info('Processing project ' + projectpath)
+        store, filename = metadata_store(projectpath,
+                                         args.backend if
+                                         args.backend_was_given else None)
+        try:
+            action(projectpath, store, filename, memo)
+        except StateManagerError as exc:
+            LOGGER.error(os.path.basename(projectpath) + ': ' + str(exc))
+            failed.append(projectpath)
+    LOGGER.info('Resolved ' + str(len(memo)) + ' repositories and ' +
+                'directories for ' + str(len(projects)) + ' projects, ' +
+                'reused results ' + str(memo.hits) + ' times')
+    if failed:
+        LOGGER.error(str(len(failed)) + ' of ' + str(len(projects)) +
+                     ' projects failed:')
+        for projectpath in failed:
+            LOGGER.error('  ' + projectpath)
+        return 1
+    return 0
+
+
+###############################################################################
+def record(args, filename):
+    """Record a snapshot in a json file, as specified by arguments in args.
+
+    Return 0 on success, 1 on failure."""
+
+    LOGGER.debug('In subcommand record.')
+    if args.workspace is not None:
+        return run_workspace(
+                    args,
+                    lambda projectpath, store, filename, memo:
+                    record_snapshot(projectpath, args.name, args.description,
+                                    args.update, store, filename,
+                                    args.journal, args.jobs,
+                                    excludes_from_args(args),
+                                    cache_dir_from_args(args), memo))
+    try:
+        record_snapshot(args.project, args.name, args.description,
+                        args.update, args.store, filename, args.journal,
+                        args.jobs, excludes_from_args(args),
+                        cache_dir_from_args(args))
+    except StateManagerError as exc:
+        LOGGER.error(str(exc))
+        return 1
+    return 0
+
+
+###############################################################################
+def traced_component(func, **kwargs):
+    """Return a function calling func(component, ..., **kwargs) in a
+    profiler span named after the component, for executor.map."""
+
+    def traced(component, *args):
+        """Archive component, see archive_component."""
+        with PROFILER.span('archive ' + component[0]):
+            return func(component, *args, **kwargs)
+    return traced
+
+
+###############################################################################
+def archive_snapshot(projectpath, name='latest', store=None,
+                     filename=JSON_METADATA, jobs=1, compression='gz',
+                     level=None, cache_dir=None, excludes=None, resume=False,
+                     base=None, stream=None, memo=None):
+    """Archive a snapshot of the project at projectpath, recording it first
+    if it does not exist yet (sharing memo with record_snapshot).
+
+    The archives are written to the archive folder of the project, relative
+    to the snapshot base if given, or into the single tar stream stream (a
+    file name or a binary file object). See the archive subcommand for the
+    other options.
+    Return a dictionary with the snapshot name, the archive folder (None
+    when streaming), the number of bytes written and the number of archives
+    written. Raise StateManagerError on failure."""
+
+    projectpath = os.path.abspath(projectpath)
+    if store is None:
+        store = SnapshotCollection
+    if excludes is None:
+        excludes = DEFAULT_EXCLUDES
+    if compression == 'zst' and zstandard is None:
+        raise StateManagerError('zst compression needs the zstandard ' +
+                                'module. Install it with "pip install ' +
+                                'zstandard".')
+    level = BlockCompressor.check_level(compression, level)
+
+    LOGGER.debug('Opening metadata file')
+    try:
+        with PROFILER.span('load metadata'):
+            snapshots = store.load(os.path.join(projectpath, filename))
+        LOGGER.info('loaded data from ' + filename)
+        entry = check_for_snapshot_entry(name, snapshots)
+        if not entry:
+            LOGGER.info('Entry ' + name + ' does not exist yet. Creating...')
+            snapshots.close()
+    except IOError as exc:
+        if exc.errno != errno.ENOENT:  # pragma: no cover
+            raise
+        LOGGER.info('Metadata file ' + filename +
+                    ' does not exist yet. Creating...')
+        entry = None
+    if not entry:
+        try:
+            with PROFILER.span('record snapshot'):
+                record_snapshot(projectpath, name, store=store,
+                                filename=filename, jobs=jobs,
+                                excludes=excludes, cache_dir=cache_dir,
+                                memo=memo)
+        except StateManagerError:
+            LOGGER.error('Creation of snapshot ' + name + ' failed.')
+            raise
+        snapshots = store.load(os.path.join(projectpath, filename))
+        entry = check_for_snapshot_entry(name, snapshots)
+    #--------------------------------------------------------------------------
+    with snapshots:
+        if stream is not None:
+            # write everything into one stream
+            if base is not None:
+                raise StateManagerError('--stream and --base cannot be ' +
+                                        'combined.')
+            with BlockCompressor(compression, level, jobs) as compressor:
+                if hasattr(stream, 'write'):
+                    LOGGER.info('Streaming snapshot ' + entry['name'] +
+                                ' to ' +
+                                str(getattr(stream, 'name', 'stream')))
+                    success = stream_snapshot(entry, snapshots, projectpath,
+                                              stream, compressor, excludes)
+                    stream.flush()
+                else:
+                    LOGGER.info('Streaming snapshot ' + entry['name'] +
+                                ' to ' + stream)
+                    with open(stream, 'wb') as streamfile:
+                        success = stream_snapshot(entry, snapshots,
+                                                  projectpath, streamfile,
+                                                  compressor, excludes)
+                    if not success:
+                        os.remove(stream)
+            if not success:
+                raise StateManagerError('Archiving snapshot ' + entry['name'] +
+                                        ' failed.')
+            return {'snapshot': entry['name'], 'archivepath': None,
+                    'written': None, 'archives': 1}
+
+        base_entry = None
+        if base is not None:
+            base_entry = check_for_snapshot_entry(base, snapshots)
+            if not base_entry:
+                raise StateManagerError('Base snapshot ' + base +
+                                        ' does not exist.')
+            base_shas = dict((addon['name'], addon['sha'])
+                             for addon in base_entry['addons'])
+            base_shas['OF'] = base_entry['core']['sha']
+            base_fingerprints = dict((addon['name'], addon.get('fingerprint'))
+                                     for addon in base_entry['addons'])
+
+    # create subdirectory for archive
+    basename = str(os.path.basename(projectpath))
+    archivedirectory = basename + '_archive'
+    archivepath = os.path.join(projectpath, archivedirectory)
+    try:
+        os.mkdir(archivepath)
+    except OSError as exc:
+        if exc.errno == errno.EEXIST:
+            LOGGER.debug('Directory ' + archivedirectory +
+                         ' already exists. Continuing.')
+        else:  # pragma: no cover
+            raise StateManagerError('Could not create directory: ' +
+                                    archivedirectory + ': ' + str(exc))
+
+    # archive all elements
+    # Description file
+    if entry['description'] != '':
+        LOGGER.info('Writing description file')
+        with open(os.path.join(archivepath, basename + '_' + entry['name'] +
+                               '_description.txt'), 'w') as descriptionfile:
+            descriptionfile.write(entry['description'])
+
+    # OF itself, then addons
+    components = snapshot_components(entry, projectpath, archivepath,
+                                     COMPRESSION_SUFFIXES[compression])
+
+    # Components are read from git/tar child processes in one pool of
+    # threads, their blocks are compressed in another shared one
+    LOGGER.debug('Archiving ' + str(len(components)) +
+                 ' components using ' + str(jobs) + ' jobs')
+    if cache_dir is not None:
+        LOGGER.debug('Using archive cache in ' + cache_dir)
+    checksums = ArchiveManifest(os.path.join(
+                    archivepath,
+                    basename + '_' + entry['name'] + '_checksums.json'))
+    with BlockCompressor(compression, level, jobs) as compressor:
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            if base_entry is None:
+                results = list(executor.map(
+                            traced_component(archive_component,
+                                             compressor=compressor,
+                                             cache_dir=cache_dir,
+                                             manifest=checksums,
+                                             resume=resume,
+                                             excludes=excludes),
+                            components))
+            else:
+                results = list(executor.map(
+                            traced_component(delta_archive_component,
+                                             compressor=compressor,
+                                             cache_dir=cache_dir,
+                                             manifest=checksums,
+                                             resume=resume,
+                                             excludes=excludes),
+                            components,
+                            [base_shas.get(component[0])
+                             for component in components],
+                            [base_fingerprints.get(component[0])
+                             for component in components]))
+                if None not in results:
+                    # components of the base which are gone, e.g. addons
+                    # dropped from addons.make, are deleted by restore
+                    prefixes = [item['prefix'] for _written, item in results]
+                    removed = sorted(set(
+                                os.path.basename(component[3])
+                                for component in snapshot_components(
+                                    base_entry, projectpath, archivepath,
+                                    '')) - set(prefixes))
+                    manifest = {'snapshot': entry['name'],
+                                'base': base_entry['name'],
+                                'components': [item for _written, item
+                                               in results],
+                                'removed': removed}
+                    manifestpath = os.path.join(
+                                    archivepath,
+                                    delta_manifest_name(projectpath,
+                                                        entry['name']))
+                    with open(manifestpath + '.part', 'w') as manifestfile:
+                        json.dump(manifest, manifestfile, indent=1,
+                                  sort_keys=True)
+                    os.replace(manifestpath + '.part', manifestpath)
+                    results = [written for written, _item in results]
+
+    if None in results:
+        raise StateManagerError('Archiving snapshot ' + entry['name'] +
+                                ' failed.')
+    result = {'snapshot': entry['name'], 'archivepath': archivepath,
+              'written': sum(results),
+              'archives': len([x for x in results if x])}
+    LOGGER.info('Wrote ' + str(result['written']) + ' bytes in ' +
+                str(result['archives']) + ' archives to ' + archivedirectory)
+    return result
+
+
+###############################################################################
+def archive(args, filename):
+    """Archive a snapshot from a json file, as specified by arguments in args.
+
+    Return 0 on success, 1 on failure."""
+    LOGGER.debug('In subcommand archive.')
+    if args.workspace is not None:
+        if args.stream is not None:
+            LOGGER.error('--stream and --workspace cannot be combined.')
+            return 1
+        return run_workspace(
+                    args,
+                    lambda projectpath, store, filename, memo:
+                    archive_snapshot(projectpath, args.name, store, filename,
+                                     args.jobs, args.compression, args.level,
+                                     cache_dir_from_args(args),
+                                     excludes_from_args(args), args.resume,
+                                     args.base, memo=memo))
+    if args.stream == '-':
+        stream = sys.stdout.buffer
+    elif args.stream is not None:
+        stream = os.path.abspath(args.stream)
+    else:
+        stream = None
+    try:
+        archive_snapshot(args.project, args.name, args.store, filename,
+                         args.jobs, args.compression, args.level,
+                         cache_dir_from_args(args), excludes_from_args(args),
+                         args.resume, args.base, stream)
+    except StateManagerError as exc:
+        LOGGER.error(str(exc))
+        return 1
+    return 0
+
+
+###############################################################################
+def get_branchname(target_sha, path=None):
+    """
+    Return branch name if a branch exists in path (or cwd) which points to
+    target_sha.
+    Return target_sha otherwise
+    """
+    if path is None:
+        path = os.getcwd()
+    git_dirs = find_git_dirs(path)
+    if git_dirs is not None:
+        branches = sorted(read_branches(git_dirs).items())
+    else:
+        out = traced_check_output(['git',
+                                   'for-each-ref',
+                                   '--format=%(refname) %(objectname)',
+                                   'refs/heads/'],
+                                  universal_newlines=True, cwd=path)
+        branches = sorted(tuple(line.split(' ', 1))
+                          for line in out.splitlines())
+    # If several branches point at target_sha, the last one in refname order
+    # wins, as before
+    name = target_sha
+    for refname, sha in branches:
+        if sha == target_sha:
+            name = refname[len('refs/heads/'):]
+    if name != target_sha:
+        LOGGER.debug('Found branch ' + name + ' pointing at ' + target_sha)
+    return name
+
+
+###############################################################################
+def get_repo_head(path):
+    """Return the SHA HEAD points to if path is the top level of a git work
+    tree, reading it without spawning git where possible. Return None
+    otherwise."""
+
+    if (not os.path.isdir(path) or
+            find_git_toplevel(path) != os.path.realpath(path)):
+        return None
+    try:
+        return get_head_sha(path)
+    except subprocess.CalledProcessError:
+        return None
+
+
+###############################################################################
+def get_head_ref(path):
+    """Return the branch checked out in the git repo at path, or the SHA of
+    a detached HEAD."""
+    git_dirs = find_git_dirs(path)
+    if git_dirs is not None:
+        with open(os.path.join(git_dirs[0], 'HEAD'), 'r') as head_file:
+            content = head_file.read().strip()
+        if content.startswith('ref: refs/heads/'):
+            return content[len('ref: refs/heads/'):]
+        if is_sha(content):
+            return content
+    try:
+        return traced_check_output(['git', 'symbolic-ref', '-q',
+                                    '--short', 'HEAD'],
+                                   universal_newlines=True,
+                                   cwd=path).strip()
+    except subprocess.CalledProcessError:
+        return get_head_sha(path)
+
+
+###############################################################################
+def snapshot_repos(entry, projectpath):
+    """Return the git components of a snapshot, as a list of tuples (label,
+    path, sha)."""
+
+    corepath = os.path.normpath(os.path.join(projectpath,
+                                             entry['core']['path']))
+    repos = [('OF', corepath, entry['core']['sha'])]
+    for addon in entry['addons']:
+        if addon['sha'] != 'non-git':
+            repos.append((addon['name'],
+                          os.path.normpath(os.path.join(
+                                        corepath, 'addons', addon['name'])),
+                          addon['sha']))
+    return repos
+
+
+###############################################################################
+def missing_commits(path, shas):
+    """Return the set of SHAs in shas which are not commits in the git repo
+    at path, checking all of them with a single git cat-file --batch-check.
+    Return None if the repo could not be queried."""
+
+    if not os.path.isdir(path):
+        return None
+    shas = list(shas)
+    process = TracedPopen(['git', 'cat-file', '--batch-check'],
+                          stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE, cwd=path,
+                          universal_newlines=True)
+    out, _ = process.communicate(''.join(sha + '^{commit}\n'
+                                         for sha in shas))
+    lines = out.splitlines()
+    if process.returncode != 0 or len(lines) != len(shas):
+        return None
+    # found objects are reported as '<sha> commit <size>', others as
+    # '<input> missing' (or 'ambiguous')
+    return set(sha for sha, line in zip(shas, lines)
+               if line.split(' ')[1:2] != ['commit'])
+
+
+###############################################################################
+def check_commits(repos, jobs):
+    """Check that the commits referenced by repos, a dictionary path -> SHAs,
+    exist, querying the repositories concurrently.
+
+    Return a dictionary path -> set of missing SHAs (None if the repo could
+    not be queried), leaving out repositories without missing commits."""
+
+    paths = sorted(repos)
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        results = list(executor.map(missing_commits, paths,
+                                    [sorted(repos[path]) for path in paths]))
+    return dict((path, missing) for path, missing in zip(paths, results)
+                if missing is None or missing)
+
+
+###############################################################################
+def fetch_source(label, path, mirrors, remote):
+    """Return the remote or URL to fetch the commits of the repo at path
+    from, and the entry of mirrors it was derived from.
+
+    mirrors is a list of NAME=URL mappings for single components (by label
+    or directory name), and mirror roots holding a NAME.git or NAME
+    repository per component. Local roots are only used if they contain the
+    repository. Without a matching mirror, the remote remote is used, with
+    None as mirror."""
+
+    name = os.path.basename(path)
+    for mirror in mirrors:
+        if '=' in mirror:
+            key, url = mirror.split('=', 1)
+            if key in (label, name):
+                return (url, mirror)
+    for mirror in mirrors:
+        if '=' in mirror:
+            continue
+        if os.path.isdir(mirror):
+            for candidate in (name + '.git', name):
+                if os.path.isdir(os.path.join(mirror, candidate)):
+                    return (os.path.abspath(os.path.join(mirror, candidate)),
+                            mirror)
+        elif '://' in mirror:
+            return (mirror.rstrip('/') + '/' + name + '.git', mirror)
+    return (remote, None)
+
+
+###############################################################################
+def fetch_commits(label, path, shas, source):
+    """Fetch the commits shas into the repo at path from source with a single
+    git fetch. Runs in worker threads of checkout. Return True on success."""
+
+    LOGGER.info('Fetching ' + str(len(shas)) + ' commits of ' + label +
+                ' from ' + source)
+    if traced_call(['git', 'fetch', '--quiet', '--no-tags', source] +
+                   sorted(shas), cwd=path) != 0:
+        LOGGER.error('Could not fetch missing commits of ' + label +
+                     ' from ' + source)
+        return False
+    return True
+
+
+###############################################################################
+def ensure_commits(repos, jobs=1, fetch=False, remote='origin', mirrors=(),
+                   dry_run=False):
+    """Check that the commits of repos, a list of tuples (label, path, sha),
+    exist, using jobs threads. With fetch, missing commits are fetched
+    first, with one fetch per repository, all repositories at once, from
+    remote or mirrors (see fetch_source). With dry_run, the fetches are only
+    logged, and the commits they would fetch count as available.
+
+    Log every missing commit. Return True if all commits are available."""
+
+    wanted = dict((path, [sha]) for _label, path, sha in repos)
+    missing = check_commits(wanted, jobs)
+    fetchable = [(label, path, missing[path]) for label, path, _sha in repos
+                 if missing.get(path)]
+    if fetch and fetchable:
+        sources = [fetch_source(label, path, mirrors, remote)
+                   for label, path, _shas in fetchable]
+        used = set(mirror for _source, mirror in sources)
+        for mirror in mirrors:
+            if mirror not in used:
+                LOGGER.warning('Mirror ' + mirror + ' matches none of the ' +
+                               'repositories to fetch. Is it an existing ' +
+                               'directory or a URL with ://?')
+        if dry_run:
+            for (label, _path, shas), (source, _mirror) in zip(fetchable,
+                                                                sources):
+                LOGGER.info('Would fetch ' + ' '.join(sorted(shas)) +
+                            ' of ' + label + ' from ' + source)
+            missing = dict((path, shas) for path, shas in missing.items()
+                           if shas is None)
+        else:
+            with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+                list(executor.map(
+                        lambda item, source: fetch_commits(
+                                                item[0], item[1], item[2],
+                                                source[0]),
+                        fetchable, sources))
+            missing = check_commits(wanted, jobs)
+    for label, path, sha in repos:
+        if path in missing:
+            LOGGER.error('Commit ' + sha + ' of ' + label +
+                         ' is missing from ' + path)
+    return not missing
+
+
+###############################################################################
+def plan_checkout(entry, projectpath):
+    """Compare the git components of a snapshot with the commits their
+    repositories are at.
+
+    Return a tuple (plan, up to date), plan being a list of tuples (label,
+    path, sha, current sha) of the components which need to be checked out,
+    in snapshot order, up to date a list of tuples (label, sha) of those
+    already at their snapshot commit. current sha is None for components
+    which are not a git repo."""
+
+    plan = []
+    up_to_date = []
+    for label, path, sha in snapshot_repos(entry, projectpath):
+        head = get_repo_head(path)
+        if head == sha:
+            up_to_date.append((label, sha))
+        else:
+            plan.append((label, path, sha, head))
+    return (plan, up_to_date)
+
+
+###############################################################################
+def checkout_repo(label, path, sha, abort):
+    """Check out sha in the repo at path, preferring a branch pointing at it.
+    Runs in worker threads of checkout.
+
+    Return True on success, False on failure, None if skipped because the
+    threading.Event abort was set by a failure elsewhere."""
+
+    if abort.is_set():
+        return None
+    LOGGER.info('Checking out ' + sha + ' of ' + label)
+    # check for named refs to avoid unnecessarily detached heads
+    with PROFILER.span('checkout ' + label):
+        refname = get_branchname(sha, path)
+        returncode = traced_call(['git', 'checkout', refname], cwd=path)
+    if returncode != 0:
+        LOGGER.error('An error occured checking out ' + label)
+        abort.set()
+        return False
+    return True
+
+
+###############################################################################
+def rollback_repo(label, path, refname):
+    """Check out refname again in the repo at path after a failed checkout.
+    Runs in worker threads of checkout. Return True on success."""
+
+    LOGGER.warning('Rolling back ' + label + ' to ' + refname)
+    with PROFILER.span('rollback ' + label):
+        returncode = traced_call(['git', 'checkout', refname], cwd=path)
+    if returncode != 0:
+        LOGGER.error('Could not roll back ' + label + ' to ' + refname)
+        return False
+    return True
+
+
+###############################################################################
+def checkout_snapshot(projectpath, name='latest', store=None,
+                      filename=JSON_METADATA, jobs=1, excludes=None,
+                      cache_dir=None, dry_run=False, fetch=False,
+                      remote='origin', mirrors=()):
+    """Check out the snapshot name of the project at projectpath.
+
+    Only repositories not at their snapshot commit yet are touched. They are
+    validated and checked out concurrently. If any checkout fails, the
+    repositories already moved are returned to their previous branch or
+    commit. With dry_run, the plan is only logged. File hashes of non-git
+    addons are kept in cache_dir, if given.
+    Return a dictionary with the snapshot name, the labels of the
+    repositories checked out (or to be checked out), the labels of those
+    already up to date, and the non-git addons whose state cannot be
+    guaranteed. Raise StateManagerError on failure."""
+
+    projectpath = os.path.abspath(projectpath)
+    if excludes is None:
+        excludes = DEFAULT_EXCLUDES
+    non_git_repos = []
+
+    # open metadata.json, abort on error
+    with open_snapshots(projectpath, store, filename) as snapshots:
+        entry = check_for_snapshot_entry(name, snapshots)
+    if not entry:
+        raise StateManagerError('Snapshot entry ' + name + ' does not exist.')
+
+    LOGGER.info('Planning checkout of snapshot ' + entry['name'])
+    with PROFILER.span('plan checkout'):
+        plan, up_to_date = plan_checkout(entry, projectpath)
+    for label, sha in up_to_date:
+        LOGGER.info(label + ' is already at ' + sha)
+    missing = [path for _label, path, _sha, _head in plan
+               if not os.path.isdir(path)]
+    if missing:
+        raise StateManagerError('Snapshot ' + entry['name'] + ' cannot be ' +
+                                'checked out, missing directories: ' +
+                                ', '.join(missing))
+
+    addons_path = os.path.join(projectpath, entry['core']['path'], 'addons')
+    for addon in entry['addons']:
+        if addon['sha'] != 'non-git':
+            continue
+        LOGGER.info('Skipping non-git addon ' + addon['name'])
+        if 'fingerprint' not in addon:
+            non_git_repos.append(addon['name'])
+            continue
+        if not os.path.isdir(os.path.join(addons_path, addon['name'])):
+            LOGGER.warning(addon['name'] + ' does not exist at ' +
+                           addons_path)
+            non_git_repos.append(addon['name'])
+            continue
+        with PROFILER.span('fingerprint ' + addon['name']):
+            fingerprint = fingerprint_dir(os.path.join(addons_path,
+                                                       addon['name']),
+                                          excludes, cache_dir, jobs)
+        if fingerprint == addon['fingerprint']:
+            LOGGER.info(addon['name'] + ' matches the content recorded in ' +
+                        'the snapshot')
         else:
-            LOGGER.warning('Not in a git repository: ' + os.getcwd())
-            return 2
+            LOGGER.warning(addon['name'] + ' changed since the snapshot ' +
+                           'was recorded')
+            non_git_repos.append(addon['name'])
+
+    # make sure all components to be changed have clean repos before actual
+    # operations. Probe concurrently, report in snapshot order.
+    def probe(item):
+        """Probe the repo of a plan item, in a worker thread."""
+        with PROFILER.span('validate ' + item[0]):
+            return probe_git_repo(item[1])
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        states = list(executor.map(probe, plan))
+    for (label, path, _sha, _head), state in zip(plan, states):
+        LOGGER.info('Making sure repos are clean: ' + label)
+        if report_repo_state(state, path) != 0:
+            raise StateManagerError(label + ' git repo could not be ' +
+                                    'validated successfully.')
+
+    # make sure all commits are available before moving anything
+    with PROFILER.span('check commits'):
+        available = ensure_commits([item[0:3] for item in plan], jobs, fetch,
+                                   remote, mirrors, dry_run)
+    if not available:
+        raise StateManagerError('Snapshot ' + entry['name'] + ' cannot be ' +
+                                'checked out. Fetch the missing commits ' +
+                                'first, or use --fetch.')
+
+    result = {'snapshot': entry['name'],
+              'checked_out': [item[0] for item in plan],
+              'up_to_date': [label for label, _sha in up_to_date],
+              'non_git': non_git_repos}
+    if dry_run:
+        if not plan:
+            LOGGER.info('Nothing to check out')
+        for label, path, sha, head in plan:
+            LOGGER.info('Would check out ' + sha + ' of ' + label +
+                        ' (now at ' + str(head) + ')')
+        return result
+
+    previous = [get_head_ref(path) for _label, path, _sha, _head in plan]
+    abort = threading.Event()
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        results = list(executor.map(
+                        lambda item: checkout_repo(item[0], item[1], item[2],
+                                                   abort),
+                        plan))
+    if abort.is_set():
+        moved = [(label, path, refname)
+                 for (label, path, _sha, _head), refname, success
+                 in zip(plan, previous, results) if success]
+        LOGGER.error('Checkout of snapshot ' + entry['name'] + ' failed. ' +
+                     'Rolling back ' + str(len(moved)) + ' repositories.')
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            list(executor.map(lambda item: rollback_repo(*item), moved))
+        raise StateManagerError('Checkout of snapshot ' + entry['name'] +
+                                ' was rolled back.')
+    LOGGER.info('Finished checking out snapshot ' + entry['name'])
+    if non_git_repos:
+        LOGGER.warning('The following addons not under git control were ' +
+                       'found. Correct code state cannot be guaranteed!')
+        for item in non_git_repos:
+            LOGGER.warning(str(item))
+
+    return result
 
 
 ###############################################################################
-def git_archive_repo(archivename, archivepath, repopath, repo_sha):
-    """Archive a git repo snapshot in the given archive file."""
+def checkout(args, filename):
+    """Check out snapshot from a json file, as specified by arguments in args.
 
+    Return 0 on success, 1 on failure."""
+    LOGGER.debug('In subcommand checkout.')
     try:
-        with open(archivename, 'r') as _archivefile:
-            LOGGER.info(archivename + ' already exists. Skipping ...')
-    except IOError as exc:
-        if exc.errno == errno.ENOENT:
-            os.chdir(archivepath)
-            LOGGER.info('Archiving ' + archivename)
-            os.chdir(repopath)
-            # git archive --format=tar.gz --output=arch.tar.gz \
-            # --remote=./openFrameworks/ sha
-            outpath = os.path.abspath(os.path.join(archivepath, archivename))
-            prefixpath = os.path.basename(repopath) + os.sep
-            subprocess.call(['git', 'archive', '--format=tar.gz',
-                             '--output=' + outpath,
-                             '--prefix=' + prefixpath, repo_sha])
-            # This doesn't work with the remote option, since git repos don't
-            # allow clients access to arbitrary sha's, only named ones.
-            # Solution: go to repo directory, use -o to put resulting file into
-            # right path
-            # cf. http://git.661346.n2.nabble.com/Passing-
-            # commit-IDs-to-git-archive-td7359753.html
-            # TODO: error catching
-            os.chdir(archivepath)
-        else:  # pragma: no cover
-            raise
+        checkout_snapshot(args.project, args.name, args.store, filename,
+                          args.jobs, excludes_from_args(args),
+                          cache_dir_from_args(args), args.dry_run,
+                          args.fetch, args.remote, args.mirror)
+    except StateManagerError as exc:
+        LOGGER.error(str(exc))
+        return 1
+    return 0
 
 
 ###############################################################################
-def check_for_snapshot_entry(name, json_object):
-    """Return snapshot entry if it already exists."""
-    return_entry = {}
-    for entry in json_object['snapshots']:
-        if entry['name'] == name:
-            LOGGER.info('Selecting snapshot ' + name)
-            return_entry = entry
-            break
-    return return_entry
+def add_worktree(label, repopath, sha, targetpath):
+    """Add a worktree of the repo at repopath at targetpath, with a detached
+    HEAD at sha. Runs in worker threads of materialize.
+
+    Return True on success."""
+
+    LOGGER.info('Adding worktree of ' + label + ' at ' + targetpath)
+    if traced_call(['git', 'worktree', 'add', '--quiet', '--detach',
+                    targetpath, sha], cwd=repopath) != 0:
+        LOGGER.error('Could not add a worktree of ' + label + ' at ' +
+                     targetpath)
+        return False
+    return True
 
 
 ###############################################################################
-def record(args, filename):
-    """Record a snapshot in a json file, as specified by arguments in args.
+def copy_dir(dirpath, targetpath, excludes):
+    """Copy the directory dirpath to targetpath, leaving out files matching
+    excludes. Symlinks are copied as symlinks."""
+
+    os.makedirs(targetpath)
+    for relpath, filestat in scan_dir(dirpath, excludes):
+        source = os.path.join(dirpath, relpath)
+        target = os.path.join(targetpath, relpath)
+        if stat.S_ISDIR(filestat.st_mode):
+            os.mkdir(target)
+        elif stat.S_ISLNK(filestat.st_mode):
+            os.symlink(os.readlink(source), target)
+        else:
+            shutil.copy2(source, target)
 
+
+###############################################################################
+def materialize(args, filename):
+    """Lay out a snapshot of OF and all addons in a new directory, as
+    specified by arguments in args, without touching the existing clones.
+
+    Git components become worktrees of the existing repositories at the
+    snapshot commits, sharing their object stores. Non-git addons and the
+    project itself are copied. Everything keeps its location relative to
+    the project.
     Return 0 on success, 1 on failure."""
 
-    LOGGER.debug('In subcommand record.')
-    os.chdir(args.project)
-    projectpath = os.getcwd()
+    LOGGER.debug('In subcommand materialize.')
+    targetpath = os.path.abspath(args.into)
+    projectpath = os.path.abspath(args.project)
 
-    # parse addons.make into a list of addons
-    addons_list = []
     try:
-        with open('addons.make', 'r') as addons_make:
-            for line in addons_make.readlines():
-                addons_list.append(line.rstrip())
-    except IOError as exc:
-        if exc.errno == errno.ENOENT:
-            LOGGER.debug('No addons.make file found.')
-        else:  # pragma: no cover
-            raise
-    if len(addons_list) is 0:
-        LOGGER.info('No addons found.')
+        snapshots = open_snapshots(projectpath, args.store, filename)
+    except StateManagerError as exc:
+        LOGGER.error(str(exc))
+        return 1
 
-    # search config.make for OF location
-    with open('config.make', 'r') as config_make:
-        of_path = ''
-        for line in config_make.readlines():
-            if 'OF_ROOT =' in line:
-                of_path = line.split('=', 1)[-1].strip()
-                break
-        if len(of_path) == 0:
-            LOGGER.error('Did not find OF location in config.make in ' +
-                         os.getcwd())
-            return 1
+    with snapshots:
+        entry = check_for_snapshot_entry(args.name, snapshots)
+    if not entry:
+        LOGGER.error('Snapshot entry ' + args.name + ' does not exist.')
+        return 1
+    if os.path.exists(targetpath) and os.listdir(targetpath):
+        LOGGER.error(targetpath + ' is not empty.')
+        return 1
 
-    LOGGER.info('Processing OF at ' + of_path)
-    os.chdir(of_path)
-    core_dict = {'path': of_path}
-    if validate_git_repo() != 0:
-        LOGGER.error('OF git repo could not be validated successfully.')
+    repos = snapshot_repos(entry, projectpath)
+    if not ensure_commits(repos, args.jobs, args.fetch, args.remote,
+                          args.mirror):
+        LOGGER.error('Snapshot ' + entry['name'] + ' cannot be ' +
+                     'materialized. Fetch the missing commits first, or ' +
+                     'use --fetch.')
+        return 1
+    corepath = repos[0][1]
+    non_git = [(addon['name'],
+                os.path.normpath(os.path.join(corepath, 'addons',
+                                              addon['name'])),
+                addon.get('fingerprint'))
+               for addon in entry['addons'] if addon['sha'] == 'non-git']
+
+    # Keep everything relative to the closest directory containing the
+    # project and all components
+    paths = ([projectpath] + [path for _label, path, _sha in repos] +
+             [path for _name, path, _fingerprint in non_git])
+    root = os.path.commonpath(paths)
+    if root in paths:
+        root = os.path.dirname(root)
+
+    def target(path):
+        """Return the location of path in the materialized snapshot."""
+        return os.path.join(targetpath, os.path.relpath(path, root))
+
+    excludes = excludes_from_args(args)
+    created = []
+    try:
+        # OF first, as addons usually live inside it
+        if add_worktree('OF', corepath, repos[0][2], target(corepath)):
+            created.append(repos[0])
+            with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as executor:
+                results = list(executor.map(
+                                lambda repo: add_worktree(repo[0], repo[1],
+                                                          repo[2],
+                                                          target(repo[1])),
+                                repos[1:]))
+            created.extend(repo for repo, result in zip(repos[1:], results)
+                           if result)
+        if len(created) != len(repos):
+            raise OSError(errno.EIO, 'Adding worktrees failed')
+
+        for name, path, fingerprint in non_git:
+            LOGGER.info('Copying non-git addon ' + name)
+            if (fingerprint is not None and
+                    fingerprint_dir(path, excludes, cache_dir_from_args(args),
+                                    args.jobs) != fingerprint):
+                LOGGER.warning(name + ' changed since the snapshot was ' +
+                               'recorded')
+            copy_dir(path, target(path), excludes)
+        LOGGER.info('Copying project ' + os.path.basename(projectpath))
+        copy_dir(projectpath, target(projectpath),
+                 excludes + [os.path.basename(projectpath) + '_archive/'])
+    except (IOError, OSError) as exc:
+        LOGGER.error('Could not materialize snapshot ' + entry['name'] +
+                     ': ' + str(exc))
+        for label, path, _sha in reversed(created):
+            LOGGER.info('Removing worktree of ' + label)
+            traced_call(['git', 'worktree', 'remove', '--force',
+                         target(path)], cwd=path)
+        shutil.rmtree(targetpath, ignore_errors=True)
         return 1
 
-    LOGGER.debug('Recording commit SHA')
-    out = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
-                                  universal_newlines=True)
-    core_dict['sha'] = out.strip()
-    LOGGER.debug('OF commit SHA: ' + core_dict['sha'])
+    LOGGER.info('Materialized snapshot ' + entry['name'] + ' in ' +
+                targetpath)
+    return 0
 
-    LOGGER.info('Processing addons')
-    addons_path = os.path.join(os.getcwd(), 'addons')
-    os.chdir(addons_path)
-    # get list of official addons
-    official_addons = []
-    with open('.gitignore', 'r') as gitignore_file:
-        for line in gitignore_file:
-            if line.startswith('!ofx'):
-                official_addons.append(line[1:].strip())
-    # prune official addons (which are in the OF repo already)
-    # not very efficient (better with sets),
-    # but irrelevant for the small lists we expect
-    addons_list = [{'name': x}
-                   for x
-                   in addons_list
-                   if x
-                   not in official_addons]
 
-    for addon in addons_list:
-        LOGGER.info('Processing addon ' + addon['name'])
-        try:
-            os.chdir(os.path.join(addons_path, addon['name']))
-        except Exception as exc:
-            if exc.errno == errno.ENOENT:
-                LOGGER.error(addon['name'] + ' does not exist at ' +
-                             addons_path + '.')
-                sys.exit('Aborting')
-            else:  # pragma: no cover
-                raise
+###############################################################################
+def restore(args, filename):
+    """Unpack an archived snapshot into a directory, as specified by
+    arguments in args. Delta archives are applied over their base snapshots.
 
-        ret = validate_git_repo(strict=False)
-        if ret == 0:
-            out_string = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
-                                                 universal_newlines=True)
-            addon['sha'] = out_string.strip()
-        elif ret == 2:
-            addon['sha'] = 'non-git'
-        else:
-            LOGGER.error(addon['name'] +
-                         ' git repo could not be validated successfully.')
-            return 1
+    Return 0 on success, 1 on failure."""
 
-    LOGGER.info('Storing metadata')
-    os.chdir(projectpath)
+    LOGGER.debug('In subcommand restore.')
+    targetpath = os.path.abspath(args.into)
+    projectpath = os.path.abspath(args.project)
+    archivepath = os.path.join(projectpath,
+                               os.path.basename(projectpath) + '_archive')
 
-    # Open/initialise metadata file
     try:
-        with open(filename, 'r') as metafile:
-            json_object = json.load(metafile)
-            LOGGER.info('loaded data from ' + filename)
-            LOGGER.debug(json_object)
-    except IOError as exc:
-        if exc.errno == errno.ENOENT:
-            LOGGER.info(filename + ' does not exist yet. Creating..')
-            open(filename, 'w').close()
-            # create new skeleton json_object
-            json_object = json.loads('{ "snapshots": [] }')
-        else:  # pragma: no cover
-            raise
+        snapshots = open_snapshots(projectpath, args.store, filename)
+    except StateManagerError as exc:
+        LOGGER.error(str(exc))
+        return 1
 
-    # Store/update metadata
-    # check if snapshot entry already exists
-    for entry in json_object['snapshots']:
-        if entry['name'] == args.name:
-            if (args.update is False) and (args.name is not 'latest'):
-                LOGGER.error(args.name +
-                             ': entry with the same name already exists. ' +
-                             'Use -u option to overwrite.')
+    with snapshots:
+        # Follow the delta chain back to a full snapshot archive
+        chain = []
+        name = args.name
+        while True:
+            entry = check_for_snapshot_entry(name, snapshots)
+            if not entry:
+                LOGGER.error('Snapshot entry ' + name + ' does not exist.')
+                return 1
+            manifestpath = os.path.join(archivepath,
+                                        delta_manifest_name(projectpath, name))
+            try:
+                with open(manifestpath, 'r') as manifestfile:
+                    manifest = json.load(manifestfile)
+            except IOError as exc:
+                if exc.errno != errno.ENOENT:  # pragma: no cover
+                    raise
+                manifest = None
+            except ValueError:
+                LOGGER.error('Delta manifest ' + manifestpath + ' is ' +
+                             'corrupt. Run archive --base again.')
+                return 1
+            chain.append((entry, manifest))
+            if manifest is None:
+                break
+            name = manifest['base']
+            if name in [item[0]['name'] for item in chain]:
+                LOGGER.error('Delta archives of ' + args.name +
+                             ' form a cycle at ' + name)
                 return 1
-            json_object['snapshots'].remove(entry)
 
-    # write updated entry
-    temp = {'name': args.name,
-            'date': datetime.now().isoformat(),
-            'description': args.description,
-            'core': core_dict,
-            'addons': addons_list}
-    json_object['snapshots'].append(temp)
+    def find_archive(archivename):
+        """Return the path of archivename in any compression format."""
+        stem = archivename[:-len(COMPRESSION_SUFFIXES['gz'])]
+        for suffix in COMPRESSION_SUFFIXES.values():
+            if os.path.isfile(os.path.join(archivepath, stem + suffix)):
+                return os.path.join(archivepath, stem + suffix)
+        return None
 
-    LOGGER.info('Writing updated data to ' + filename)
-    with open(filename, 'w') as metafile:
-        json.dump(json_object, metafile, indent=1, sort_keys=True)
+    try:
+        base_entry = chain[-1][0]
+        LOGGER.info('Unpacking snapshot ' + base_entry['name'] + ' into ' +
+                    targetpath)
+        for component in snapshot_components(base_entry, projectpath,
+                                             archivepath,
+                                             COMPRESSION_SUFFIXES['gz']):
+            archivefile = find_archive(component[1])
+            if archivefile is None:
+                LOGGER.error('Archive of ' + component[0] + ' for ' +
+                             'snapshot ' + base_entry['name'] +
+                             ' not found. Run archive first.')
+                return 1
+            LOGGER.info('Unpacking ' + os.path.basename(archivefile))
+            extract_archive(archivefile, targetpath)
+
+        for entry, manifest in reversed(chain[:-1]):
+            LOGGER.info('Applying delta of snapshot ' + entry['name'])
+            for prefix in manifest.get('removed', []):
+                if os.path.isdir(os.path.join(targetpath, prefix)):
+                    LOGGER.info('Removing ' + prefix)
+                    shutil.rmtree(os.path.join(targetpath, prefix))
+            for item in manifest['components']:
+                componentpath = os.path.join(targetpath, item['prefix'])
+                if item['mode'] == 'unchanged':
+                    continue
+                elif item['mode'] == 'full' and os.path.isdir(componentpath):
+                    shutil.rmtree(componentpath)
+                for path in item['deleted']:
+                    try:
+                        os.remove(os.path.join(componentpath, path))
+                    except OSError as exc:
+                        if exc.errno != errno.ENOENT:  # pragma: no cover
+                            raise
+                LOGGER.info('Unpacking ' + item['archive'])
+                extract_archive(os.path.join(archivepath, item['archive']),
+                                targetpath)
+    except (IOError, OSError, tarfile.TarError) as exc:
+        LOGGER.error('Could not unpack snapshot: ' + str(exc))
+        return 1
 
+    LOGGER.info('Restored snapshot ' + args.name + ' into ' + targetpath)
     return 0
 
 
 ###############################################################################
-def create_entry_then_archive(args, basedir, filename):
-    """run record, then archive, """
-    os.chdir(basedir)
-    setattr(args, 'description', '')
-    # call record to create the necessary entry:
-    if record(args, filename) == 0:
-        os.chdir(basedir)
-        return archive(args, filename)  # call archive recursively
-    else:
-        LOGGER.error('Creation of snapshot ' + args.name + 'failed.')
-        return 1
+def compact(args, filename):
+    """Fold the journal of a metadata file back into the file itself.
+
+    Return 0 on success, 1 on failure."""
+
+    LOGGER.debug('In subcommand compact.')
+    path = os.path.join(os.path.abspath(args.project), filename)
+    if not os.path.exists(journal_name(path)):
+        LOGGER.info('No journal found for ' + filename + '. Nothing to do.')
+        return 0
+    with SnapshotCollection.lock(path):
+        try:
+            snapshots = SnapshotCollection.load(path)
+        except IOError as exc:
+            LOGGER.error('Could not open file: ' + str(exc))
+            return 1
+        LOGGER.info('Writing ' + str(len(snapshots)) + ' snapshots to ' +
+                    filename)
+        snapshots.dump(path)
+    return 0
 
 
 ###############################################################################
-def archive(args, filename):
-    """Archive a snapshot from a json file, as specified by arguments in args.
+def list_snapshots(projectpath, store=None, filename=JSON_METADATA,
+                   sha=None):
+    """Return the snapshots of the project at projectpath, oldest first.
+    If sha is given, return only those using that commit or fingerprint.
+
+    Raise StateManagerError if the metadata file cannot be opened."""
+
+    with open_snapshots(os.path.abspath(projectpath), store,
+                        filename) as snapshots:
+        if sha is None:
+            return list(snapshots.by_date())
+        names = snapshots.names_with_sha(sha)
+        return [entry for entry in snapshots.by_date()
+                if entry['name'] in names]
+
+
+###############################################################################
+def list_command(args, filename):
+    """List available snapshots. If a snapshot name is supplied,
+    give more detailed info.
 
     Return 0 on success, 1 on failure."""
-    LOGGER.debug('In subcommand archive.')
-    basedir = os.getcwd()
-    os.chdir(args.project)
-    projectpath = os.getcwd()
 
-    LOGGER.debug('Opening metadata file')
+    LOGGER.debug('In subcommand list.')
     try:
-        with open(filename, 'r') as metafile:
-            json_object = json.load(metafile)
-            LOGGER.info('loaded data from ' + filename)
-            LOGGER.debug(json_object)
-            # update with data
-    except IOError as exc:
-        if exc.errno == errno.ENOENT:
-            LOGGER.info('Metadata file ' + filename +
-                        ' does not exist yet. Creating...')
-            return create_entry_then_archive(args, basedir, filename)
-        else:  # pragma: no cover
-            raise
-
-    # check if snapshot entry already exists, if not create it
-    entry = check_for_snapshot_entry(args.name, json_object)
-    if not entry:
-        LOGGER.info('Entry ' + args.name + ' does not exist yet. Creating...')
-        return create_entry_then_archive(args, basedir, filename)
-    #--------------------------------------------------------------------------
-    else:
-        # entry exists, start archiving
-        # create subdirectory for archive
-        basename = str(os.path.basename(projectpath))
-        archivedirectory = basename + '_archive'
-        try:
-            os.mkdir(archivedirectory)
-        except OSError as exc:
-            if exc.errno == errno.EEXIST:
-                LOGGER.debug('Directory ' + archivedirectory +
-                             ' already exists. Continuing.')
-            else:  # pragma: no cover
-                LOGGER.error('Could not create directory: ' +
-                             archivedirectory + ': ' + str(exc))
-                raise
-        os.chdir(archivedirectory)
+        snapshots = open_snapshots(os.path.abspath(args.project), args.store,
+                                   filename)
+    except StateManagerError as exc:
+        LOGGER.error(str(exc))
+        return 1
 
-        # archive all elements
-        # Description file
-        if entry['description'] != '':
-            LOGGER.info('Writing description file')
-            with open(basename + '_' + entry['name'] +
-                      '_description.txt', 'w') as descriptionfile:
-                descriptionfile.write(entry['description'])
-
-        # OF itself
-        archivename = (basename + '_' + entry['name'] +
-                       '_OF_' + entry['core']['sha'][0:7] + '.tar.gz')
-        repopath = os.path.abspath(os.path.join(projectpath,
-                                                entry['core']['path']))
-        git_archive_repo(archivename, os.getcwd(),
-                         repopath, entry['core']['sha'])
-
-        # addons
-        for addon in entry['addons']:
-            LOGGER.info('Archiving addon ' + addon['name'])
-            archivename = (basename + '_' + entry['name'] + '_' +
-                           os.path.basename(addon['name']) + '_' +
-                           addon['sha'][0:7] + '.tar.gz')
-            repopath = os.path.abspath(os.path.join(projectpath,
-                                                    entry['core']['path'],
-                                                    'addons',
-                                                    addon['name']))
-            if addon['sha'] != 'non-git':
-                git_archive_repo(archivename, os.getcwd(),
-                                 repopath, addon['sha'])
+    with snapshots:
+        if args.name_was_given:
+            entry = check_for_snapshot_entry(args.name, snapshots)
+            if not entry:
+                LOGGER.error('Snapshot entry ' + args.name +
+                             ' does not exist.')
+                return 1
             else:
-                LOGGER.info(addon['name'] +
-                            ' is not a git repo. Packing as tar.gz file.')
-                subprocess.call(['tar', '-zcf', archivename,
-                                 '--directory=' + os.path.dirname(repopath),
-                                 os.path.basename(repopath)])
-
-        return 0
+                LOGGER.info('Detailed info for snapshot ' + entry['name'] +
+                            ':')
+                if entry['description'] != '':
+                    LOGGER.info('Description: ' + entry['description'])
+                LOGGER.info('Date: ' + entry['date'])
+                LOGGER.info('Openframeworks:')
+                LOGGER.info('  path: ' + entry['core']['path'])
+                LOGGER.info('  SHA: ' + entry['core']['sha'])
+                LOGGER.info('Addons:')
+                for addon in entry['addons']:
+                    LOGGER.info('  name: ' + addon['name'])
+                    LOGGER.info('  SHA: ' + addon['sha'])
+                return 0
+        elif args.sha:
+            LOGGER.info('Snapshots using ' + args.sha + ':')
+            for name in snapshots.names_with_sha(args.sha):
+                LOGGER.info('  ' + name)
+            return 0
+        else:
+            LOGGER.info('Available snapshots:')
+            for snapshot in snapshots.by_date():
+                temp_string = '  ' + snapshot['name']
+                if snapshot['description'] != '':
+                    temp_string += (': ' + snapshot['description'])
+                LOGGER.info(temp_string)
+            LOGGER.info('Get more information by specifying desired ' +
+                        'snapshot with -n <name>.')
+            return 0
 
 
 ###############################################################################
-def get_branchname(target_sha):
-    """
-    Return branch name if a branch exists in cwd which points to target_sha.
-    Return target_sha otherwise
-    """
-    # Create an eval-able dictionary containing SHAs and associated branchnames
-    my_dict = (
-        '{' +
-        subprocess.check_output(['git',
-                                 'for-each-ref',
-                                 '--sort=authordate',
-                                 '--python',
-                                 '--format=%(objectname): %(refname:short),',
-                                 'refs/heads/'], universal_newlines=True) +
-        '}')
+def verify(args, filename):
+    """Check that every commit referenced by the snapshots in a metadata
+    file exists in its repository, or only those of the snapshot given in
+    args.
+
+    Return 0 if all snapshots can be checked out, 1 otherwise."""
+
+    LOGGER.debug('In subcommand verify.')
+    projectpath = os.path.abspath(args.project)
 
     try:
-        name = eval(my_dict)[target_sha]
-        LOGGER.debug('Found branch ' + name + ' pointing at ' + target_sha)
-    except KeyError as _exc:
-        name = target_sha
-    return name
+        snapshots = open_snapshots(projectpath, args.store, filename)
+    except StateManagerError as exc:
+        LOGGER.error(str(exc))
+        return 1
+
+    with snapshots:
+        if args.name_was_given:
+            entry = check_for_snapshot_entry(args.name, snapshots)
+            if not entry:
+                LOGGER.error('Snapshot entry ' + args.name +
+                             ' does not exist.')
+                return 1
+            entries = [entry]
+        else:
+            entries = list(snapshots.by_date())
+
+    # one query per repository, covering the commits of all snapshots
+    repos = {}
+    users = {}
+    for entry in entries:
+        for label, path, sha in snapshot_repos(entry, projectpath):
+            repos.setdefault(path, set()).add(sha)
+            users.setdefault((path, sha), []).append((entry['name'], label))
+    LOGGER.info('Checking ' + str(len(users)) + ' commits in ' +
+                str(len(repos)) + ' repositories')
+    missing = check_commits(repos, args.jobs)
+
+    broken = set()
+    for path in sorted(missing):
+        for sha in sorted(repos[path] if missing[path] is None
+                          else missing[path]):
+            for name, label in users[(path, sha)]:
+                broken.add(name)
+                if missing[path] is None:
+                    LOGGER.error(name + ': ' + label + ' at ' + path +
+                                 ' is not a git repository')
+                else:
+                    LOGGER.error(name + ': commit ' + sha + ' of ' + label +
+                                 ' is missing from ' + path)
+    if broken:
+        LOGGER.error(str(len(broken)) + ' of ' + str(len(entries)) +
+                     ' snapshots cannot be checked out.')
+        return 1
+    LOGGER.info('All commits of ' + str(len(entries)) +
+                ' snapshots are available.')
+    return 0
 
 
 ###############################################################################
-def checkout(args, filename):
-    """Check out snapshot from a json file, as specified by arguments in args.
+def import_command(args, _filename):
+    """Import the snapshots of metadata.json into metadata.sqlite.
 
+    Snapshots with the same name are replaced.
     Return 0 on success, 1 on failure."""
-    LOGGER.debug('In subcommand checkout.')
-    os.chdir(args.project)
-    projectpath = os.getcwd()
-    non_git_repos = []
 
-    # open metadata.json, abort on error
+    LOGGER.debug('In subcommand import.')
+    projectpath = os.path.abspath(args.project)
     try:
-        with open(filename, 'r') as metafile:
-            json_object = json.load(metafile)
-            LOGGER.info('Loaded json data from ' + filename)
-            LOGGER.debug(json_object)
+        source = SnapshotCollection.load(os.path.join(projectpath,
+                                                      JSON_METADATA))
     except IOError as exc:
-            LOGGER.error('Could not open file: ' + str(exc))
-            return 1
-
-    entry = check_for_snapshot_entry(args.name, json_object)
-    if not entry:
-        LOGGER.error('Snapshot entry ' + args.name + ' does not exist.')
+        LOGGER.error('Could not open file: ' + str(exc))
         return 1
+    with SqliteSnapshotCollection.create(os.path.join(
+                        projectpath, SQLITE_METADATA)) as target:
+        for entry in source:
+            target.put(entry)
+        target.dump(os.path.join(projectpath, SQLITE_METADATA))
+    LOGGER.info('Imported ' + str(len(source)) + ' snapshots into ' +
+                SQLITE_METADATA)
+    return 0
 
-    # make sure all components have clean repos before actual operations,
-    # skip non-git
-    LOGGER.info('Making sure repos are clean: OF')
-    os.chdir(entry['core']['path'])
-    if validate_git_repo() != 0:
-        LOGGER.error('OF git repo could not be validated successfully.')
-        return 1
 
-    LOGGER.info('Making sure repos are clean: addons')
-    addons_path = os.path.join(os.getcwd(), 'addons')
-    os.chdir(addons_path)
-    for addon in entry['addons']:
-            LOGGER.info('Processing addon ' + addon['name'])
-            if addon['sha'] == 'non-git':
-                LOGGER.info('Skipping non-git addon ' + addon['name'])
-                non_git_repos.append(addon['name'])
-            else:
-                os.chdir(addon['name'])
-                if validate_git_repo() != 0:
-                    LOGGER.error(
-                        addon['name'] +
-                        ' git repo could not be validated successfully.')
-                    return 1
-                os.chdir(addons_path)
-
-    LOGGER.info('Checking out openFrameworks')
-    LOGGER.info('Checking out ' + entry['core']['sha'] +
-                ' of ' + entry['core']['path'])
-    os.chdir(projectpath)
-    os.chdir(entry['core']['path'])
-    # check for named refs to avoid unnecessarily detached heads
-    refname = get_branchname(entry['core']['sha'])
-    if subprocess.call(['git', 'checkout', refname]) != 0:
-        LOGGER.error('An error occured checking out ' + entry['core']['path'])
-        return 1
+###############################################################################
+def export_command(args, _filename):
+    """Export the snapshots of metadata.sqlite to metadata.json.
 
-    LOGGER.info('Checking out addons')
-    os.chdir(addons_path)
-    for addon in entry['addons']:
-            if addon['sha'] == 'non-git':
-                LOGGER.info('Skipping non-git addon ' + addon['name'])
-            else:
-                LOGGER.info('Checking out ' + addon['sha'] +
-                            ' of ' + addon['name'])
-                os.chdir(addon['name'])
-                # check for named refs to avoid unnecessarily detached heads
-                refname = get_branchname(addon['sha'])
-                if subprocess.call(['git', 'checkout', refname]) != 0:
-                    LOGGER.error('An error occured checking out '
-                                 + addon['name'])
-                    return 1
-                os.chdir(addons_path)
-    LOGGER.info('Finished checking out snapshot ' + entry['name'])
-    if non_git_repos:
-        LOGGER.warning('The following addons not under git control were ' +
-                       'found. Correct code state cannot be guaranteed!')
-        for item in non_git_repos:
-            LOGGER.warning(str(item))
+    Return 0 on success, 1 on failure."""
 
+    LOGGER.debug('In subcommand export.')
+    projectpath = os.path.abspath(args.project)
+    try:
+        source = SqliteSnapshotCollection.load(os.path.join(projectpath,
+                                                            SQLITE_METADATA))
+    except IOError as exc:
+        LOGGER.error('Could not open file: ' + str(exc))
+        return 1
+    with source:
+        target = SnapshotCollection(source.to_json_object())
+    with SnapshotCollection.lock(os.path.join(projectpath, JSON_METADATA)):
+        target.dump(os.path.join(projectpath, JSON_METADATA))
+    LOGGER.info('Exported ' + str(len(target)) + ' snapshots to ' +
+                JSON_METADATA)
     return 0
 
 
 ###############################################################################
-def list_command(args, filename):
-    """List available snapshots. If a snapshot name is supplied,
-    give more detailed info.
+def watched_repos(projectpath):
+    """Return the git repositories of the project at projectpath, as a list
+    of tuples (label, path): OF and every addon of addons.make with a
+    repository of its own, in a layout find_git_dirs understands. Official
+    addons are covered by OF."""
+
+    of_path, addons_list = read_project_files(projectpath)
+    corepath = os.path.normpath(os.path.join(projectpath, of_path))
+    official_addons = RepoMemo().official_addons(os.path.join(corepath,
+                                                              'addons'))
+    repos = []
+    for name in ['OF'] + addons_list:
+        if not name or name in official_addons:
+            continue
+        path = (corepath if name == 'OF' else
+                os.path.normpath(os.path.join(corepath, 'addons', name)))
+        if (find_git_toplevel(path) != os.path.realpath(path) or
+                find_git_dirs(path) is None):
+            LOGGER.info('Not watching ' + name + ', it is not the top ' +
+                        'level of a git repository')
+            continue
+        repos.append((name, path))
+    return repos
 
-    Return 0 on success, 1 on failure."""
 
-    LOGGER.debug('In subcommand list.')
-    os.chdir(args.project)
+###############################################################################
+class InotifyWatcher(object):
+    """Wait for changes to HEAD, the refs and packed-refs of repositories,
+    using inotify (Linux). Blocks without using any CPU while nothing
+    happens.
+
+    Raise OSError if inotify is not available."""
+
+    def __init__(self, repos):
+        libname = ctypes.util.find_library('c')
+        self._libc = ctypes.CDLL(libname, use_errno=True)
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self._fd = self._libc.inotify_init1(IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self._labels = [label for label, _path in repos]
+        self._wds = {}  # watch descriptor -> directory
+        self._dirs = {}  # directory -> [(label, names or None for all)]
+        try:
+            for label, path in repos:
+                gitdir, commondir = find_git_dirs(path)
+                self._add(label, gitdir, ('HEAD',))
+                self._add(label, commondir, ('packed-refs',))
+                self._add_tree(label, os.path.join(commondir, 'refs',
+                                                   'heads'))
+        except OSError:
+            os.close(self._fd)
+            raise
 
-    with open(filename, 'r') as metafile:
-        json_object = json.load(metafile)
-        LOGGER.info('Loaded json data from ' + filename)
-        LOGGER.debug(json_object)
+    def _add(self, label, dirpath, names):
+        """Watch dirpath for changes to names, or all entries if None."""
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(dirpath),
+                                          INOTIFY_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), 'Could not watch ' + dirpath)
+        self._wds[wd] = dirpath
+        self._dirs.setdefault(dirpath, []).append((label, names))
+
+    def _add_tree(self, label, dirpath):
+        """Watch dirpath and all directories below it."""
+        for current, _subdirs, _files in os.walk(dirpath):
+            self._add(label, current, None)
+
+    def wait(self, timeout=None):
+        """Wait up to timeout seconds (forever if None) for changes. Return
+        the set of labels of the repositories which changed."""
+        end = None if timeout is None else time.monotonic() + timeout
+        while True:
+            left = None if end is None else max(0, end - time.monotonic())
+            if not select.select([self._fd], [], [], left)[0]:
+                return set()
+            # other files in the git directories (index, logs, ...) do not
+            # count, keep waiting for the rest of timeout
+            changed = self._read()
+            if changed:
+                return changed
+
+    def _read(self):
+        """Read pending events. Return the labels of the repositories whose
+        watched files changed."""
+        data = os.read(self._fd, 65536)
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _cookie, length = struct.unpack_from('iIII', data,
+                                                           offset)
+            name = os.fsdecode(data[offset + 16:offset + 16 +
+                                    length].rstrip(b'\0'))
+            offset += 16 + length
+            if mask & IN_Q_OVERFLOW:
+                changed.update(self._labels)
+                continue
+            dirpath = self._wds.get(wd)
+            if dirpath is None:
+                continue
+            for label, names in list(self._dirs[dirpath]):
+                if names is not None and name not in names:
+                    continue
+                changed.add(label)
+                if (names is None and mask & IN_ISDIR and
+                        mask & (IN_CREATE | IN_MOVED_TO)):
+                    # branch names with slashes
+                    self._add_tree(label, os.path.join(dirpath, name))
+        return changed
+
+    def close(self):
+        """Stop watching."""
+        os.close(self._fd)
 
-    if args.name_was_given:
-        entry = check_for_snapshot_entry(args.name, json_object)
-        if not entry:
-            LOGGER.error('Snapshot entry ' + args.name + ' does not exist.')
-            return 1
-        else:
-            LOGGER.info('Detailed info for snapshot ' + entry['name'] + ':')
-            if entry['description'] != '':
-                LOGGER.info('Description: ' + entry['description'])
-            LOGGER.info('Date: ' + entry['date'])
-            LOGGER.info('Openframeworks:')
-            LOGGER.info('  path: ' + entry['core']['path'])
-            LOGGER.info('  SHA: ' + entry['core']['sha'])
-            LOGGER.info('Addons:')
-            for addon in entry['addons']:
-                LOGGER.info('  name: ' + addon['name'])
-                LOGGER.info('  SHA: ' + addon['sha'])
-            return 0
+
+###############################################################################
+class PollingWatcher(object):
+    """Wait for changes to HEAD, the current branch and packed-refs of
+    repositories by comparing their stat results every interval seconds.
+    Used where inotify is not available."""
+
+    def __init__(self, repos, interval=1.0):
+        self._repos = repos
+        self.interval = interval
+        self._signatures = self._scan()
+
+    @staticmethod
+    def _files(path):
+        """Return the files HEAD of the repo at path depends on."""
+        gitdir, commondir = find_git_dirs(path)
+        files = [os.path.join(gitdir, 'HEAD'),
+                 os.path.join(commondir, 'packed-refs')]
+        try:
+            with open(files[0], 'r') as head_file:
+                head = head_file.read().strip()
+        except IOError:
+            return files
+        if head.startswith('ref:'):
+            files.append(os.path.join(commondir,
+                                      head[len('ref:'):].strip()))
+        return files
+
+    def _scan(self):
+        """Return the stat signatures of the watched files by label."""
+        signatures = {}
+        for label, path in self._repos:
+            items = []
+            for name in self._files(path):
+                try:
+                    items.append(StatIndex.signature(os.stat(name)))
+                except OSError:
+                    items.append(None)
+            signatures[label] = items
+        return signatures
+
+    def wait(self, timeout=None):
+        """Wait up to timeout seconds (forever if None) for changes. Return
+        the set of labels of the repositories which changed."""
+        end = None if timeout is None else time.monotonic() + timeout
+        while True:
+            current = self._scan()
+            changed = set(label for label in current
+                          if current[label] != self._signatures.get(label))
+            self._signatures = current
+            if changed:
+                return changed
+            if end is None:
+                time.sleep(self.interval)
+            else:
+                left = end - time.monotonic()
+                if left <= 0:
+                    return set()
+                time.sleep(min(self.interval, left))
+
+    def close(self):
+        """Stop watching."""
+        pass
+
+
+###############################################################################
+def watch(args, filename):
+    """Record a snapshot whenever OF or an addon of the project moves to
+    another commit, as specified by arguments in args.
+
+    Changes are collected until none arrived for args.debounce seconds, then
+    the snapshot is recorded once. The first snapshot is recorded in full,
+    later ones only validate the repositories that moved and keep the other
+    pins of the last snapshot, unless config.make or addons.make changed.
+    Return 0 when stopped, 1 on failure."""
+
+    LOGGER.debug('In subcommand watch.')
+    projectpath = os.path.abspath(args.project)
+    try:
+        repos = watched_repos(projectpath)
+    except (StateManagerError, IOError) as exc:
+        LOGGER.error(str(exc))
+        return 1
+    paths = dict(repos)
+    # before the watcher starts, so that no move is missed
+    heads = dict((label, get_head_sha(path)) for label, path in repos)
+    if args.poll:
+        watcher = PollingWatcher(repos, args.poll_interval)
     else:
-        LOGGER.info('Available snapshots:')
-        for snapshot in json_object['snapshots']:
-            temp_string = '  ' + snapshot['name']
-            if snapshot['description'] != '':
-                temp_string += (': ' + snapshot['description'])
-            LOGGER.info(temp_string)
-        LOGGER.info('Get more information by specifying desired ' +
-                    'snapshot with -n <name>.')
+        try:
+            watcher = InotifyWatcher(repos)
+        except (OSError, AttributeError) as exc:
+            LOGGER.info('inotify is not available (' + str(exc) + '), ' +
+                        'polling every ' + str(args.poll_interval) + 's')
+            watcher = PollingWatcher(repos, args.poll_interval)
+    LOGGER.info('Watching ' + str(len(repos)) + ' repositories: ' +
+                ', '.join(label for label, _path in repos))
+
+    cache_dir = cache_dir_from_args(args)
+    # project files and entry of the last recorded snapshot
+    last = None
+    # repositories that moved while recording failed
+    stale = set()
+    try:
+        while True:
+            changed = watcher.wait()
+            while True:
+                more = watcher.wait(args.debounce)
+                if not more:
+                    break
+                changed.update(more)
+            changed.update(stale)
+            moved = []
+            for label in sorted(changed):
+                sha = get_head_sha(paths[label])
+                if sha != heads[label]:
+                    LOGGER.info(label + ' moved to ' + str(sha))
+                    moved.append((label, sha))
+            if not moved:
+                LOGGER.debug('No HEAD moved')
+                continue
+            description = ('Recorded by watch after ' +
+                           ', '.join(label for label, _sha in moved) +
+                           ' moved')
+            try:
+                project_files = read_project_files(projectpath)
+                if last is None or last[0] != project_files:
+                    entry = record_snapshot(projectpath, args.name,
+                                            description, True, args.store,
+                                            filename, args.journal,
+                                            args.jobs,
+                                            excludes_from_args(args),
+                                            cache_dir)
+                else:
+                    entry = repin_snapshot(last[1],
+                                           [(label, paths[label])
+                                            for label, _sha in moved],
+                                           args.name, description)
+                    store_snapshot(projectpath, entry, True, args.store,
+                                   filename, args.journal)
+            except (StateManagerError, IOError) as exc:
+                # try again on the next change
+                LOGGER.error('Could not record snapshot ' + args.name +
+                             ': ' + str(exc))
+                stale.update(label for label, _sha in moved)
+                continue
+            # HEADs may have moved on while recording
+            recorded = dict((addon['name'], addon['sha'])
+                            for addon in entry['addons'])
+            recorded['OF'] = entry['core']['sha']
+            heads.update((label, recorded[label]) for label in heads
+                         if label in recorded)
+            last = (project_files, entry)
+            stale.clear()
+            LOGGER.info('Recorded snapshot ' + args.name)
+            if args.once:
+                return 0
+    except KeyboardInterrupt:
+        LOGGER.info('Stopped watching')
         return 0
+    finally:
+        watcher.close()
 
 
 ###############################################################################
@@ -536,13 +3668,104 @@ def main():
                                '--verbose',
                                action='store_true',
                                help='Switch on debug logging.')
+    parent_parser.add_argument('--backend',
+                               choices=['json', 'sqlite'],
+                               help='Metadata storage to use. Defaults to ' +
+                                    'sqlite if ' + SQLITE_METADATA +
+                                    ' exists in the project, json ' +
+                                    'otherwise.')
+    parent_parser.add_argument('--profile',
+                               action='store_true',
+                               help='Time the phases of the subcommand and ' +
+                                    'every external command, and print a ' +
+                                    'summary at the end.')
+    parent_parser.add_argument('--trace',
+                               metavar='FILE',
+                               help='Write the timings as a Chrome ' +
+                                    'trace_event file for chrome://tracing ' +
+                                    'or Perfetto. Implies --profile.')
+
+    #Jobs parser contains options for subcommands doing concurrent work
+    jobs_parser = argparse.ArgumentParser(add_help=False)
+    jobs_parser.add_argument('-j',
+                             '--jobs',
+                             type=int,
+                             default=multiprocessing.cpu_count(),
+                             help='Number of components to process ' +
+                                  'concurrently. Defaults to the number ' +
+                                  'of CPUs.')
+
+    #Content parser contains options for subcommands reading addons which
+    #are not under git control
+    content_parser = argparse.ArgumentParser(add_help=False)
+    content_parser.add_argument('--cache-dir',
+                                default=default_cache_dir(),
+                                help='Shared cache of archives and file ' +
+                                     'hashes, used across projects to ' +
+                                     'avoid packing the same commit or ' +
+                                     'reading unchanged files twice. ' +
+                                     'Defaults to ' +
+                                     '~/.cache/ofStateManager/archives')
+    content_parser.add_argument('--no-cache',
+                                action='store_true',
+                                help='Do not use the shared cache.')
+    content_parser.add_argument('--exclude',
+                                action='append',
+                                default=[],
+                                metavar='PATTERN',
+                                help='Leave files matching PATTERN out of ' +
+                                     'addons not under git control. ' +
+                                     'Patterns ending in / only match ' +
+                                     'directories. Can be given several ' +
+                                     'times, adds to the defaults ' +
+                                     ' '.join(DEFAULT_EXCLUDES))
+    content_parser.add_argument('--no-default-excludes',
+                                action='store_true',
+                                help='Do not exclude ' +
+                                     ' '.join(DEFAULT_EXCLUDES) +
+                                     ' by default.')
+
+    #Workspace parser contains options for subcommands handling many
+    #projects at once
+    workspace_parser = argparse.ArgumentParser(add_help=False)
+    workspace_parser.add_argument('--workspace',
+                                  metavar='DIR',
+                                  help='Process every project (directory ' +
+                                       'containing config.make) below ' +
+                                       'DIR instead of --project. ' +
+                                       'Repositories shared by several ' +
+                                       'projects are validated only once.')
+
+    #Fetch parser contains options for subcommands needing snapshot commits
+    fetch_parser = argparse.ArgumentParser(add_help=False)
+    fetch_parser.add_argument('--fetch',
+                              action='store_true',
+                              help='Fetch commits missing from a ' +
+                                   'repository, with one git fetch per ' +
+                                   'repository.')
+    fetch_parser.add_argument('--remote',
+                              default='origin',
+                              help='Remote to fetch from if no mirror ' +
+                                   'matches. Defaults to origin.')
+    fetch_parser.add_argument('--mirror',
+                              action='append',
+                              default=[],
+                              metavar='[NAME=]URL',
+                              help='Fetch component NAME (OF or an addon) ' +
+                                   'from URL. Without NAME=, URL is a ' +
+                                   'directory or URL holding a NAME.git ' +
+                                   'repository per component. Can be ' +
+                                   'given several times.')
 
     subparsers = parser.add_subparsers(help='Available commands')
     record_parser = subparsers.add_parser('record',
                                           help='Record the state of all ' +
                                                'relevant components into a ' +
                                                'snapshot',
-                                          parents=[parent_parser])
+                                          parents=[parent_parser,
+                                                   jobs_parser,
+                                                   content_parser,
+                                                   workspace_parser])
     record_parser.add_argument('-u',
                                '--update',
                                action='store_true',
@@ -555,29 +3778,166 @@ def main():
                                     'in more detail than the name. Do not ' +
                                     'forget " " around DESCRIPTION if it ' +
                                     'contains whitespace.')
+    record_parser.add_argument('--journal',
+                               action='store_true',
+                               help='Append the snapshot to a journal ' +
+                                    'next to the metadata file instead of ' +
+                                    'rewriting it. Use compact to fold the ' +
+                                    'journal back into the metadata file.')
     record_parser.set_defaults(func=record)
 
     checkout_parser = subparsers.add_parser('checkout',
                                             help='Check out the complete ' +
                                                  'named or latest snapshot ' +
                                                  'of your project and OF',
-                                            parents=[parent_parser])
+                                            parents=[parent_parser,
+                                                     jobs_parser,
+                                                     content_parser,
+                                                     fetch_parser])
+    checkout_parser.add_argument('--dry-run',
+                                 action='store_true',
+                                 help='Only print which repositories would ' +
+                                      'be checked out.')
     checkout_parser.set_defaults(func=checkout)
 
     archive_parser = subparsers.add_parser('archive',
                                            help='Archive all relevant ' +
                                                 'components for the named or' +
                                                 ' latest snapshot',
-                                           parents=[parent_parser])
+                                           parents=[parent_parser,
+                                                    jobs_parser,
+                                                    content_parser,
+                                                    workspace_parser])
+    archive_parser.add_argument('--compression',
+                                choices=sorted(COMPRESSION_SUFFIXES),
+                                default='gz',
+                                help='Compression of the archives. ' +
+                                     'Defaults to gz, zst needs the ' +
+                                     'zstandard module.')
+    archive_parser.add_argument('--stream',
+                                metavar='FILE',
+                                help='Write metadata, description and all ' +
+                                     'components into the single tar file ' +
+                                     'FILE, keeping their folder ' +
+                                     'structure. Use - for stdout.')
+    archive_parser.add_argument('--resume', action='store_true',
+                                help='Continue an interrupted archive run: ' +
+                                     'keep archives matching the checksums ' +
+                                     'recorded by earlier runs, redo any ' +
+                                     'incomplete or corrupt ones.')
+    archive_parser.add_argument('--base',
+                                metavar='SNAPSHOT',
+                                help='Only archive what changed since the ' +
+                                     'given snapshot. Use restore to unpack ' +
+                                     'the result.')
+    archive_parser.add_argument('--level',
+                                type=int,
+                                help='Compression level, 0 to 9 for gz ' +
+                                     'and xz (default 6), 1 to 22 for zst ' +
+                                     '(default 3).')
     archive_parser.set_defaults(func=archive)
 
+    watch_parser = subparsers.add_parser('watch',
+                                         help='Record a snapshot whenever ' +
+                                              'OF or an addon moves to ' +
+                                              'another commit',
+                                         parents=[parent_parser,
+                                                  jobs_parser,
+                                                  content_parser])
+    watch_parser.add_argument('--debounce',
+                              type=float,
+                              default=1.0,
+                              metavar='SECONDS',
+                              help='Record once no further change arrived ' +
+                                   'for SECONDS. Defaults to 1.')
+    watch_parser.add_argument('--poll',
+                              action='store_true',
+                              help='Poll the repositories instead of using ' +
+                                   'inotify.')
+    watch_parser.add_argument('--poll-interval',
+                              type=float,
+                              default=1.0,
+                              metavar='SECONDS',
+                              help='Interval between polls, if polling. ' +
+                                   'Defaults to 1.')
+    watch_parser.add_argument('--journal',
+                              action='store_true',
+                              help='Append snapshots to the journal, as ' +
+                                   'with record --journal.')
+    watch_parser.add_argument('--once',
+                              action='store_true',
+                              help='Stop after recording one snapshot.')
+    watch_parser.set_defaults(func=watch)
+
     list_parser = subparsers.add_parser('list',
                                         help='List available snapshots. -n ' +
                                              'gives more detailed info about' +
                                              ' named snapshot',
                                         parents=[parent_parser])
+    list_parser.add_argument('--sha',
+                             help='List the snapshots which pin OF or an ' +
+                                  'addon to the commit SHA.')
     list_parser.set_defaults(func=list_command)
 
+    materialize_parser = subparsers.add_parser('materialize',
+                                               help='Lay out the named or ' +
+                                                    'latest snapshot in a ' +
+                                                    'new directory, using ' +
+                                                    'git worktrees of the ' +
+                                                    'existing repositories',
+                                               parents=[parent_parser,
+                                                        jobs_parser,
+                                                        content_parser,
+                                                        fetch_parser])
+    materialize_parser.add_argument('--into',
+                                    required=True,
+                                    metavar='DIR',
+                                    help='Empty or new directory to lay ' +
+                                         'out the snapshot in')
+    materialize_parser.set_defaults(func=materialize)
+
+    verify_parser = subparsers.add_parser('verify',
+                                          help='Check that the commits of ' +
+                                               'all snapshots, or of the ' +
+                                               'named one, exist in their ' +
+                                               'repositories',
+                                          parents=[parent_parser,
+                                                   jobs_parser])
+    verify_parser.set_defaults(func=verify)
+
+    restore_parser = subparsers.add_parser('restore',
+                                           help='Unpack the archives of the ' +
+                                                'named or latest snapshot, ' +
+                                                'applying delta archives ' +
+                                                'over their base',
+                                           parents=[parent_parser])
+    restore_parser.add_argument('--into',
+                                required=True,
+                                metavar='DIR',
+                                help='Directory to unpack the snapshot into')
+    restore_parser.set_defaults(func=restore)
+
+    compact_parser = subparsers.add_parser('compact',
+                                           help='Fold the journal written ' +
+                                                'by record --journal into ' +
+                                                'the metadata file',
+                                           parents=[parent_parser])
+    compact_parser.set_defaults(func=compact)
+
+    import_parser = subparsers.add_parser('import',
+                                          help='Import the snapshots of ' +
+                                               JSON_METADATA + ' into ' +
+                                               SQLITE_METADATA,
+                                          parents=[parent_parser])
+    import_parser.set_defaults(func=import_command)
+
+    export_parser = subparsers.add_parser('export',
+                                          help='Export the snapshots of ' +
+                                               SQLITE_METADATA + ' to ' +
+                                               JSON_METADATA,
+                                          parents=[parent_parser])
+    export_parser.set_defaults(func=export_command)
+
     args = parser.parse_args()
 #    args=parser.parse_args(('archive -p tests/mockTree/mockProject1 -n ' +
 #                           'somesnapshot -v').split())
@@ -594,6 +3954,9 @@ def main():
     #TODO: verification routines
 
     # Initialisation
+    if getattr(args, 'stream', None) == '-':
+        # stdout is reserved for the archive
+        stdout_handler.setStream(sys.stderr)
     if args.verbose is True:
         LOGGER.setLevel(logging.DEBUG)
         # more detailed error messages for verbose mode
@@ -603,17 +3966,36 @@ def main():
     else:
         LOGGER.setLevel(logging.INFO)  # DEBUG/INFO/WARNING/ERROR/CRITICAL
 
+    # file with metadata about project
+    setattr(args, 'backend_was_given', args.backend is not None)
+    store, metadata_filename = metadata_store(args.project, args.backend)
+    setattr(args, 'store', store)
+
     LOGGER.debug(args)
-    metadata_filename = 'metadata.json'  # file with metadata about project
     LOGGER.debug('Metadata filename: ' + metadata_filename)
 
     #Main function
     LOGGER.info('Start processing.')
-    ret = args.func(args, metadata_filename)
+    if args.profile or args.trace:
+        PROFILER.enable()
+    with PROFILER.span(args.func.__name__.replace('_command', '')):
+        ret = args.func(args, metadata_filename)
     if  ret != 0:
         LOGGER.critical('An error occurred! Aborting execution.')
     else:
         LOGGER.info('Successfully finished processing!')
+    if PROFILER.enabled:
+        for line in PROFILER.summary():
+            LOGGER.info(line)
+    if args.trace:
+        try:
+            PROFILER.write_trace(args.trace)
+        except IOError as err:
+            LOGGER.error('Could not write trace to ' + args.trace + ': ' +
+                         err.strerror)
+            ret = 1
+        else:
+            LOGGER.info('Wrote trace to ' + args.trace)
 
     #Cleanup
     logging.shutdown()
@@ -621,6 +4003,5 @@ def main():
 
 ###############################################################################
 if __name__ == '__main__':  # pragma: no branch
-    LOGGER = logging.getLogger('OFStateMgr')
     RET_VAL = main()
     sys.exit(RET_VAL)
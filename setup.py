@@ -2,9 +2,8 @@
 
 import sys
 # Check for correct Python version
-if ((sys.version_info.major, sys.version_info.minor) != (2, 7) and
-    (sys.version_info.major, sys.version_info.minor) != (3, 3)):
-    print("This package needs Python 2.7 or 3.3 to run.")
+if sys.version_info < (3, 6):
+    print("This package needs Python 3.6 or newer to run.")
     sys.exit(1)
 
 #from ez_setup import use_setuptools
@@ -38,7 +37,8 @@ setup(name='ofStateManager',
       cmdclass={'test': PyTest},
       scripts=['ofStateManager.py'],
 #      requires=['argparse'], # dropped because included in python 2.7
-      extras_require={'test': ['pytest>=2.3.4', 'coverage']},
+      extras_require={'test': ['pytest>=2.3.4', 'coverage'],
+                      'zst': ['zstandard']},
 #      tests_require=['pytest>=2.3.4', 'coverage'],
-      use_2to3=True
+      python_requires='>=3.6'
      )
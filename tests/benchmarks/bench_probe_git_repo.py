@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+"""Benchmark the repository state probe on a tree with many ignored files.
+
+Compares probe_git_repo against the former subprocess chain of
+validate_git_repo (git rev-parse, git clean -xnd | grep, git diff, git
+ls-files), which walked every ignored file in the tree.
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                os.path.pardir,
+                                                os.path.pardir)))
+import ofStateManager  # pylint: disable=F0401,C0413
+
+
+def legacy_probe(path):
+    """Former validate_git_repo checks, without logging."""
+    with open(os.devnull, 'w') as devnull:
+        if ((0 == subprocess.call(['git', 'rev-parse'], cwd=path,
+                                  stderr=devnull)) and
+            (1 == subprocess.call(
+                    'git clean -xnd `pwd` | grep "Would remove \\./" ' +
+                    '> /dev/null', shell=True, cwd=path))):
+            if 0 != subprocess.call('git diff --exit-code HEAD > /dev/null',
+                                    shell=True, cwd=path):
+                return 'uncommitted'
+            if not subprocess.call(
+                    'git ls-files --others --exclude-standard ' +
+                    '--error-unmatch . > /dev/null 2>&1', shell=True,
+                    cwd=path):
+                return 'untracked'
+            return 'clean'
+        return 'no-repo'
+
+
+def make_tree(root, dirs, files_per_dir):
+    """Create a committed repo at root with dirs*files_per_dir ignored files.
+
+    Return the paths of the repository and of an ignored addon inside it."""
+    repo = os.path.join(root, 'openFrameworks')
+    os.makedirs(os.path.join(repo, 'addons', 'ofxNonGit'))
+    with open(os.path.join(repo, '.gitignore'), 'w') as fobj:
+        fobj.write('obj/\nbuild/\naddons/*\n')
+    with open(os.path.join(repo, 'README'), 'w') as fobj:
+        fobj.write('mock OF\n')
+    open(os.path.join(repo, 'addons', 'ofxNonGit', 'addon.h'), 'w').close()
+    for i in range(dirs):
+        for build_dir in ('obj', 'build'):
+            target = os.path.join(repo, 'apps', 'app' + str(i), build_dir)
+            os.makedirs(target)
+            for j in range(files_per_dir):
+                open(os.path.join(target, 'f' + str(j) + '.o'), 'w').close()
+    with open(os.devnull, 'w') as devnull:
+        for cmd in (['git', 'init', '-q'],
+                    ['git', 'add', '-A'],
+                    ['git', '-c', 'user.name=bench', '-c',
+                     'user.email=bench@example.com', 'commit', '-q', '-m',
+                     'init']):
+            subprocess.check_call(cmd, cwd=repo, stdout=devnull)
+    return repo, os.path.join(repo, 'addons', 'ofxNonGit')
+
+
+def main():
+    """Build the tree, time both probes and print the results."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--dirs', type=int, default=50,
+                        help='Number of app directories with build output')
+    parser.add_argument('--files', type=int, default=400,
+                        help='Ignored files per build directory')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Number of timed runs per probe')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='ofSM_bench_')
+    try:
+        repo, ignored = make_tree(root, args.dirs, args.files)
+        print('Tree with ' + str(2 * args.dirs * args.files) +
+              ' ignored files in ' + root)
+        for label, path in (('repository', repo), ('ignored addon', ignored)):
+            assert legacy_probe(path) == ofStateManager.probe_git_repo(path)
+            old = min(timeit.repeat(lambda: legacy_probe(path),
+                                    number=1, repeat=args.repeat))
+            new = min(timeit.repeat(
+                        lambda: ofStateManager.probe_git_repo(path),
+                        number=1, repeat=args.repeat))
+            print('{0:14s} legacy {1:8.1f} ms  probe {2:8.1f} ms  '
+                  'speedup {3:5.1f}x'.format(label, old * 1000, new * 1000,
+                                             old / new))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+"""Benchmark the subcommands of ofStateManager on a synthetic workspace.
+
+Runs record, list, verify, checkout and archive on a workspace made by
+make_workspace.py and reports wall time, the number of git processes
+started and the peak RSS per subcommand. The archive cache is kept between
+runs, except for archive-nocache. Results are saved as JSON, so runs on
+different commits can be compared with --compare.
+"""
+import argparse
+import json
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import make_workspace  # pylint: disable=F0401
+
+SCRIPT_LOC = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                          os.path.pardir, os.path.pardir,
+                                          'ofStateManager.py'))
+
+# name, arguments, and whether the archive folder is removed before each run
+COMMANDS = [
+    ('record', ['record', '-u', '-n', 'bench'], False),
+    ('list', ['list'], False),
+    ('list-name', ['list', '-n', 'bench'], False),
+    ('list-sha', ['list', '--sha', '0' * 40], False),
+    ('verify', ['verify'], False),
+    ('checkout-noop', ['checkout', '-n', 'bench'], False),
+    ('checkout-old', ['checkout', '-n', 'snapshot-0'], False),
+    ('checkout-back', ['checkout', '-n', 'bench'], False),
+    ('archive-nocache', ['archive', '-n', 'bench', '--no-cache'], True),
+    ('archive', ['archive', '-n', 'bench'], True),
+]
+
+
+def make_git_shim(shimdir, logfile):
+    """Put a git wrapper into shimdir which logs every call to logfile."""
+    real_git = shutil.which('git')
+    shim = os.path.join(shimdir, 'git')
+    with open(shim, 'w') as fobj:
+        fobj.write('#!/bin/sh\necho "$*" >> "' + logfile + '"\n' +
+                   'exec "' + real_git + '" "$@"\n')
+    os.chmod(shim, os.stat(shim).st_mode | stat.S_IXUSR)
+
+
+def run_command(arguments, workspace, env, logfile):
+    """Run ofStateManager once. Return (wall time in s, git processes,
+    peak RSS in kB)."""
+    open(logfile, 'w').close()
+    with open(os.devnull, 'w') as devnull:
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable, SCRIPT_LOC] + arguments +
+                                   ['-p', workspace['project']], env=env,
+                                   stdout=devnull, stderr=devnull)
+        _pid, status, usage = os.wait4(process.pid, 0)
+        wall = time.perf_counter() - start
+        process.returncode = (os.WEXITSTATUS(status)
+                              if os.WIFEXITED(status) else -1)
+    if process.returncode != 0:
+        raise RuntimeError(' '.join(arguments) + ' failed')
+    with open(logfile, 'r') as fobj:
+        calls = len(fobj.readlines())
+    # Linux reports kB, macOS bytes
+    rss = usage.ru_maxrss if sys.platform != 'darwin' else \
+        usage.ru_maxrss // 1024
+    return wall, calls, rss
+
+
+def run_benchmark(workspace, commands, repeat, env, logfile):
+    """Run every command repeat times. Return the results by command."""
+    results = {}
+    archivepath = os.path.join(workspace['project'], 'benchProject_archive')
+    for _i in range(repeat):
+        for name, arguments, clean in commands:
+            if clean and os.path.isdir(archivepath):
+                shutil.rmtree(archivepath)
+            wall, calls, rss = run_command(arguments, workspace, env,
+                                           logfile)
+            item = results.setdefault(name, {'wall_times': [],
+                                             'subprocesses': calls,
+                                             'peak_rss_kb': rss})
+            item['wall_times'].append(wall)
+            item['subprocesses'] = max(item['subprocesses'], calls)
+            item['peak_rss_kb'] = max(item['peak_rss_kb'], rss)
+    for item in results.values():
+        times = sorted(item['wall_times'])
+        item['wall_time_min'] = times[0]
+        item['wall_time_median'] = times[len(times) // 2]
+    return results
+
+
+def current_commit():
+    """Return the commit of the ofStateManager checkout, if known."""
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=os.path.dirname(SCRIPT_LOC),
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, commands, baseline=None):
+    """Print a table of results, with ratios to baseline if given."""
+    print('{0:16s} {1:>10s} {2:>10s} {3:>6s} {4:>10s}'.format(
+            'command', 'min ms', 'median ms', 'git', 'rss kB') +
+          ('  vs. baseline' if baseline else ''))
+    for name, _arguments, _clean in commands:
+        item = results[name]
+        line = '{0:16s} {1:10.1f} {2:10.1f} {3:6d} {4:10d}'.format(
+                    name, item['wall_time_min'] * 1000,
+                    item['wall_time_median'] * 1000, item['subprocesses'],
+                    item['peak_rss_kb'])
+        if baseline and name in baseline:
+            line += '  {0:5.2f}x time, {1:+d} git'.format(
+                        item['wall_time_min'] /
+                        baseline[name]['wall_time_min'],
+                        item['subprocesses'] -
+                        baseline[name]['subprocesses'])
+        print(line)
+
+
+def main():
+    """Generate a workspace, run the benchmark and save the results."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    make_workspace.add_arguments(parser)
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Number of timed runs per command')
+    parser.add_argument('--commands',
+                        help='Comma separated commands to run, of ' +
+                             ', '.join(name for name, _a, _c in COMMANDS) +
+                             '. record always runs first.')
+    parser.add_argument('--output', metavar='FILE',
+                        help='Where to save the JSON results. Defaults to ' +
+                             'bench_<commit>.json in the current directory.')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='JSON results of an earlier run to compare with')
+    parser.add_argument('--keep', action='store_true',
+                        help='Keep the generated workspace')
+    args = parser.parse_args()
+
+    commands = COMMANDS
+    if args.commands:
+        selected = args.commands.split(',')
+        commands = [item for item in COMMANDS
+                    if item[0] == 'record' or item[0] in selected]
+
+    root = tempfile.mkdtemp(prefix='ofSM_bench_')
+    try:
+        workspace = make_workspace.make_workspace(
+                        os.path.join(root, 'workspace'), args.addons,
+                        args.files, args.ignored, args.history,
+                        args.non_git_files, args.snapshots)
+        shimdir = os.path.join(root, 'bin')
+        os.mkdir(shimdir)
+        logfile = os.path.join(root, 'git-calls.log')
+        make_git_shim(shimdir, logfile)
+        env = dict(os.environ)
+        env['PATH'] = shimdir + os.pathsep + env.get('PATH', '')
+        env['XDG_CACHE_HOME'] = os.path.join(root, 'cache')
+        print('Workspace in ' + root + ': ' +
+              ', '.join(key + '=' + str(value) for key, value
+                        in sorted(workspace['params'].items())))
+
+        results = run_benchmark(workspace, commands, args.repeat, env,
+                                logfile)
+        commit = current_commit()
+        output = {'commit': commit,
+                  'date': datetime.now().isoformat(),
+                  'python': sys.version.split()[0],
+                  'params': dict(workspace['params'], repeat=args.repeat),
+                  'results': results}
+        baseline = None
+        if args.compare:
+            with open(args.compare, 'r') as fobj:
+                baseline = json.load(fobj)['results']
+        print_results(results, commands, baseline)
+        outfile = args.output or 'bench_' + (commit or 'unknown')[0:12] + \
+            '.json'
+        with open(outfile, 'w') as fobj:
+            json.dump(output, fobj, indent=1, sort_keys=True)
+        print('Results written to ' + outfile)
+    finally:
+        if args.keep:
+            print('Kept workspace in ' + root)
+        else:
+            shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
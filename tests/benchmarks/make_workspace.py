@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+"""Generate a synthetic OF workspace for benchmarking ofStateManager.
+
+The workspace contains an OF repository with an official addon, a number of
+git addons inside OF/addons, one addon not under git control, and a project
+using all of them, with a metadata.json holding many snapshots. Every git
+repository gets tracked files, ignored build artifacts (obj/) and a history
+of several commits.
+"""
+import argparse
+import json
+import os
+import subprocess
+from datetime import datetime, timedelta
+
+# files per directory of the generated trees
+FILES_PER_DIR = 50
+
+GIT_IDENTITY = ['-c', 'user.name=bench', '-c', 'user.email=bench@example.com']
+
+
+def git(cwd, *args):
+    """Run git in cwd, return its output."""
+    return subprocess.check_output(['git'] + GIT_IDENTITY + list(args),
+                                   cwd=cwd, universal_newlines=True)
+
+
+def write_files(path, count, subdir, suffix, size):
+    """Create count files of size bytes in subdirectories of path/subdir."""
+    for i in range(count):
+        dirpath = os.path.join(path, subdir, 'd' + str(i // FILES_PER_DIR))
+        if not os.path.isdir(dirpath):
+            os.makedirs(dirpath)
+        with open(os.path.join(dirpath, 'f' + str(i) + suffix),
+                  'w') as fobj:
+            fobj.write(('// ' + str(i) + ' ' * 60 + '\n') * (size // 64 + 1))
+
+
+def make_repo(path, files, ignored, history, gitignore, file_size=1024):
+    """Create a git repository at path with files tracked files, ignored
+    build artifacts and history commits.
+
+    Return the commit SHAs, oldest first."""
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    with open(os.path.join(path, '.gitignore'), 'w') as fobj:
+        fobj.write(gitignore)
+    write_files(path, files, 'src', '.cpp', file_size)
+    write_files(path, ignored, 'obj', '.o', file_size)
+    git(path, 'init', '-q')
+    git(path, 'add', '-A')
+    git(path, 'commit', '-q', '-m', 'initial')
+    for i in range(1, history):
+        with open(os.path.join(path, 'CHANGES'), 'a') as fobj:
+            fobj.write('change ' + str(i) + '\n')
+        git(path, 'add', 'CHANGES')
+        git(path, 'commit', '-q', '-m', 'change ' + str(i))
+    return git(path, 'rev-list', '--reverse', 'HEAD').split()
+
+
+def make_workspace(root, addons=10, files=200, ignored=200, history=5,
+                   non_git_files=100, snapshots=50):
+    """Create a workspace in the directory root, see the module docstring.
+
+    Return a dictionary with the paths of OF, the project and the addons,
+    and the parameters used."""
+    ofpath = os.path.join(root, 'openFrameworks')
+    os.makedirs(os.path.join(ofpath, 'addons', 'ofxOfficial'))
+    with open(os.path.join(ofpath, 'addons', '.gitignore'), 'w') as fobj:
+        fobj.write('!.gitignore\n!ofxOfficial\n')
+    with open(os.path.join(ofpath, 'addons', 'ofxOfficial', 'ofxOfficial.h'),
+              'w') as fobj:
+        fobj.write('// official addon\n')
+    core_shas = make_repo(ofpath, files, ignored, history,
+                          'obj/\nbin/\naddons/*\n!addons/.gitignore\n' +
+                          '!addons/ofxOfficial/\n')
+
+    addon_names = ['ofxAddon' + str(i) for i in range(addons)]
+    addon_shas = {}
+    for name in addon_names:
+        addon_shas[name] = make_repo(os.path.join(ofpath, 'addons', name),
+                                     files, ignored, history, 'obj/\nbin/\n')
+
+    nongit = os.path.join(ofpath, 'addons', 'ofxNonGit')
+    write_files(nongit, non_git_files, 'src', '.cpp', 4096)
+    write_files(nongit, non_git_files, 'obj', '.o', 4096)
+
+    projectpath = os.path.join(root, 'apps', 'benchProject')
+    os.makedirs(os.path.join(projectpath, 'src'))
+    with open(os.path.join(projectpath, 'src', 'main.cpp'), 'w') as fobj:
+        fobj.write('int main() { return 0; }\n')
+    with open(os.path.join(projectpath, 'config.make'), 'w') as fobj:
+        fobj.write('OF_ROOT = ../../openFrameworks\n')
+    with open(os.path.join(projectpath, 'addons.make'), 'w') as fobj:
+        fobj.write('\n'.join(['ofxOfficial'] + addon_names + ['ofxNonGit']) +
+                   '\n')
+
+    # snapshots cycling through the history of every repository
+    start = datetime(2014, 1, 1)
+    entries = []
+    for i in range(snapshots):
+        entries.append(
+            {'name': 'snapshot-' + str(i),
+             'date': (start + timedelta(hours=i)).isoformat(),
+             'description': 'generated snapshot ' + str(i),
+             'core': {'path': '../../openFrameworks',
+                      'sha': core_shas[i % len(core_shas)]},
+             'addons': [{'name': name,
+                         'sha': addon_shas[name][(i + j) %
+                                                 len(addon_shas[name])]}
+                        for j, name in enumerate(addon_names)] +
+                       [{'name': 'ofxNonGit', 'sha': 'non-git'}]})
+    with open(os.path.join(projectpath, 'metadata.json'), 'w') as fobj:
+        json.dump({'snapshots': entries}, fobj, indent=1, sort_keys=True)
+
+    return {'root': root, 'of': ofpath, 'project': projectpath,
+            'addons': [os.path.join(ofpath, 'addons', name)
+                       for name in addon_names] + [nongit],
+            'params': {'addons': addons, 'files': files, 'ignored': ignored,
+                       'history': history, 'non_git_files': non_git_files,
+                       'snapshots': snapshots}}
+
+
+def add_arguments(parser):
+    """Add the workspace parameters to the argparse parser."""
+    parser.add_argument('--addons', type=int, default=10,
+                        help='Number of git addons')
+    parser.add_argument('--files', type=int, default=200,
+                        help='Tracked files per repository')
+    parser.add_argument('--ignored', type=int, default=200,
+                        help='Ignored build artifacts per repository')
+    parser.add_argument('--history', type=int, default=5,
+                        help='Commits per repository')
+    parser.add_argument('--non-git-files', type=int, default=100,
+                        help='Files of the addon not under git control')
+    parser.add_argument('--snapshots', type=int, default=50,
+                        help='Snapshots in metadata.json')
+
+
+def main():
+    """Generate a workspace in the given directory."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('root', help='Directory to create the workspace in')
+    add_arguments(parser)
+    args = parser.parse_args()
+    workspace = make_workspace(args.root, args.addons, args.files,
+                               args.ignored, args.history,
+                               args.non_git_files, args.snapshots)
+    print('Created project ' + workspace['project'])
+
+
+if __name__ == '__main__':
+    main()
@@ -7,9 +7,11 @@ BASEDIR = os.path.dirname(__file__)
 
 
 @pytest.fixture(autouse=False)
-def set_up(tmpdir):
+def set_up(tmpdir, monkeypatch):
 #    print BASEDIR
     tmpdir.chdir()
+    # keep the shared archive cache out of the user's home directory
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmpdir.join('cache')))
     tar = tarfile.open(os.path.join(BASEDIR, "MockRepos.tar.gz"))
     tar.extractall()
     tar.close()
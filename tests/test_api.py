@@ -0,0 +1,140 @@
+"""Tests for using ofStateManager as a library"""
+# pylint: disable=C0111
+import pytest
+import gzip
+import os
+import shutil
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                os.path.pardir)))
+import ofStateManager  # pylint: disable=F0401,C0413
+
+
+@pytest.mark.usefixtures('set_up')
+class TestApi:
+    """Test the library functions"""
+
+    def test_api_concurrent_projects(self):
+        shutil.copytree('mockProject', 'otherProject')
+        cwd = os.getcwd()
+        projects = [os.path.abspath('mockProject'),
+                    os.path.abspath('otherProject')]
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            entries = list(executor.map(
+                            lambda path: ofStateManager.record_snapshot(
+                                path, 'snapshot-1', 'a text'),
+                            projects))
+        assert os.getcwd() == cwd
+        assert entries[0]['core'] == entries[1]['core']
+        assert entries[0]['addons'] == entries[1]['addons']
+        for path in projects:
+            snapshots = ofStateManager.list_snapshots(path)
+            assert [entry['name'] for entry in snapshots] == ['snapshot-1']
+            assert snapshots[0]['description'] == 'a text'
+
+        result = ofStateManager.checkout_snapshot(projects[1], 'snapshot-1',
+                                                  dry_run=True)
+        assert result['checked_out'] == []
+        assert 'OF' in result['up_to_date']
+
+        result = ofStateManager.archive_snapshot(projects[1], 'snapshot-1')
+        assert result['archivepath'] == os.path.join(projects[1],
+                                                     'otherProject_archive')
+        assert os.path.isfile(os.path.join(
+                    result['archivepath'],
+                    'otherProject_snapshot-1_description.txt'))
+        assert os.getcwd() == cwd
+
+    def test_api_concurrent_shared_cache(self):
+        projects = [os.path.abspath('project' + str(i)) for i in range(8)]
+        for path in projects:
+            shutil.copytree('mockProject', path)
+        cache_dir = os.path.abspath('cache')
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            entries = list(executor.map(
+                            lambda path: ofStateManager.record_snapshot(
+                                path, cache_dir=cache_dir),
+                            projects))
+        fingerprints = set(addon.get('fingerprint') for entry in entries
+                           for addon in entry['addons']
+                           if addon['name'] == 'ofxNonGitAddon')
+        assert len(fingerprints) == 1
+        assert not [name for _dirpath, _dirnames, filenames
+                    in os.walk(cache_dir) for name in filenames
+                    if name.endswith('.tmp')]
+
+    def test_api_concurrent_journal(self, monkeypatch):
+        # compact after every append, racing with the other appends
+        monkeypatch.setattr(ofStateManager, 'JOURNAL_MAX_SIZE', 0)
+        ofStateManager.record_snapshot('mockProject')
+        names = ['snapshot-' + str(i) for i in range(16)]
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(
+                    lambda name: ofStateManager.record_snapshot(
+                        'mockProject', name, update=True, journal=True),
+                    names))
+        snapshots = ofStateManager.list_snapshots('mockProject')
+        assert (sorted(entry['name'] for entry in snapshots) ==
+                sorted(names + ['latest']))
+        assert not [name for name in os.listdir('mockProject')
+                    if name.endswith('.tmp')]
+
+    def test_api_errors(self):
+        with pytest.raises(ofStateManager.StateManagerError):
+            ofStateManager.list_snapshots('mockProject')
+        ofStateManager.record_snapshot('mockProject', 'snapshot-1')
+        with pytest.raises(ofStateManager.StateManagerError):
+            ofStateManager.record_snapshot('mockProject', 'snapshot-1')
+        with pytest.raises(ofStateManager.StateManagerError):
+            ofStateManager.checkout_snapshot('mockProject', 'notexist')
+
+    def test_api_block_writer(self):
+        size = ofStateManager.COMPRESSION_BLOCK_SIZE
+        with open('out.gz', 'wb') as target:
+            with ofStateManager.BlockCompressor('gz', jobs=2) as compressor:
+                writer = ofStateManager.BlockWriter(compressor, target)
+                assert writer.write(b'a' * (size - 1)) == size - 1
+                # completes a block, only the new bytes are reported
+                assert writer.write(b'b' * 10) == 10
+                writer.close()
+        with gzip.open('out.gz', 'rb') as archive:
+            assert archive.read() == b'a' * (size - 1) + b'b' * 10
+
+    def test_api_write_archive_failure(self):
+        class FailingCompressor(object):
+            def compress(self, _source, target):
+                target.write(b'partial')
+                raise IOError('disk full')
+
+        with pytest.raises(IOError):
+            ofStateManager.write_archive(['git', 'archive', 'HEAD'],
+                                         'mockOF', 'out.tar',
+                                         FailingCompressor())
+        assert not os.path.exists('out.tar.part')
+        assert not os.path.exists('out.tar')
+
+    def test_api_sqlite_closed(self, monkeypatch):
+        store = ofStateManager.SqliteSnapshotCollection
+        connections = []
+        init = store.__init__
+
+        def tracking_init(self, filename):
+            init(self, filename)
+            connections.append(self._connection)
+        monkeypatch.setattr(store, '__init__', tracking_init)
+
+        ofStateManager.record_snapshot('mockProject', store=store,
+                                       filename='metadata.sqlite')
+        ofStateManager.list_snapshots('mockProject', store,
+                                      'metadata.sqlite')
+        ofStateManager.checkout_snapshot('mockProject', store=store,
+                                         filename='metadata.sqlite')
+        ofStateManager.archive_snapshot('mockProject', 'other', store=store,
+                                        filename='metadata.sqlite')
+        assert connections
+        for connection in connections:
+            # closed connections refuse to run statements
+            with pytest.raises(ofStateManager.sqlite3.ProgrammingError):
+                connection.execute('SELECT 1')
@@ -2,7 +2,11 @@
 # pylint: disable=C0111
 import pytest
 import os
-from util_functions import run_ofSM
+import shutil
+import subprocess
+import tarfile
+import io
+from util_functions import SCRIPT_LOC, run_ofSM
 
 # TODO: git_archive_repo needs to return exist status to verify packing worked.
 
@@ -62,3 +66,177 @@ class TestArchive:
         out, _ = run_ofSM('archive -v -p mockProject -n someName', capfd=capfd)
         assert ('Directory mockProject_archive already exists. Continuing.'
                 in out)
+
+    def test_archive_jobs(self, capfd):
+        out, _ = run_ofSM('archive -j 1 -p mockProject', capfd=capfd)
+        assert 'Finished archiving OF' in out
+        assert 'Finished archiving ofxNonGitAddon' in out
+        assert 'bytes in 5 archives to mockProject_archive' in out
+
+        out, _ = run_ofSM('archive -j 4 -p mockProject -n other', capfd=capfd)
+        assert 'Finished archiving ofxSomeAddon' in out
+        assert len([name for name in
+                    os.listdir(os.path.join('mockProject',
+                                            'mockProject_archive'))
+                    if '.tar' in name]) == 10
+
+    def test_archive_resume(self, capfd):
+        run_ofSM('archive --no-cache -p mockProject', capfd=capfd)
+        archive_dir = os.path.join('mockProject', 'mockProject_archive')
+        assert os.path.isfile(os.path.join(
+                    archive_dir, 'mockProject_latest_checksums.json'))
+        assert not [name for name in os.listdir(archive_dir)
+                    if name.endswith('.part')]
+        # simulate an archive cut short by an interrupted run
+        damaged = os.path.join(archive_dir, 'mockProject_latest_OF_f12de85' +
+                               '.tar.gz')
+        with open(damaged, 'r+b') as archivefile:
+            archivefile.truncate(10)
+
+        out, err = run_ofSM('archive --no-cache --resume -p mockProject',
+                            capfd=capfd)
+        assert ('mockProject_latest_OF_f12de85.tar.gz is incomplete or ' +
+                'corrupt. Archiving again.') in err
+        assert 'Finished archiving OF' in out
+        assert ('mockProject_latest_ofxSomeAddon_' in out and
+                'verified. Skipping ...' in out)
+        assert 'Finished archiving ofxSomeAddon' not in out
+        assert tarfile.open(damaged).getnames()[0] == 'mockOF'
+
+    def test_archive_cache(self, capfd):
+        cache_dir = os.path.join(os.environ['XDG_CACHE_HOME'],
+                                 'ofStateManager', 'archives')
+        out, _ = run_ofSM('archive -p mockProject', capfd=capfd)
+        assert 'Using cached archive' not in out
+        cached = os.path.join(cache_dir, 'mockOF',
+                              'f12de856d1b398637686d3cc47afb191baec1d25' +
+                              '-level6.tar.gz')
+        assert os.path.isfile(cached)
+
+        # a second project using the same OF gets its archives from the cache
+        shutil.copytree('mockProject', 'mockProject2')
+        shutil.rmtree(os.path.join('mockProject2', 'mockProject_archive'))
+        out, _ = run_ofSM('archive -p mockProject2', capfd=capfd)
+        assert ('Using cached archive for mockProject2_latest_OF_f12de85' +
+                '.tar.gz') in out
+        assert 'Using cached archive for mockProject2_latest_ofxSomeAddon' \
+            in out
+        assert os.path.samefile(cached, os.path.join(
+                        'mockProject2', 'mockProject2_archive',
+                        'mockProject2_latest_OF_f12de85.tar.gz'))
+
+        # archives of another level are not taken from the cache
+        shutil.rmtree(os.path.join('mockProject2', 'mockProject2_archive'))
+        out, _ = run_ofSM('archive --level 1 -p mockProject2', capfd=capfd)
+        assert 'Using cached archive' not in out
+        assert 'unchanged since it was last archived' not in out
+        assert os.path.isfile(os.path.join(
+                        cache_dir, 'mockOF',
+                        'f12de856d1b398637686d3cc47afb191baec1d25' +
+                        '-level1.tar.gz'))
+
+    def test_archive_non_git_unchanged(self, capfd):
+        addon = os.path.join('mockOF', 'addons', 'ofxNonGitAddon')
+        run_ofSM('archive -p mockProject', capfd=capfd)
+        # build output is excluded, so it does not count as a change
+        os.mkdir(os.path.join(addon, 'obj'))
+        with open(os.path.join(addon, 'obj', 'build.o'), 'w') as objfile:
+            objfile.write('object code')
+        with open(os.path.join(addon, '.DS_Store'), 'w') as dsfile:
+            dsfile.write('finder data')
+        out, _ = run_ofSM('archive -p mockProject -n other', capfd=capfd)
+        assert ('ofxNonGitAddon is unchanged since it was last archived. ' +
+                'Using cached archive for ' +
+                'mockProject_other_ofxNonGitAddon_non-git.tar.gz') in out
+
+        with open(os.path.join(addon, 'nonGitfile.txt'), 'a') as addonfile:
+            addonfile.write('more content')
+        out, _ = run_ofSM('archive -p mockProject -n third --exclude "*.txt"',
+                          capfd=capfd)
+        assert 'Archiving mockProject_third_ofxNonGitAddon_non-git' in out
+        with tarfile.open(os.path.join(
+                    'mockProject', 'mockProject_archive',
+                    'mockProject_third_ofxNonGitAddon_non-git.tar.gz')) as tar:
+            names = tar.getnames()
+        assert 'ofxNonGitAddon/.hiddenfile' in names
+        assert 'ofxNonGitAddon/nonGitfile.txt' not in names
+        assert 'ofxNonGitAddon/.DS_Store' not in names
+        assert 'ofxNonGitAddon/obj' not in names
+
+        out, _ = run_ofSM('archive -p mockProject -n fourth ' +
+                          '--no-default-excludes', capfd=capfd)
+        archivefile = os.path.join(
+                    'mockProject', 'mockProject_archive',
+                    'mockProject_fourth_ofxNonGitAddon_non-git.tar.gz')
+        with tarfile.open(archivefile) as tar:
+            assert 'ofxNonGitAddon/obj/build.o' in tar.getnames()
+            assert (tar.extractfile('ofxNonGitAddon/nonGitfile.txt').read()
+                    .endswith(b'more content'))
+
+    def test_archive_no_cache(self, capfd):
+        out, _ = run_ofSM('archive --no-cache -p mockProject', capfd=capfd)
+        assert 'Finished archiving OF' in out
+        assert not os.path.exists(os.environ['XDG_CACHE_HOME'])
+
+    @pytest.mark.parametrize('compression,suffix', [('gz', '.tar.gz'),
+                                                    ('xz', '.tar.xz'),
+                                                    ('none', '.tar')])
+    def test_archive_compression(self, capfd, compression, suffix):
+        run_ofSM('archive --no-cache --level 1 --compression ' +
+                 compression + ' -p mockProject')
+        archive_dir = os.path.join('mockProject', 'mockProject_archive')
+        for archivename in ('mockProject_latest_OF_f12de85' + suffix,
+                            'mockProject_latest_ofxNonGitAddon_non-git' +
+                            suffix):
+            # readable by standard tar
+            out = subprocess.check_output(
+                        ['tar', '-tf', os.path.join(archive_dir, archivename)],
+                        universal_newlines=True)
+            assert out.split('\n')[0] in ('mockOF/', 'ofxNonGitAddon/')
+
+    def test_archive_level_invalid(self, capfd):
+        _, err = run_ofSM('archive --level 10 -p mockProject', capfd=capfd,
+                          desired_exit_status=1)
+        assert ('Compression level of gz must be between 0 and 9, '
+                'not 10.') in err
+        assert 'Traceback' not in err
+        assert not os.path.exists(os.path.join('mockProject',
+                                               'mockProject_archive'))
+
+    def test_archive_zst_missing(self, capfd):
+        try:
+            import zstandard  # pylint: disable=F0401,W0612
+            pytest.skip('zstandard is installed')
+        except ImportError:
+            pass
+        _, err = run_ofSM('archive --compression zst -p mockProject',
+                          capfd=capfd, desired_exit_status=1)
+        assert 'zst compression needs the zstandard module' in err
+
+    def test_archive_stream(self, capfd):
+        run_ofSM('record -p mockProject -d "my description"')
+        out, _ = run_ofSM('archive -p mockProject --stream snapshot.tar.gz',
+                          capfd=capfd)
+        assert 'Streaming ofxNonGitAddon to mockOF/addons/ofxNonGitAddon' \
+            in out
+        assert not os.path.exists(os.path.join('mockProject',
+                                               'mockProject_archive'))
+        with tarfile.open('snapshot.tar.gz') as tar:
+            names = tar.getnames()
+            assert (tar.extractfile('mockProject/' +
+                                    'mockProject_latest_description.txt')
+                    .read() == b'my description')
+        assert 'mockProject/metadata.json' in names
+        # components keep their location relative to the project
+        assert 'mockOF/somOfFile.txt' in names
+        assert 'mockOF/addons/ofxSomeAddon/someAddonFile.txt' in names
+        assert 'mockOF/addons/ofxNonGitAddon/nonGitfile.txt' in names
+        assert 'ofxMockExternalAddon/externalAddonfile.txt' in names
+
+    def test_archive_stream_stdout(self):
+        run_ofSM('record -p mockProject')
+        out = subprocess.check_output([SCRIPT_LOC, 'archive', '-p',
+                                       'mockProject', '--stream', '-',
+                                       '--compression', 'none'])
+        with tarfile.open(fileobj=io.BytesIO(out)) as tar:
+            assert 'mockOF/addons/ofxSomeOtherAddon' in tar.getnames()
@@ -0,0 +1,70 @@
+"""Tests for the sqlite metadata backend and the import/export subcommands"""
+# pylint: disable=C0111
+import pytest
+import os
+from util_functions import REPLAY_DIR, run_ofSM, load_json_file
+
+
+@pytest.mark.usefixtures('set_up')
+class TestBackend:
+    """Test the sqlite backend"""
+
+    def test_sqlite_record(self, capfd):
+        run_ofSM('record --backend sqlite -p mockProject')
+        assert os.path.isfile(os.path.join('mockProject', 'metadata.sqlite'))
+        assert not os.path.exists(os.path.join('mockProject',
+                                               'metadata.json'))
+
+        # later commands pick up the database automatically
+        run_ofSM('record -p mockProject -n snapshot-1 -d "a text"')
+        run_ofSM('record -p mockProject -n snapshot-1', desired_exit_status=1)
+        out, _ = run_ofSM('list -p mockProject', capfd=capfd)
+        assert 'latest' in out
+        assert 'snapshot-1: a text' in out
+
+        out, _ = run_ofSM('list -p mockProject -n snapshot-1', capfd=capfd)
+        assert 'path: ../mockOF' in out
+        assert 'name: ofxNonGitAddon' in out
+
+    def test_sqlite_checkout_archive(self, capfd):
+        run_ofSM('record --backend sqlite -p mockProject')
+        _, err = run_ofSM('checkout -p mockProject', capfd=capfd)
+        assert 'git repo could not be validated successfully.' not in err
+        out, _ = run_ofSM('archive -p mockProject', capfd=capfd)
+        assert 'Finished archiving OF' in out
+
+    def test_list_sha(self, capfd):
+        run_ofSM('record --backend sqlite -p mockProject -n snapshot-1')
+        out, _ = run_ofSM('list -p mockProject --sha ' +
+                          'b64dbe3392dbecb8f24fd40c00b5e4e9d1f73b4c',
+                          capfd=capfd)
+        assert '  snapshot-1' in out
+
+        out, _ = run_ofSM('list -p mockProject --sha 0000000', capfd=capfd)
+        assert 'snapshot-1' not in out
+
+    def test_list_sha_json(self, capfd):
+        run_ofSM('record -p mockProject -n snapshot-1')
+        out, _ = run_ofSM('list -p mockProject --sha ' +
+                          'f12de856d1b398637686d3cc47afb191baec1d25',
+                          capfd=capfd)
+        assert '  snapshot-1' in out
+
+    def test_import_export(self, capfd):
+        run_ofSM('record -p mockProject')
+        run_ofSM('record -p mockProject -n snapshot-1')
+        out, _ = run_ofSM('import -p mockProject', capfd=capfd)
+        assert 'Imported 2 snapshots into metadata.sqlite' in out
+
+        os.remove(os.path.join('mockProject', 'metadata.json'))
+        out, _ = run_ofSM('export -p mockProject', capfd=capfd)
+        assert 'Exported 2 snapshots to metadata.json' in out
+        test = load_json_file(os.path.join('mockProject', 'metadata.json'))
+        std = load_json_file(os.path.join(REPLAY_DIR, 'md_record.json'))
+        assert test['snapshots'][0] == std['snapshots'][0]
+        assert test['snapshots'][1]['name'] == 'snapshot-1'
+
+    def test_import_no_metadata(self, capfd):
+        _, err = run_ofSM('import -p mockProject', capfd=capfd,
+                          desired_exit_status=1)
+        assert 'Could not open file: ' in err
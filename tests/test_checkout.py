@@ -7,6 +7,19 @@ import subprocess
 from util_functions import run_ofSM
 
 
+def move_head(repopath):
+    """Commit on a detached HEAD in the repo at repopath, return the new SHA.
+    """
+    subprocess.check_call(['git', 'checkout', '-q', '--detach'],
+                          cwd=repopath)
+    subprocess.check_call(['git', '-c', 'user.name=test', '-c',
+                           'user.email=test@example.com', 'commit', '-q',
+                           '--allow-empty', '-m', 'moved'], cwd=repopath)
+    return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                   cwd=repopath,
+                                   universal_newlines=True).strip()
+
+
 @pytest.mark.usefixtures('set_up')
 class TestCheckout:
     """Test checkout subcommand."""
@@ -31,10 +44,21 @@ class TestCheckout:
         run_ofSM('record -p mockProject')
 
         # Do a default checkout
-        _, err = run_ofSM('checkout -p mockProject', capfd=capfd)
+        out, err = run_ofSM('checkout -p mockProject', capfd=capfd)
         assert 'git repo could not be validated successfully.' not in err
+        assert ('ofxNonGitAddon matches the content recorded in the snapshot'
+                in out)
+        assert 'Correct code state cannot be guaranteed!' not in err
+
+    def test_checkout_non_git_drift(self, capfd):
+        run_ofSM('record -p mockProject')
+        with open(os.path.join('mockOF', 'addons', 'ofxNonGitAddon',
+                               'nonGitfile.txt'), 'a') as addonfile:
+            addonfile.write('changed')
+
+        _, err = run_ofSM('checkout -p mockProject', capfd=capfd)
+        assert 'ofxNonGitAddon changed since the snapshot was recorded' in err
         assert 'Correct code state cannot be guaranteed!' in err
-        assert 'ofxNonGitAddon' in err
 
     def test_checkout_OF_invalid(self, capfd):
         # Create metadata file
@@ -59,6 +83,24 @@ class TestCheckout:
         assert ('ofxSomeAddon git repo could not be validated successfully.'
                 in err)
 
+    def test_checkout_addon_missing(self, capfd):
+        run_ofSM('record -p mockProject')
+
+        # a missing non-git addon cannot be guaranteed
+        shutil.rmtree(os.path.join('mockOF', 'addons', 'ofxNonGitAddon'))
+        _, err = run_ofSM('checkout -p mockProject', capfd=capfd)
+        assert 'ofxNonGitAddon does not exist at ' in err
+        assert 'Correct code state cannot be guaranteed!' in err
+
+        # a missing git addon cannot be checked out
+        shutil.rmtree(os.path.join('mockOF', 'addons', 'ofxSomeAddon'))
+        _, err = run_ofSM('checkout -p mockProject', capfd=capfd,
+                          desired_exit_status=1)
+        assert ('Snapshot latest cannot be checked out, missing '
+                'directories: ') in err
+        assert os.path.join('addons', 'ofxSomeAddon') in err
+        assert 'Traceback' not in err
+
     def test_checkout_no_nongit(self, capfd):
         # Remove non-git addon from addons.make
         with open(os.path.join('mockProject', 'addons.make'), 'r') as fobj:
@@ -80,11 +122,20 @@ class TestCheckout:
     def test_checkout_head_detached(self, capfd):
         # Create metadata file
         run_ofSM('record -p mockProject')
+        # move OF off its snapshot commit, onto a detached HEAD
+        move_head('mockOF')
 
-        # Check it out again, assert that there's no detached HEAD
+        # Check it out again, assert that the branch is checked out instead
+        # of a detached HEAD
         out, err = run_ofSM('checkout -v -p mockProject', capfd=capfd)
+        assert 'Checking out ' in out
+        assert 'of OF' in out
         assert "You are in 'detached HEAD' state" not in out
         assert "You are in 'detached HEAD' state" not in err
+        assert subprocess.check_output(['git', 'rev-parse', '--abbrev-ref',
+                                        'HEAD'], cwd='mockOF',
+                                       universal_newlines=True).strip() \
+            == 'master'
 
     def test_checkout_head_should_be_detached(self, capfd):
         # detach the head of OF
@@ -106,3 +157,145 @@ class TestCheckout:
         # Check it out again, assert that there's a detached HEAD now
         _, err = run_ofSM('checkout -p mockProject', capfd=capfd)
         assert "You are in 'detached HEAD' state" in err
+
+    def test_checkout_packed_refs(self, capfd):
+        # Move OF's branches into packed-refs
+        os.chdir('mockOF')
+        ret = subprocess.call(['git', 'pack-refs', '--all', '--prune'])
+        assert ret == 0
+        os.chdir('..')
+
+        # Create metadata file, move away from it, and check it out again
+        # without detaching HEAD
+        run_ofSM('record -p mockProject')
+        move_head('mockOF')
+        out, err = run_ofSM('checkout -v -p mockProject', capfd=capfd)
+        assert 'Found branch master pointing at' in out
+        assert "You are in 'detached HEAD' state" not in err
+
+    def test_checkout_up_to_date(self, capfd):
+        run_ofSM('record -p mockProject')
+        move_head(os.path.join('mockOF', 'addons', 'ofxSomeAddon'))
+        out, _ = run_ofSM('checkout -p mockProject', capfd=capfd)
+        assert 'OF is already at f12de856d1b398637686d3cc47afb191baec1d25' \
+            in out
+        assert 'Making sure repos are clean: OF' not in out
+        assert 'Checking out b64dbe3392dbecb8f24fd40c00b5e4e9d1f73b4c of ' + \
+            'ofxSomeAddon' in out
+        assert 'Checking out f12de856' not in out
+
+        out, _ = run_ofSM('checkout -p mockProject', capfd=capfd)
+        assert 'ofxSomeAddon is already at' in out
+        assert 'Checking out ' not in out
+
+    def test_checkout_rollback(self, capfd):
+        run_ofSM('record -p mockProject')
+        of_sha = move_head('mockOF')
+        addon = os.path.join('mockOF', 'addons', 'ofxSomeAddon')
+        move_head(addon)
+        # a stale lock makes git checkout fail after validation
+        open(os.path.join(addon, '.git', 'index.lock'), 'w').close()
+
+        out, err = run_ofSM('checkout -p mockProject', capfd=capfd,
+                            desired_exit_status=1)
+        assert 'An error occured checking out ofxSomeAddon' in err
+        assert 'Checkout of snapshot latest failed. Rolling back' in err
+        assert 'Finished checking out snapshot' not in out
+        assert subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd='mockOF',
+                                       universal_newlines=True).strip() \
+            == of_sha
+
+    def test_checkout_jobs(self, capfd):
+        run_ofSM('record -p mockProject')
+        for repo in ('mockOF', os.path.join('mockOF', 'addons',
+                                            'ofxSomeAddon'),
+                     'ofxMockExternalAddon'):
+            move_head(repo)
+        out, _ = run_ofSM('checkout -j 4 -p mockProject', capfd=capfd)
+        assert 'Finished checking out snapshot latest' in out
+        out, _ = run_ofSM('checkout -p mockProject --dry-run', capfd=capfd)
+        assert 'Nothing to check out' in out
+
+    def make_unfetched_snapshot(self):
+        """Record a snapshot pinning ofxSomeAddon to a commit which only
+        exists in a mirror of the addon. Return the commit SHA."""
+        addon = os.path.join('mockOF', 'addons', 'ofxSomeAddon')
+        old_sha = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                          cwd=addon,
+                                          universal_newlines=True).strip()
+        new_sha = move_head(addon)
+        run_ofSM('record -p mockProject')
+        subprocess.check_call(['git', 'branch', 'mirrored'], cwd=addon)
+        subprocess.check_call(['git', 'clone', '-q', '--mirror', addon,
+                               os.path.join('mirrors', 'ofxSomeAddon.git')])
+        subprocess.check_call(['git', 'checkout', '-q', old_sha], cwd=addon)
+        subprocess.check_call(['git', 'branch', '-q', '-D', 'mirrored'],
+                              cwd=addon)
+        subprocess.check_call(['git', 'reflog', 'expire', '--expire=now',
+                               '--all'], cwd=addon)
+        subprocess.check_call(['git', 'gc', '-q', '--prune=now'], cwd=addon)
+        assert subprocess.call(['git', 'cat-file', '-e', new_sha],
+                               cwd=addon) != 0
+        return new_sha
+
+    def test_checkout_fetch_mirror(self, capfd):
+        new_sha = self.make_unfetched_snapshot()
+        _, err = run_ofSM('checkout -p mockProject', capfd=capfd,
+                          desired_exit_status=1)
+        assert 'Commit ' + new_sha + ' of ofxSomeAddon is missing' in err
+
+        out, _ = run_ofSM('checkout -p mockProject --fetch --mirror ' +
+                          os.path.abspath('mirrors'), capfd=capfd)
+        assert 'Fetching 1 commits of ofxSomeAddon from ' in out
+        assert 'Finished checking out snapshot latest' in out
+        assert subprocess.check_output(
+                    ['git', 'rev-parse', 'HEAD'],
+                    cwd=os.path.join('mockOF', 'addons', 'ofxSomeAddon'),
+                    universal_newlines=True).strip() == new_sha
+
+    def test_checkout_fetch_url(self, capfd):
+        new_sha = self.make_unfetched_snapshot()
+        url = 'file://' + os.path.abspath(os.path.join('mirrors',
+                                                       'ofxSomeAddon.git'))
+        out, _ = run_ofSM('checkout -p mockProject --fetch --mirror ' +
+                          'ofxSomeAddon=' + url, capfd=capfd)
+        assert 'Fetching 1 commits of ofxSomeAddon from ' + url in out
+        assert 'Checking out ' + new_sha + ' of ofxSomeAddon' in out
+
+    def test_checkout_fetch_dry_run(self, capfd):
+        new_sha = self.make_unfetched_snapshot()
+        addon = os.path.join('mockOF', 'addons', 'ofxSomeAddon')
+        mirror = os.path.abspath(os.path.join('mirrors', 'ofxSomeAddon.git'))
+        out, _ = run_ofSM('checkout -p mockProject --dry-run --fetch ' +
+                          '--mirror ' + os.path.abspath('mirrors'),
+                          capfd=capfd)
+        assert ('Would fetch ' + new_sha + ' of ofxSomeAddon from ' +
+                mirror) in out
+        assert 'Would check out ' + new_sha + ' of ofxSomeAddon' in out
+        # nothing was fetched
+        assert subprocess.call(['git', 'cat-file', '-e', new_sha],
+                               cwd=addon) != 0
+        assert not os.path.exists(os.path.join(addon, '.git', 'FETCH_HEAD'))
+
+        out, err = run_ofSM('checkout -p mockProject --dry-run --fetch ' +
+                            '--mirror host:mirrors', capfd=capfd)
+        assert 'Mirror host:mirrors matches none of the repositories' in err
+        assert ('Would fetch ' + new_sha + ' of ofxSomeAddon from ' +
+                'origin') in out
+
+    def test_checkout_dry_run(self, capfd):
+        run_ofSM('record -p mockProject')
+        addon = os.path.join('mockOF', 'addons', 'ofxSomeAddon')
+        moved = move_head(addon)
+        out, _ = run_ofSM('checkout --dry-run -p mockProject', capfd=capfd)
+        assert ('Would check out b64dbe3392dbecb8f24fd40c00b5e4e9d1f73b4c ' +
+                'of ofxSomeAddon (now at ' + moved + ')') in out
+        assert subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=addon,
+                                       universal_newlines=True).strip() \
+            == moved
+
+        run_ofSM('checkout -p mockProject')
+        out, _ = run_ofSM('checkout --dry-run -p mockProject', capfd=capfd)
+        assert 'Nothing to check out' in out
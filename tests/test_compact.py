@@ -0,0 +1,61 @@
+"""Tests for the compact subcommand"""
+# pylint: disable=C0111
+import pytest
+import os
+from util_functions import run_ofSM, load_json_file
+
+
+@pytest.mark.usefixtures('set_up')
+class TestCompact:
+    """Test compact subcommand"""
+
+    def test_compact_no_journal(self, capfd):
+        run_ofSM('record -p mockProject')
+        out, _ = run_ofSM('compact -p mockProject', capfd=capfd)
+        assert 'No journal found for metadata.json' in out
+
+    def test_compact(self, capfd):
+        run_ofSM('record -p mockProject')
+        run_ofSM('record --journal -p mockProject -n snapshot-1')
+        run_ofSM('record --journal -p mockProject -d "new latest"')
+
+        # readers see the journalled entries
+        out, _ = run_ofSM('list -p mockProject', capfd=capfd)
+        assert 'snapshot-1' in out
+        assert 'latest: new latest' in out
+
+        out, _ = run_ofSM('compact -p mockProject', capfd=capfd)
+        assert 'Writing 2 snapshots to metadata.json' in out
+        assert not os.path.exists(os.path.join('mockProject',
+                                               'metadata.json.journal'))
+        test = load_json_file(os.path.join('mockProject', 'metadata.json'))
+        assert ([entry['name'] for entry in test['snapshots']] ==
+                ['snapshot-1', 'latest'])
+        assert test['snapshots'][1]['description'] == 'new latest'
+
+    def test_compact_corrupt_line(self, capfd):
+        run_ofSM('record -p mockProject')
+        run_ofSM('record --journal -p mockProject -n snapshot-1')
+        with open(os.path.join('mockProject', 'metadata.json.journal'),
+                  'a') as journal:
+            journal.write('{"op": "put", "ent')
+
+        _, err = run_ofSM('compact -p mockProject', capfd=capfd)
+        assert 'Ignoring corrupt entry in line 2' in err
+        test = load_json_file(os.path.join('mockProject', 'metadata.json'))
+        assert len(test['snapshots']) == 2
+
+    def test_append_after_corrupt_line(self, capfd):
+        run_ofSM('record -p mockProject')
+        run_ofSM('record --journal -p mockProject -n snapshot-1')
+        with open(os.path.join('mockProject', 'metadata.json.journal'),
+                  'a') as journal:
+            journal.write('{"op": "put", "entry": {"na')
+
+        _, err = run_ofSM('record --journal -p mockProject -n snapshot-2',
+                          capfd=capfd)
+        assert 'Found incomplete last line in' in err
+        out, err = run_ofSM('list -p mockProject', capfd=capfd)
+        assert 'Ignoring corrupt entry in line 2' in err
+        assert 'snapshot-1' in out
+        assert 'snapshot-2' in out
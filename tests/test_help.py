@@ -33,3 +33,45 @@ class TestHelp:
         out, err = run_ofSM('list --help', capfd=capfd)
         assert out.startswith('usage: ofStateManager.py list [-h]')
         assert err == ''
+
+    def test_help_compact(self, capfd):
+        """Test if compact help text gets printed"""
+        out, err = run_ofSM('compact --help', capfd=capfd)
+        assert out.startswith('usage: ofStateManager.py compact [-h]')
+        assert err == ''
+
+    def test_help_materialize(self, capfd):
+        """Test if materialize help text gets printed"""
+        out, err = run_ofSM('materialize --help', capfd=capfd)
+        assert out.startswith('usage: ofStateManager.py materialize [-h]')
+        assert err == ''
+
+    def test_help_verify(self, capfd):
+        """Test if verify help text gets printed"""
+        out, err = run_ofSM('verify --help', capfd=capfd)
+        assert out.startswith('usage: ofStateManager.py verify [-h]')
+        assert err == ''
+
+    def test_help_import(self, capfd):
+        """Test if import help text gets printed"""
+        out, err = run_ofSM('import --help', capfd=capfd)
+        assert out.startswith('usage: ofStateManager.py import [-h]')
+        assert err == ''
+
+    def test_help_export(self, capfd):
+        """Test if export help text gets printed"""
+        out, err = run_ofSM('export --help', capfd=capfd)
+        assert out.startswith('usage: ofStateManager.py export [-h]')
+        assert err == ''
+
+    def test_help_restore(self, capfd):
+        """Test if restore help text gets printed"""
+        out, err = run_ofSM('restore --help', capfd=capfd)
+        assert out.startswith('usage: ofStateManager.py restore [-h]')
+        assert err == ''
+
+    def test_help_watch(self, capfd):
+        """Test if watch help text gets printed"""
+        out, err = run_ofSM('watch --help', capfd=capfd)
+        assert out.startswith('usage: ofStateManager.py watch [-h]')
+        assert err == ''
@@ -0,0 +1,82 @@
+"""Tests for the materialize subcommand"""
+# pylint: disable=C0111
+import pytest
+import os
+import shutil
+import subprocess
+from util_functions import run_ofSM
+
+OF_SHA = 'f12de856d1b398637686d3cc47afb191baec1d25'
+
+
+def head_of(repopath):
+    return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                   cwd=repopath,
+                                   universal_newlines=True).strip()
+
+
+@pytest.mark.usefixtures('set_up')
+class TestMaterialize:
+    """Test materialize subcommand"""
+
+    def test_materialize(self, capfd):
+        run_ofSM('record -p mockProject')
+        # move the existing clone, it must not matter
+        subprocess.check_call(['git', 'checkout', '-q', '--detach'],
+                              cwd='mockOF')
+        subprocess.check_call(['git', '-c', 'user.name=test', '-c',
+                               'user.email=test@example.com', 'commit', '-q',
+                               '--allow-empty', '-m', 'moved'], cwd='mockOF')
+        moved = head_of('mockOF')
+
+        out, _ = run_ofSM('materialize -p mockProject --into built',
+                          capfd=capfd)
+        assert 'Materialized snapshot latest in ' in out
+        assert head_of('mockOF') == moved
+        assert head_of(os.path.join('built', 'mockOF')) == OF_SHA
+        # worktrees share the object store of the existing clones
+        assert os.path.isfile(os.path.join('built', 'mockOF', '.git'))
+        addon = os.path.join('built', 'mockOF', 'addons', 'ofxSomeAddon')
+        assert os.path.isfile(os.path.join(addon, '.git'))
+        assert head_of(addon) == head_of(os.path.join('mockOF', 'addons',
+                                                      'ofxSomeAddon'))
+        assert os.path.isfile(os.path.join('built', 'ofxMockExternalAddon',
+                                           'externalAddonfile.txt'))
+        assert os.path.isfile(os.path.join('built', 'mockOF', 'addons',
+                                           'ofxNonGitAddon',
+                                           'nonGitfile.txt'))
+        assert os.path.isfile(os.path.join('built', 'mockProject',
+                                           'config.make'))
+
+        # a second snapshot side by side
+        out, _ = run_ofSM('materialize -p mockProject --into built2',
+                          capfd=capfd)
+        assert head_of(os.path.join('built2', 'mockOF')) == OF_SHA
+
+    def test_materialize_not_empty(self, capfd):
+        run_ofSM('record -p mockProject')
+        os.mkdir('built')
+        open(os.path.join('built', 'somefile'), 'w').close()
+        _, err = run_ofSM('materialize -p mockProject --into built',
+                          capfd=capfd, desired_exit_status=1)
+        assert 'built is not empty.' in err
+
+    def test_materialize_cleanup(self, capfd):
+        run_ofSM('record -p mockProject')
+        # a stale worktree registration makes adding the external addon fail
+        target = os.path.abspath(os.path.join('built',
+                                              'ofxMockExternalAddon'))
+        subprocess.check_call(['git', 'worktree', 'add', '-q', '--detach',
+                               target], cwd='ofxMockExternalAddon')
+        shutil.rmtree('built')
+
+        _, err = run_ofSM('materialize -p mockProject --into built',
+                          capfd=capfd, desired_exit_status=1)
+        assert 'Could not add a worktree of ../../ofxMockExternalAddon' in err
+        assert 'Could not materialize snapshot latest' in err
+        assert not os.path.exists('built')
+        # the worktrees already added were removed again
+        out = subprocess.check_output(['git', 'worktree', 'list',
+                                       '--porcelain'], cwd='mockOF',
+                                      universal_newlines=True)
+        assert out.count('worktree ') == 1
@@ -0,0 +1,59 @@
+"""Tests for the --profile and --trace options"""
+# pylint: disable=C0111
+import json
+import pytest
+from util_functions import run_ofSM
+
+
+@pytest.mark.usefixtures('set_up')
+class TestProfile:
+    """Test profiling of subcommands"""
+
+    def test_record_profile(self, capfd):
+        out, _ = run_ofSM('record -p mockProject --profile', capfd=capfd)
+        assert 'INFO\tProfile: ' in out
+        assert 'Spans by total time:' in out
+        assert 'validate OF' in out
+        assert 'addon ofxSomeAddon' in out
+        assert 'Commands by total time:' in out
+        assert 'git --no-optional-locks' in out
+        assert 'Slowest commands:' in out
+
+        out, _ = run_ofSM('record -p mockProject -n snapshot-1', capfd=capfd)
+        assert 'Profile: ' not in out
+
+    def test_trace(self, capfd):
+        out, _ = run_ofSM('record -p mockProject --trace trace.json',
+                          capfd=capfd)
+        assert 'Profile: ' in out
+        assert 'Wrote trace to trace.json' in out
+
+        with open('trace.json', 'r') as trace_file:
+            trace = json.load(trace_file)
+        assert trace['displayTimeUnit'] == 'ms'
+        events = trace['traceEvents']
+        spans = [event['name'] for event in events
+                 if event['ph'] == 'X' and event['cat'] == 'span']
+        assert 'record' in spans
+        assert 'write metadata' in spans
+        commands = [event for event in events
+                    if event['ph'] == 'X' and event['cat'] == 'command']
+        assert commands
+        for event in commands:
+            assert event['name'].startswith('git ')
+            assert event['dur'] >= 0
+            assert 'returncode' in event['args']
+        assert any(event['ph'] == 'M' and event['name'] == 'thread_name'
+                   for event in events)
+
+        # everything is at the snapshot already, checkout runs no git
+        out, _ = run_ofSM('checkout -p mockProject --trace trace.json',
+                          capfd=capfd)
+        assert 'Profile: 0 external commands' in out
+        with open('trace.json', 'r') as trace_file:
+            trace = json.load(trace_file)
+        spans = [event['name'] for event in trace['traceEvents']
+                 if event['ph'] == 'X']
+        assert 'checkout' in spans
+        assert 'plan checkout' in spans
+        assert 'fingerprint ofxNonGitAddon' in spans
@@ -3,6 +3,7 @@
 import pytest
 import os
 import shutil
+import subprocess
 from util_functions import SCRIPT_LOC, REPLAY_DIR, script_cmd, load_json_file
 from util_functions import run_ofSM
 
@@ -81,6 +82,32 @@ class TestRecord:
         test = load_json_file(os.path.join('mockProject', 'metadata.json'))
         assert test == std
 
+    def test_record_update_multiple(self):
+        for name in ('first', 'second', 'third'):
+            run_ofSM('record -p mockProject -n ' + name)
+        run_ofSM('record -u -p mockProject -n first -d "updated"')
+
+        test = load_json_file(os.path.join('mockProject', 'metadata.json'))
+        assert ([entry['name'] for entry in test['snapshots']] ==
+                ['second', 'third', 'first'])
+        assert test['snapshots'][-1]['description'] == 'updated'
+
+    def test_record_journal(self):
+        run_ofSM('record -p mockProject')
+        run_ofSM('record --journal -p mockProject -n snapshot-1')
+        run_ofSM('record --journal -p mockProject')
+        # this has to bail because -u was not given
+        run_ofSM('record --journal -p mockProject -n snapshot-1',
+                 desired_exit_status=1)
+
+        # metadata.json itself is untouched, the rest is in the journal
+        std = load_json_file(os.path.join(REPLAY_DIR, 'md_record.json'))
+        test = load_json_file(os.path.join('mockProject', 'metadata.json'))
+        assert test == std
+        with open(os.path.join('mockProject',
+                               'metadata.json.journal'), 'r') as journal:
+            assert len(journal.readlines()) == 2
+
     def test_record_description(self):
         run_ofSM('record -p mockProject -d "My Test description"')
         std = load_json_file(os.path.join(REPLAY_DIR,
@@ -108,7 +135,7 @@ class TestRecord:
         _, err = run_ofSM('record -p mockProject', capfd=capfd,
                           desired_exit_status=1)
         assert 'ofxSomeAddon does not exist at' in err
-        assert err.endswith('Aborting\n')
+        assert err.endswith('Aborting execution.\n')
 
     def test_record_addon_invalid(self, capfd):
         open(os.path.join(os.getcwd(), 'mockOF', 'addons', 'ofxSomeAddon',
@@ -121,3 +148,75 @@ class TestRecord:
         os.remove(os.path.join(os.getcwd(), 'mockProject', 'addons.make'))
         out, _ = run_ofSM('record -v -p mockProject', capfd=capfd)
         assert 'No addons.make file found.' in out
+
+    def test_record_gitdir_file(self):
+        # Move the addon's repository out of its work tree, as for submodules
+        addon_path = os.path.join('mockOF', 'addons', 'ofxSomeAddon')
+        shutil.move(os.path.join(addon_path, '.git'), 'ofxSomeAddon.git')
+        with open(os.path.join(addon_path, '.git'), 'w') as gitdir_file:
+            gitdir_file.write('gitdir: ../../../ofxSomeAddon.git\n')
+        subprocess.check_call(['git', 'config', 'core.worktree',
+                               os.path.abspath(addon_path)],
+                              cwd='ofxSomeAddon.git')
+
+        run_ofSM('record -p mockProject')
+        std = load_json_file(os.path.join(REPLAY_DIR, 'md_record.json'))
+        test = load_json_file(os.path.join('mockProject', 'metadata.json'))
+        assert test == std
+
+    def test_record_fingerprint(self, capfd):
+        run_ofSM('record -p mockProject')
+        test = load_json_file(os.path.join('mockProject', 'metadata.json'))
+        fingerprint = test['snapshots'][0]['addons'][-1]['fingerprint']
+        # the fingerprint is the tree hash git gives the directory
+        shutil.copytree(os.path.join('mockOF', 'addons', 'ofxNonGitAddon'),
+                        'gitified')
+        subprocess.check_call(['git', 'init', '-q', 'gitified'])
+        subprocess.check_call(['git', 'add', '-A'], cwd='gitified')
+        assert subprocess.check_output(['git', 'write-tree'], cwd='gitified',
+                                       universal_newlines=True).strip() \
+            == fingerprint
+
+        # unchanged files are not read again
+        out, _ = run_ofSM('record -v -p mockProject -n other', capfd=capfd)
+        assert 'Hashing 0 of ' in out
+        with open(os.path.join('mockOF', 'addons', 'ofxNonGitAddon',
+                               'nonGitfile.txt'), 'a') as addonfile:
+            addonfile.write('changed')
+        out, _ = run_ofSM('record -v -p mockProject -n third', capfd=capfd)
+        assert 'Hashing 1 of ' in out
+        test = load_json_file(os.path.join('mockProject', 'metadata.json'))
+        assert test['snapshots'][2]['addons'][-1]['fingerprint'] != \
+            fingerprint
+
+    def test_record_jobs(self):
+        run_ofSM('record -j 1 -p mockProject')
+        std = load_json_file(os.path.join(REPLAY_DIR, 'md_record.json'))
+        test = load_json_file(os.path.join('mockProject', 'metadata.json'))
+        assert test == std
+
+        run_ofSM('record -j 4 -p mockProject')
+        test = load_json_file(os.path.join('mockProject', 'metadata.json'))
+        assert test == std
+
+    def test_record_revalidates(self, capfd):
+        run_ofSM('record -p mockProject')
+
+        # editing a tracked file changes neither HEAD nor the index
+        addon_path = os.path.join('mockOF', 'addons', 'ofxSomeAddon')
+        with open(os.path.join(addon_path, 'someAddonFile.txt'),
+                  'a') as addonfile:
+            addonfile.write('changed')
+        _, err = run_ofSM('record -p mockProject', capfd=capfd,
+                          desired_exit_status=1)
+        assert 'ofxSomeAddon git repo could not be validated' in err
+
+        subprocess.check_call(['git', 'checkout', '-q', '--',
+                               'someAddonFile.txt'], cwd=addon_path)
+        os.makedirs(os.path.join('mockOF', 'addons', 'ofxSomeOtherAddon',
+                                 'src'))
+        open(os.path.join('mockOF', 'addons', 'ofxSomeOtherAddon', 'src',
+                          'untracked.txt'), 'w').close()
+        _, err = run_ofSM('record -p mockProject', capfd=capfd,
+                          desired_exit_status=1)
+        assert 'ofxSomeOtherAddon git repo could not be validated' in err
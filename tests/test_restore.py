@@ -0,0 +1,118 @@
+"""Tests for delta archives and the restore subcommand"""
+# pylint: disable=C0111
+import pytest
+import os
+import json
+import subprocess
+from util_functions import run_ofSM
+
+
+def commit_all(repopath, message):
+    """Commit all changes in the repo at repopath."""
+    subprocess.check_call(['git', 'add', '-A'], cwd=repopath)
+    subprocess.check_call(['git', '-c', 'user.name=test', '-c',
+                           'user.email=test@example.com', 'commit', '-q',
+                           '-m', message], cwd=repopath)
+
+
+@pytest.mark.usefixtures('set_up')
+class TestRestore:
+    """Test archive --base and restore"""
+
+    def make_delta(self):
+        """Archive a base snapshot, change OF and an addon, archive a delta."""
+        run_ofSM('record -p mockProject -n base')
+        run_ofSM('archive -p mockProject -n base')
+
+        addon_path = os.path.join('mockOF', 'addons', 'ofxSomeAddon')
+        with open(os.path.join(addon_path, 'someAddonFile.txt'), 'w') as fobj:
+            fobj.write('changed')
+        with open(os.path.join(addon_path, 'newFile.txt'), 'w') as fobj:
+            fobj.write('new')
+        commit_all(addon_path, 'change addon')
+        os.remove(os.path.join('mockOF', 'somOfFile.txt'))
+        commit_all('mockOF', 'remove file')
+
+        run_ofSM('record -p mockProject -n next')
+        run_ofSM('archive -p mockProject -n next --base base')
+
+    def test_archive_base(self):
+        self.make_delta()
+        archive_dir = os.path.join('mockProject', 'mockProject_archive')
+        with open(os.path.join(archive_dir,
+                               'mockProject_next_delta.json')) as fobj:
+            manifest = json.load(fobj)
+        assert manifest['base'] == 'base'
+        modes = dict((item['label'], item['mode'])
+                     for item in manifest['components'])
+        assert modes == {'OF': 'delta',
+                         'ofxSomeAddon': 'delta',
+                         '../../mockOF/addons/ofxSomeOtherAddon': 'unchanged',
+                         '../../ofxMockExternalAddon': 'unchanged',
+                         'ofxNonGitAddon': 'unchanged'}
+        assert manifest['components'][0]['deleted'] == ['somOfFile.txt']
+        archives = os.listdir(archive_dir)
+        assert not [name for name in archives
+                    if name.startswith('mockProject_next_ofxSomeOtherAddon')]
+
+    def test_restore(self, capfd):
+        self.make_delta()
+        out, _ = run_ofSM('restore -p mockProject -n next --into restored',
+                          capfd=capfd)
+        assert 'Applying delta of snapshot next' in out
+        assert not os.path.exists(os.path.join('restored', 'mockOF',
+                                               'somOfFile.txt'))
+        assert os.path.isfile(os.path.join('restored', 'mockOF', 'addons',
+                                           'ofxOfficialAddon',
+                                           'some_official_file.txt'))
+        with open(os.path.join('restored', 'ofxSomeAddon',
+                               'someAddonFile.txt')) as fobj:
+            assert fobj.read() == 'changed'
+        assert os.path.isfile(os.path.join('restored', 'ofxSomeAddon',
+                                           'newFile.txt'))
+        assert os.path.isfile(os.path.join('restored', 'ofxNonGitAddon',
+                                           'nonGitfile.txt'))
+        assert os.path.isfile(os.path.join('restored', 'ofxSomeOtherAddon',
+                                           'someOtherAddonFile.txt'))
+
+    def test_restore_removed_addon(self, capfd):
+        run_ofSM('record -p mockProject -n base')
+        run_ofSM('archive -p mockProject -n base')
+        addons_make = os.path.join('mockProject', 'addons.make')
+        with open(addons_make, 'r') as fobj:
+            lines = fobj.readlines()
+        with open(addons_make, 'w') as fobj:
+            fobj.writelines(line for line in lines
+                            if 'ofxMockExternalAddon' not in line)
+        run_ofSM('record -p mockProject -n next')
+        run_ofSM('archive -p mockProject -n next --base base')
+
+        manifestpath = os.path.join('mockProject', 'mockProject_archive',
+                                    'mockProject_next_delta.json')
+        with open(manifestpath) as fobj:
+            assert json.load(fobj)['removed'] == ['ofxMockExternalAddon']
+        out, _ = run_ofSM('restore -p mockProject -n next --into restored',
+                          capfd=capfd)
+        assert 'Removing ofxMockExternalAddon' in out
+        assert not os.path.exists(os.path.join('restored',
+                                               'ofxMockExternalAddon'))
+        assert os.path.isdir(os.path.join('restored', 'ofxSomeAddon'))
+
+        # a torn manifest is reported, not a crash
+        with open(manifestpath, 'r+') as fobj:
+            fobj.truncate(10)
+        _, err = run_ofSM('restore -p mockProject -n next --into other',
+                          capfd=capfd, desired_exit_status=1)
+        assert 'mockProject_next_delta.json is corrupt' in err
+
+    def test_restore_not_archived(self, capfd):
+        run_ofSM('record -p mockProject')
+        _, err = run_ofSM('restore -p mockProject --into restored',
+                          capfd=capfd, desired_exit_status=1)
+        assert 'Run archive first.' in err
+
+    def test_archive_base_nonexistent(self, capfd):
+        run_ofSM('record -p mockProject')
+        _, err = run_ofSM('archive -p mockProject --base nothere',
+                          capfd=capfd, desired_exit_status=1)
+        assert 'Base snapshot nothere does not exist.' in err
@@ -2,8 +2,13 @@
 # pylint: disable=C0111
 import pytest
 import os
+import sys
 from util_functions import run_ofSM
 
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                os.path.pardir)))
+import ofStateManager  # pylint: disable=F0401,C0413
+
 
 @pytest.mark.usefixtures('set_up')
 class TestValidateGitRepo:
@@ -20,3 +25,14 @@ class TestValidateGitRepo:
         _, err = run_ofSM('record -p mockProject', capfd=capfd,
                           desired_exit_status=1)
         assert 'Repository has uncommitted changes' in err
+
+    def test_validate_repo_untracked_parent(self):
+        os.makedirs(os.path.join('mockOF', 'untracked', 'subdir'))
+        open(os.path.join('mockOF', 'untracked', 'subdir', 'file.txt'),
+             'w').close()
+        # git status only lists untracked/, not the directories below
+        assert ofStateManager.probe_git_repo(
+                    os.path.join('mockOF', 'untracked', 'subdir')) == 'no-repo'
+        assert ofStateManager.probe_git_repo(
+                    os.path.join('mockOF', 'untracked')) == 'no-repo'
+        assert ofStateManager.probe_git_repo('mockOF') == 'untracked'
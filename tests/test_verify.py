@@ -0,0 +1,55 @@
+"""Tests for the verify subcommand"""
+# pylint: disable=C0111
+import pytest
+import os
+import json
+from util_functions import run_ofSM, load_json_file
+
+MISSING_SHA = '0123456789abcdef0123456789abcdef01234567'
+
+
+def break_snapshot(name):
+    """Point ofxSomeAddon of snapshot name to a commit which does not exist."""
+    filename = os.path.join('mockProject', 'metadata.json')
+    metadata = load_json_file(filename)
+    for entry in metadata['snapshots']:
+        if entry['name'] == name:
+            entry['addons'][0]['sha'] = MISSING_SHA
+    with open(filename, 'w') as fobj:
+        json.dump(metadata, fobj)
+
+
+@pytest.mark.usefixtures('set_up')
+class TestVerify:
+    """Test verify subcommand and the checkout pre-flight check"""
+
+    def test_verify(self, capfd):
+        run_ofSM('record -p mockProject')
+        run_ofSM('record -p mockProject -n snapshot-1')
+        out, _ = run_ofSM('verify -p mockProject', capfd=capfd)
+        assert 'Checking 4 commits in 4 repositories' in out
+        assert 'All commits of 2 snapshots are available.' in out
+
+    def test_verify_missing(self, capfd):
+        run_ofSM('record -p mockProject')
+        run_ofSM('record -p mockProject -n snapshot-1')
+        break_snapshot('snapshot-1')
+        _, err = run_ofSM('verify -p mockProject', capfd=capfd,
+                          desired_exit_status=1)
+        assert ('snapshot-1: commit ' + MISSING_SHA + ' of ofxSomeAddon ' +
+                'is missing from ') in err
+        assert 'latest:' not in err
+        assert '1 of 2 snapshots cannot be checked out.' in err
+
+        # only check the named snapshot
+        out, _ = run_ofSM('verify -p mockProject -n latest', capfd=capfd)
+        assert 'All commits of 1 snapshots are available.' in out
+
+    def test_checkout_missing(self, capfd):
+        run_ofSM('record -p mockProject')
+        break_snapshot('latest')
+        out, err = run_ofSM('checkout -p mockProject', capfd=capfd,
+                            desired_exit_status=1)
+        assert 'Commit ' + MISSING_SHA + ' of ofxSomeAddon is missing' in err
+        assert 'Snapshot latest cannot be checked out.' in err
+        assert 'Checking out ' not in out
@@ -0,0 +1,127 @@
+"""Tests for the watch subcommand"""
+# pylint: disable=C0111
+import pytest
+import os
+import re
+import signal
+import subprocess
+import sys
+from util_functions import SCRIPT_LOC, load_json_file
+
+
+def read_until(process, prefix):
+    """Read the output of process up to a line starting with prefix, return
+    the lines read"""
+    output = []
+    for line in process.stdout:
+        output.append(line)
+        if line.startswith(prefix):
+            break
+    return output
+
+
+def start_watch(options, once=True):
+    """Start watch on mockProject, return the process once it watches"""
+    process = subprocess.Popen([sys.executable, SCRIPT_LOC, 'watch', '-p',
+                                'mockProject'] + (['--once'] if once else []) +
+                               options,
+                               # background jobs of a shell ignore SIGINT
+                               preexec_fn=lambda: signal.signal(
+                                   signal.SIGINT, signal.SIG_DFL),
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT,
+                               universal_newlines=True)
+    return process, read_until(process, 'INFO\tWatching')
+
+
+def commit(repopath):
+    subprocess.check_call(['git', '-c', 'user.name=test', '-c',
+                           'user.email=test@example.com', 'commit', '-q',
+                           '--allow-empty', '-m', 'moved'], cwd=repopath)
+    return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                   cwd=repopath,
+                                   universal_newlines=True).strip()
+
+
+@pytest.mark.usefixtures('set_up')
+class TestWatch:
+    """Test watch subcommand"""
+
+    @pytest.mark.parametrize('options', [[], ['--poll', '--poll-interval',
+                                              '0.1']])
+    def test_watch(self, options):
+        # both commits end up in one snapshot
+        process, output = start_watch(options + ['--debounce', '1'])
+        assert ('Watching 4 repositories: OF, ofxSomeAddon, '
+                '../../mockOF/addons/ofxSomeOtherAddon, '
+                '../../ofxMockExternalAddon') in output[-1]
+
+        addon_path = os.path.join('mockOF', 'addons', 'ofxSomeAddon')
+        commit(addon_path)
+        sha = commit(addon_path)
+        out = process.communicate(timeout=60)[0]
+        assert process.returncode == 0
+        assert out.count('Recorded snapshot latest') == 1
+
+        test = load_json_file(os.path.join('mockProject', 'metadata.json'))
+        entry = test['snapshots'][0]
+        assert entry['description'] == ('Recorded by watch after '
+                                        'ofxSomeAddon moved')
+        assert entry['addons'][0]['name'] == 'ofxSomeAddon'
+        assert entry['addons'][0]['sha'] == sha
+
+    def test_watch_retry(self):
+        process, _ = start_watch(['--poll', '--poll-interval', '0.1',
+                                  '--debounce', '0.2'])
+        addon_path = os.path.join('mockOF', 'addons', 'ofxSomeAddon')
+        open(os.path.join(addon_path, 'untracked.txt'), 'w').close()
+        commit(addon_path)
+        # the addon is not clean, so record fails
+        output = read_until(process, 'ERROR\tCould not record snapshot')
+        assert 'Repository has untracked files' in ''.join(output)
+        assert process.poll() is None
+
+        # and is tried again on the next change
+        subprocess.check_call(['git', 'add', 'untracked.txt'],
+                              cwd=addon_path)
+        sha = commit(addon_path)
+        out = process.communicate(timeout=60)[0]
+        assert process.returncode == 0
+        assert 'Recorded snapshot latest' in out
+        test = load_json_file(os.path.join('mockProject', 'metadata.json'))
+        assert test['snapshots'][0]['addons'][0]['sha'] == sha
+
+    def test_watch_incremental(self):
+        process, _ = start_watch(['--poll', '--poll-interval', '0.1',
+                                  '--debounce', '1', '--profile'],
+                                 once=False)
+        addon_path = os.path.join('mockOF', 'addons', 'ofxSomeAddon')
+        commit(addon_path)
+        read_until(process, 'INFO\tRecorded snapshot')
+        sha = commit(addon_path)
+        external_sha = commit('ofxMockExternalAddon')
+        output = ''.join(read_until(process, 'INFO\tRecorded snapshot'))
+        assert 'ofxSomeAddon moved' in output
+        process.send_signal(signal.SIGINT)
+        out = process.communicate(timeout=60)[0]
+        assert process.returncode == 0
+        assert 'Stopped watching' in out
+
+        # only the repositories that moved were validated again
+        counts = dict((name, int(count)) for count, name in
+                      re.findall(r' ms +(\d+)x  (.*)', out))
+        assert counts['validate OF'] == 1
+        assert counts['addon ofxSomeAddon'] == 2
+        assert counts['addon ../../ofxMockExternalAddon'] == 2
+        assert counts['addon ../../mockOF/addons/ofxSomeOtherAddon'] == 1
+
+        test = load_json_file(os.path.join('mockProject', 'metadata.json'))
+        entry = test['snapshots'][0]
+        assert entry['description'] == ('Recorded by watch after '
+                                        '../../ofxMockExternalAddon, '
+                                        'ofxSomeAddon moved')
+        addons = dict((addon['name'], addon) for addon in entry['addons'])
+        assert addons['ofxSomeAddon']['sha'] == sha
+        assert addons['../../ofxMockExternalAddon']['sha'] == external_sha
+        assert addons['ofxNonGitAddon']['sha'] == 'non-git'
+        assert 'fingerprint' in addons['ofxNonGitAddon']
@@ -0,0 +1,84 @@
+"""Tests for the --workspace option of record and archive"""
+# pylint: disable=C0111
+import pytest
+import os
+import shutil
+from util_functions import run_ofSM, load_json_file
+
+
+def add_project(path):
+    """Copy mockProject to path, pointing it at mockOF"""
+    shutil.copytree('mockProject', path)
+    of_root = os.path.relpath('mockOF', path)
+    config = os.path.join(path, 'config.make')
+    with open(config, 'r') as config_make:
+        text = config_make.read()
+    with open(config, 'w') as config_make:
+        config_make.write(text.replace('OF_ROOT = ../mockOF',
+                                       'OF_ROOT = ' + of_root))
+
+
+@pytest.mark.usefixtures('set_up')
+class TestWorkspace:
+    """Test workspace mode"""
+
+    def test_record_workspace(self, capfd):
+        add_project(os.path.join('apps', 'projectA'))
+        add_project(os.path.join('apps', 'category', 'projectB'))
+        add_project(os.path.join('apps', '.hidden', 'projectC'))
+        out, _ = run_ofSM('record -v --workspace apps -n snapshot-1',
+                          capfd=capfd)
+        assert 'Found 2 projects in apps' in out
+        # OF, addons/.gitignore, 4 addons and 1 fingerprint, once each
+        assert 'Resolved 7 repositories and directories for 2 projects' in out
+        assert 'reused results 7 times' in out
+        assert out.count('Reusing core result') == 1
+        assert out.count('Reusing addon result') == 4
+
+        entries = [load_json_file(os.path.join(path, 'metadata.json'))
+                   ['snapshots'][0]
+                   for path in [os.path.join('apps', 'projectA'),
+                                os.path.join('apps', 'category',
+                                             'projectB')]]
+        assert entries[0]['name'] == 'snapshot-1'
+        assert entries[0]['core']['path'] == '../../mockOF'
+        assert entries[1]['core']['path'] == '../../../mockOF'
+        assert entries[0]['core']['sha'] == entries[1]['core']['sha']
+        assert entries[0]['addons'] == entries[1]['addons']
+        assert not os.path.exists(os.path.join('apps', '.hidden',
+                                               'projectC', 'metadata.json'))
+
+    def test_record_workspace_failure(self, capfd):
+        add_project(os.path.join('apps', 'projectA'))
+        add_project(os.path.join('apps', 'projectB'))
+        with open(os.path.join('apps', 'projectB', 'addons.make'),
+                  'a') as addons_make:
+            addons_make.write('ofxMissingAddon\n')
+        _, err = run_ofSM('record --workspace apps', capfd=capfd,
+                          desired_exit_status=1)
+        assert 'projectB: ofxMissingAddon does not exist at' in err
+        assert '1 of 2 projects failed:' in err
+        assert os.path.isfile(os.path.join('apps', 'projectA',
+                                           'metadata.json'))
+
+        _, err = run_ofSM('record --workspace mockOF/addons', capfd=capfd,
+                          desired_exit_status=1)
+        assert 'No projects found in mockOF/addons' in err
+
+    def test_archive_workspace(self, capfd):
+        add_project(os.path.join('apps', 'projectA'))
+        add_project(os.path.join('apps', 'projectB'))
+        out, _ = run_ofSM('archive --workspace apps', capfd=capfd)
+        assert 'Found 2 projects in apps' in out
+        for name in ['projectA', 'projectB']:
+            archivepath = os.path.join('apps', name, name + '_archive')
+            assert os.path.isfile(os.path.join(archivepath, name +
+                                               '_latest_checksums.json'))
+            assert len([item for item in os.listdir(archivepath)
+                        if item.endswith('.tar.gz')]) == 5
+            assert os.path.isfile(os.path.join('apps', name,
+                                               'metadata.json'))
+
+        _, err = run_ofSM('archive --workspace apps --stream out.tar',
+                          capfd=capfd, desired_exit_status=1)
+        assert '--stream and --workspace cannot be combined.' in err
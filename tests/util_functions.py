@@ -14,8 +14,7 @@ REPLAY_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__),
 
 def script_cmd(arg_string, working_dir):
     """Execute command in working_dir and return output"""
-    output = subprocess.call(shlex.split(arg_string),
-                                stderr=subprocess.STDOUT, cwd=working_dir)
+    output = subprocess.call(shlex.split(arg_string), cwd=working_dir)
     return output
 
 